@@ -6,51 +6,99 @@ import glob
 import click
 import zipfile
 import gzip
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from cjio import errors, cityjson
-from cityjson2ifc import Cityjson2ifc
-from multiprocessing import Pool
+from cityjson2ifc import Cityjson2ifc, CONVERTER_VERSION
+from reader import JSON_BACKENDS, CityJSONStream, estimate_size, get_json_loads
+from scheduler import RETRY_BACKOFF, Scheduler, read_quarantine
+from simplify import DEFAULT_TOLERANCE
+from metrics import Metrics, get_max_rss, reset_peak_rss, write_record
+from manifest import Manifest
+from chunking import convert_in_chunks
+from patch import PatchError, patch_tile
+from pipeline import ArchiveWriter
+from sharding import LEASE_TIMEOUT, LeaseDirectory, LeaseLost, get_tile_key, in_shard, parse_shard
 from pathlib import Path
 
 # Define which LODs to export
 LODS = ["0", "1.2", "1.3", "2.2"]
 
-def load_cityjson(infile, ignore_duplicate_keys=False):
+# Name of the manifest of the converted files in the input directory
+MANIFEST_NAME = "ifc_manifest.sqlite"
+# Name of the list of files that failed every retry in the input directory, they are skipped until removed from it
+QUARANTINE_NAME = "ifc_quarantine.jsonl"
+
+# Compression methods for the IFC files in the output zip
+ZIP_COMPRESSION = {
+    "deflate": zipfile.ZIP_DEFLATED,
+    "stored": zipfile.ZIP_STORED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+if hasattr(zipfile, "ZIP_ZSTANDARD"):
+    # Python 3.14 and later
+    ZIP_COMPRESSION["zstd"] = zipfile.ZIP_ZSTANDARD
+
+
+class ConversionError(Exception):
+    """The conversion of a file failed, the scheduler converts it again or quarantines it."""
+
+# Extensions of the input files. Compressed files are decompressed while they are read,
+# a decompressed copy is preferred when it exists.
+CITYJSON_EXTENSIONS = [
+    ".city.jsonl", ".city.json",
+    ".city.jsonl.gz", ".city.json.gz",
+    ".city.jsonl.zst", ".city.json.zst",
+]
+
+
+def stream_cityjson(path, ignore_duplicate_keys=False, json_backend="auto"):
     """
-    Loads a CityJSON file using cjio's cityjson.reader with optional duplicate key ignoring.
-    Returns a CityJSON object.
+    Opens a CityJSON or CityJSONSeq file as a CityJSONStream, which reads the CityObjects one
+    building at a time while converting instead of loading the whole file.
     """
     try:
-        cm = cityjson.reader(file=infile, ignore_duplicate_keys=ignore_duplicate_keys)
+        stream = CityJSONStream(path, ignore_duplicate_keys=ignore_duplicate_keys, json_backend=json_backend)
     except ValueError as e:
-        raise click.ClickException(f'{e}: "{infile.name}".')
+        raise click.ClickException(f'{e}: "{path}".')
     except IOError as e:
-        raise click.ClickException(f'Invalid file: "{infile.name}".\n{e}')
+        raise click.ClickException(f'Invalid file: "{path}".\n{e}')
 
     # Check version and capture warnings
     try:
         with warnings.catch_warnings(record=True) as w:
-            cm.check_version()
-            if w:  # If any warnings were captured
+            cityjson.CityJSON(j=stream.j).check_version()
+            if w:
                 for warn in w:
-                    # Print or log the warning messages if needed
                     click.echo(f"Warning: {warn.message}")
     except errors.CJInvalidVersion as e:
         raise click.ClickException(e.msg)
 
-    # If the purpose is to clear out cityobjects for memory reasons, do it explicitly
-    cm.cityobjects = {}
-    cm.load_from_j(transform=False)
-
-    # The next line also clears the "CityObjects" in cm.j explicitly
-    cm.j["CityObjects"] = {}
-
-    # Force garbage collection to free memory
-    gc.collect()
+    return stream
 
-    return cm
+def unzip_cityjson_file(gz_file):
+    """Decompress a .city.json.gz file next to it, returns the decompressed file or None when it failed."""
+    cityjson_file = gz_file.replace('.gz', '')
+    if os.path.isfile(cityjson_file):
+        click.echo(f"Skipping unzip, already exists: {cityjson_file}")
+        return cityjson_file
+    try:
+        with gzip.open(gz_file, 'rb') as f_in:
+            with open(cityjson_file, 'wb') as f_out:
+                while True:
+                    chunk = f_in.read(64 * 1024 * 1024)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+        click.echo(f"Unzipped {gz_file} to {cityjson_file}.")
+        return cityjson_file
+    except Exception as e:
+        click.echo(f"Failed to unzip {gz_file}: {e}")
+        return None
 
-def unzip_cityjson_files(input_dir: Path):
+def unzip_cityjson_files(input_dir: Path, num_threads: int = 1):
     # Find all zipped files
     cityjson_gz_files = glob.glob(os.path.join(input_dir, "**", "*.city.json.gz"), recursive=True)
     if not cityjson_gz_files:
@@ -59,92 +107,226 @@ def unzip_cityjson_files(input_dir: Path):
 
     click.echo(f"Found {len(cityjson_gz_files)} .city.json.gz files.")
     click.echo("Unzipping files...")
-    # Unzip the .city.json.gz files
-    cityjson_files = []
-    for gz_file in cityjson_gz_files:
-        cityjson_file = gz_file.replace('.gz', '')
-        if os.path.isfile(cityjson_file):
-            click.echo(f"Skipping unzip, already exists: {cityjson_file}")
-            cityjson_files.append(cityjson_file)
-            continue
-        try:
-            with gzip.open(gz_file, 'rb') as f_in:
-                with open(cityjson_file, 'wb') as f_out:
-                    while True:
-                        chunk = f_in.read(64 * 1024 * 1024)
-                        if not chunk:
-                            break
-                        f_out.write(chunk)
-            cityjson_files.append(cityjson_file)
-            click.echo(f"Unzipped {gz_file} to {cityjson_file}.")
-        except Exception as e:
-            click.echo(f"Failed to unzip {gz_file}: {e}")
+    # Unzip the .city.json.gz files, zlib releases the GIL so threads decompress and write at the same time
+    with ThreadPoolExecutor(max(1, num_threads)) as executor:
+        cityjson_files = [
+            cityjson_file for cityjson_file in executor.map(unzip_cityjson_file, cityjson_gz_files)
+            if cityjson_file is not None
+        ]
     if not cityjson_files:
         click.echo("No valid CityJSON files found after unzipping.")
         sys.exit(1)
     click.echo(f"Total unzipped CityJSON files: {len(cityjson_files)}")
 
-def process_cityjson_file(cityjson_file: Path, ignore_duplicate: bool) -> None:
-    zip_filename = cityjson_file.replace(".city.json", ".ifc.zip")
-    zip_tmp = zip_filename + ".tmp"
+def strip_cityjson_extension(cityjson_file):
+    for extension in CITYJSON_EXTENSIONS:
+        if cityjson_file.endswith(extension):
+            return cityjson_file[:-len(extension)]
+    return os.path.splitext(cityjson_file)[0]
+
+def find_cityjson_files(input_dir):
+    cityjson_files = {}
+    for extension in CITYJSON_EXTENSIONS:
+        for cityjson_file in glob.glob(os.path.join(input_dir, "**", "*" + extension), recursive=True):
+            cityjson_files.setdefault(strip_cityjson_extension(cityjson_file), cityjson_file)
+    return sorted(cityjson_files.values())
+
+def build_metrics_record(record, metrics, converter):
+    """Combine the metrics of the tile with the metrics of the conversion of each LoD."""
+    record.update(metrics.to_dict())
+    if converter is not None:
+        conversion = converter.get_metrics()
+        record["timings"].update(conversion["timings"])
+        record["counts"].update(conversion["counts"])
+        record["lods"] = conversion.get("lods", {})
+        for lod, error in converter.failed_lods.items():
+            record["lods"].setdefault(lod, {})["error"] = str(error)
+    return record
+
+def get_zip_filename(cityjson_file):
+    return strip_cityjson_extension(cityjson_file) + ".ifc.zip"
+
+def get_settings(tessellated, compression, compression_level, gltf=False, simplify=None):
+    """The settings that change the output, a tile converted with other settings is converted again."""
+    settings = {"tessellated": tessellated, "compression": compression, "compression_level": compression_level}
+    # Only when set, so that the tiles of earlier conversions stay up to date
+    if gltf:
+        settings["gltf"] = True
+    if simplify is not None:
+        settings["simplify"] = simplify
+    return settings
 
-    if os.path.isfile(zip_filename):
+def process_cityjson_file(cityjson_file: Path, ignore_duplicate: bool, tessellated: bool = False,
+                          compression: str = "deflate", compression_level: int = None, metrics_file: str = None,
+                          manifest_file: str = None, patch: bool = False, chunks: int = 1,
+                          json_backend: str = "auto", step_geometry: bool = False, gltf: bool = False,
+                          simplify: float = None, lease=None) -> None:
+    output_base = strip_cityjson_extension(cityjson_file)
+    zip_filename = get_zip_filename(cityjson_file)
+    # A node that lost its lease may still be writing its temp file
+    zip_tmp = zip_filename + (f".{lease.token}.tmp" if lease is not None else ".tmp")
+
+    manifest = None
+    previous = None
+    if manifest_file is not None:
+        manifest = Manifest(manifest_file, shared=lease is not None)
+        settings = get_settings(tessellated, compression, compression_level, gltf, simplify)
+        up_to_date, content_hash = manifest.check(cityjson_file, zip_filename, CONVERTER_VERSION, LODS, settings)
+        if up_to_date:
+            click.echo(f"Zip file {zip_filename} is up to date. Skipping {cityjson_file}.")
+            manifest.close()
+            return
+        # The GLB files are written from the whole model, a patched model has no GLB file of its own
+        if patch and not gltf and manifest.can_patch(cityjson_file, zip_filename, CONVERTER_VERSION, LODS, settings):
+            # The buildings of the earlier conversion, the ones that changed are patched into its output
+            previous = manifest.get_features(cityjson_file)
+        # Hashing a large tile takes a while, a node that lost its lease in the meantime leaves the record alone
+        if lease is not None and not lease.is_held():
+            click.echo(f"The lease on {cityjson_file} expired and another node claimed it. Skipping.")
+            manifest.close()
+            return
+        since = lease.claimed_at if lease is not None else None
+        if not manifest.start(cityjson_file, content_hash, CONVERTER_VERSION, LODS, settings, since=since):
+            click.echo(f"{cityjson_file} was converted by another node. Skipping.")
+            manifest.close()
+            return
+    elif os.path.isfile(zip_filename):
         click.echo(f"Zip file {zip_filename} exists. Skipping {cityjson_file}.")
-        try:
-            os.remove(cityjson_file)
-        except Exception:
-            pass
+        # Only remove decompressed copies, never the original compressed tiles
+        if not cityjson_file.endswith((".gz", ".zst")):
+            try:
+                os.remove(cityjson_file)
+            except Exception:
+                pass
         return
 
-    if os.path.isfile(zip_tmp):
-        click.echo(f"Removing stale temp file: {zip_tmp}")
+    stale_files = [zip_tmp] if os.path.isfile(zip_tmp) else []
+    if lease is not None:
+        # Temp files of nodes that crashed, the temp file of a node that is still converting keeps changing
+        stale_files = [
+            tmp for tmp in glob.glob(glob.escape(zip_filename) + ".*.tmp")
+            if time.time() - os.path.getmtime(tmp) > lease.timeout
+        ]
+    for stale_file in stale_files:
+        click.echo(f"Removing stale temp file: {stale_file}")
         try:
-            os.remove(zip_tmp)
+            os.remove(stale_file)
         except Exception:
             pass
 
-    output_ifc_files = []
+    cm = None
+    converter = None
+    metrics = Metrics()
+    record = {"file": cityjson_file, "status": "failed"}
+    # The worker may have converted larger tiles before, so its peak memory use is measured from here
+    peak_reset = reset_peak_rss()
+    start = time.perf_counter()
     try:
-        with open(cityjson_file, "r") as infile:
-            click.echo(f"Parsing {infile.name} ...")
-            cm = load_cityjson(infile, ignore_duplicate_keys=ignore_duplicate)
-            for lod in LODS:
-                converter = Cityjson2ifc()
-                output_ifc_path = cityjson_file.replace(".city.json", f"-{lod}.ifc")
-                converter.configuration(
-                    name_project="3DBAG Project",
-                    name_site="3DBAG Site",
-                    name_person_family="3Dgeoinfo",
-                    name_person_given="3DGI/",
-                    lod=lod,
-                    file_destination=output_ifc_path
-                )
+        click.echo(f"Parsing {cityjson_file} ...")
+        with metrics.time("read_header"):
+            cm = stream_cityjson(cityjson_file, ignore_duplicate_keys=ignore_duplicate, json_backend=json_backend)
+        # The IFC files are compressed straight into the zip, they are never written to disk uncompressed
+        # The models are compressed into the zip in a thread while the next one is serialized
+        with zipfile.ZipFile(zip_tmp, 'w', compression=ZIP_COMPRESSION[compression],
+                             compresslevel=compression_level) as zf, ArchiveWriter(zf) as writer:
+            converter = Cityjson2ifc()
+            converter.configuration(
+                name_project="3DBAG Project",
+                name_site="3DBAG Site",
+                name_person_family="3Dgeoinfo",
+                name_person_given="3DGI/",
+                lods=LODS,
+                tessellated=tessellated,
+                archive=writer,
+                hash_features=manifest is not None,
+                step_geometry=step_geometry,
+                gltf=gltf,
+                simplify=simplify,
+                file_destination=output_base + ".ifc"
+            )
+            patched = False
+            if previous is not None:
                 try:
+                    with metrics.time("patch"):
+                        changed, removed = patch_tile(converter, cm, previous, zip_filename)
+                    patched = True
+                    click.echo(f"Patched {changed} changed and {removed} removed buildings into {zip_filename}.")
+                except PatchError as e:
+                    click.echo(f"Cannot patch {zip_filename}, converting {cityjson_file} as a whole: {e}")
+            if not patched and chunks > 1:
+                click.echo(f"Converting {cityjson_file} in {chunks} chunks ...")
+                with metrics.time("convert"):
+                    record["chunk_peak_rss"] = convert_in_chunks(converter, cm, chunks, ignore_duplicate)
+            elif not patched:
+                # All LoDs are converted in a single pass over the CityObjects
+                with metrics.time("convert"):
                     converter.convert(cm)
-                    #click.echo(f"Conversion completed for {cityjson_file} at LoD {lod}.")
-                    output_ifc_files.append(output_ifc_path)
-                except Exception as ex:
-                    click.echo(f"Failed to convert {cityjson_file} at LoD {lod}.\nError: {ex}")
-                    continue
-            if output_ifc_files:
-                with zipfile.ZipFile(zip_tmp, 'w') as zf:
-                    for ifc_file in output_ifc_files:
-                        zf.write(ifc_file, os.path.basename(ifc_file))
-                os.rename(zip_tmp, zip_filename)
-                click.echo(f"Zipped IFC files into {zip_filename}.")
-                click.echo(f"Processed {cityjson_file} and created {zip_filename}.")
-            else:
-                click.echo(f"No IFC files generated for {cityjson_file}. Skipping zip.")
+        for lod in LODS:
+            if lod in converter.failed_lods:
+                click.echo(f"Failed to convert {cityjson_file} at LoD {lod}.\nError: {converter.failed_lods[lod]}")
+        stats = converter.get_entity_stats()
+        reused = sum(counts["reused"] for counts in stats.values())
+        if reused:
+            total = reused + sum(counts["created"] for counts in stats.values())
+            details = ", ".join(f"{IFC_class} {counts['reused']}" for IFC_class, counts in stats.items() if counts["reused"])
+            click.echo(f"Reused {reused} of {total} deduplicated entities for {cityjson_file} ({details}).")
+        if simplify is not None:
+            counts = [lod_metrics.counts for lod_metrics in converter.lod_metrics.values()]
+            removed_faces = sum(lod_counts["simplified_faces"] for lod_counts in counts)
+            removed_vertices = sum(lod_counts["simplified_vertices"] for lod_counts in counts)
+            click.echo(f"Simplified {cityjson_file}: removed {removed_faces} faces and {removed_vertices} vertices.")
+        if converter.output_files:
+            metrics.count("zip_bytes", os.path.getsize(zip_tmp))
+            if lease is not None and not lease.is_held():
+                raise LeaseLost(f"the lease on {cityjson_file} expired and another node claimed it")
+            os.replace(zip_tmp, zip_filename)
+            # A tile with failed LoDs is converted again in the next run
+            record["status"] = "partial" if converter.failed_lods else "converted"
+            click.echo(f"Zipped IFC files into {zip_filename}.")
+            click.echo(f"Processed {cityjson_file} and created {zip_filename}.")
+        else:
+            record["status"] = "no_output"
+            click.echo(f"No IFC files generated for {cityjson_file}. Skipping zip.")
+    except LeaseLost as e:
+        record["status"] = "lease_lost"
+        record["error"] = str(e)
+        click.echo(f"Dropped the conversion of {cityjson_file}: {e}")
     except Exception as e:
+        record["error"] = str(e)
         click.echo(f"Error processing {cityjson_file}: {e}")
     finally:
-        for ifc_file in output_ifc_files:
+        if manifest is not None and record["status"] == "lease_lost":
+            # The manifest entry belongs to the node that holds the lease now
+            manifest.close()
+        elif manifest is not None:
+            converted = record["status"] in ["converted", "partial"]
+            # Only the buildings of a tile of which all LoDs were converted can be patched later
+            features = converter.feature_hashes if record["status"] == "converted" else None
+            manifest.finish(cityjson_file, record["status"], zip_filename if converted else None, features, since=since)
+            manifest.close()
+        if metrics_file is not None:
+            metrics.timings["total"] = time.perf_counter() - start
+            # Without a reset, eg. on macOS, only the peak of the worker since it started is known
+            record["tile_peak_rss" if peak_reset else "worker_peak_rss"] = get_max_rss()
+            write_record(metrics_file, build_metrics_record(record, metrics, converter))
+        if os.path.isfile(zip_tmp):
             try:
-                os.remove(ifc_file)
+                os.remove(zip_tmp)
             except Exception:
                 pass
         del cm
         gc.collect()
+    if record["status"] == "failed":
+        raise ConversionError(record.get("error", "the conversion failed"))
+
+def process_leased_cityjson_file(leases, cityjson_file, *args):
+    """Convert the file when no other node holds a lease on it, see process_cityjson_file for the arguments."""
+    lease = leases.claim(cityjson_file)
+    if lease is None:
+        click.echo(f"{cityjson_file} is claimed by another node. Skipping.")
+        return
+    with lease:
+        process_cityjson_file(cityjson_file, *args, lease=lease)
 
 
 @click.command()
@@ -152,29 +334,154 @@ def process_cityjson_file(cityjson_file: Path, ignore_duplicate: bool) -> None:
               help="Directory containing .city.json.gz files.")
 @click.option('--ignore_duplicate', is_flag=True, default=False,
               help="Ignore duplicate JSON keys in CityJSON files.")
+@click.option('--json-backend', type=click.Choice(JSON_BACKENDS), default="auto", show_default=True,
+              help="Parser of CityJSONSeq lines. orjson is faster but requires --ignore_duplicate, "
+                   "auto uses it when it is installed and duplicate keys are ignored.")
 @click.option('--unzip-files', is_flag=True, default=False,
-              help="Unzip .city.json.gz files before processing.")
+              help="Unzip .city.json.gz files to disk before processing. By default they are read compressed.")
 @click.option('--num-workers', type=int, default=2, show_default=True,
               help="Number of parallel workers for processing.")
-def main(input_dir, ignore_duplicate, unzip_files, num_workers):
+@click.option('--manifest', 'manifest_file', type=click.Path(dir_okay=False), default=None,
+              help=f"SQLite manifest of the converted files, {MANIFEST_NAME} in the input directory by default.")
+@click.option('--no-manifest', is_flag=True, default=False,
+              help="Do not use a manifest, skip the files of which the zip file exists.")
+@click.option('--metrics', 'metrics_file', type=click.Path(dir_okay=False), default=None,
+              help="Append the timings and counts of every file as a JSON line to this file.")
+@click.option('--max-worker-memory-growth', type=int, default=2048, show_default=True,
+              help="Restart a worker when its memory use has grown by more than this many MB.")
+@click.option('--tile-timeout', type=float, default=None,
+              help="Kill a worker that converts a file for longer than this many seconds, no limit by default.")
+@click.option('--max-worker-memory', type=int, default=None,
+              help="Kill a worker of which the processes use more than this many MB, no limit by default.")
+@click.option('--retries', type=int, default=2, show_default=True,
+              help="Number of times a file is converted again after it failed or its worker was killed.")
+@click.option('--retry-backoff', type=float, default=RETRY_BACKOFF, show_default=True,
+              help="Seconds before the first retry of a file, every next retry waits twice as long.")
+@click.option('--quarantine', 'quarantine_file', type=click.Path(dir_okay=False), default=None,
+              help=f"List of the files that failed every retry, with their error, {QUARANTINE_NAME} in the input "
+                   "directory by default. These files are skipped until they are removed from it.")
+@click.option('--tessellated', is_flag=True, default=False,
+              help="Write geometry as IfcPolygonalFaceSet instead of IfcFace/IfcPolyLoop.")
+@click.option('--step-geometry', is_flag=True, default=False,
+              help="Write the geometry as STEP text directly instead of creating its entities with IfcOpenShell.")
+@click.option('--gltf', is_flag=True, default=False,
+              help="Also write a GLB file of the geometry per LoD into the zip, with nodes named by IFC GlobalId.")
+@click.option('--simplify', is_flag=True, default=False,
+              help="Merge adjacent coplanar faces of the same surface and drop collinear vertices and degenerate rings.")
+@click.option('--simplify-tolerance', type=float, default=DEFAULT_TOLERANCE, show_default=True,
+              help="Distance in metres within which faces are coplanar and vertices collinear with --simplify.")
+@click.option('--compression', type=click.Choice(list(ZIP_COMPRESSION)), default="deflate", show_default=True,
+              help="Compression of the IFC files in the output zip.")
+@click.option('--compression-level', type=int, default=None,
+              help="Compression level, the default of the compression method when not given.")
+@click.option('--patch', is_flag=True, default=False,
+              help="Patch only the buildings that changed into the existing zip file of a changed file.")
+@click.option('--chunk-size', type=int, default=1024, show_default=True,
+              help="Convert files larger than this many MB (uncompressed) in chunks in parallel processes.")
+@click.option('--chunks', type=int, default=None,
+              help="Number of chunks, and processes, of a file that is larger than --chunk-size. "
+                   "By default 4, or the number of CPUs when there are less.")
+@click.option('--shard', default=None,
+              help="Only convert the files of shard i/n, counting from 0, to split the files over n nodes.")
+@click.option('--leases', is_flag=True, default=False,
+              help="Claim every file with a lease file before converting it, to share the files with other nodes.")
+@click.option('--lease-dir', type=click.Path(file_okay=False), default=None,
+              help="Directory of the lease files, .ifc_leases in the input directory by default.")
+@click.option('--lease-timeout', type=int, default=LEASE_TIMEOUT, show_default=True,
+              help="Seconds after which the lease of a node that stopped, eg. crashed, expires.")
+def main(input_dir, ignore_duplicate, json_backend, unzip_files, num_workers, manifest_file, no_manifest,
+         metrics_file, max_worker_memory_growth, tile_timeout, max_worker_memory, retries, retry_backoff,
+         quarantine_file, tessellated, step_geometry, gltf, simplify, simplify_tolerance,
+         compression, compression_level, patch, chunk_size, chunks, shard, leases, lease_dir, lease_timeout):
     """
-    Finds all .city.json.gz files in the input directory, unzips them, converts each to IFC for multiple LoDs and zips them in one file.
+    Finds all CityJSON files in the input directory, converts each to IFC for multiple LoDs and zips them in one file.
+    Compressed .city.json.gz files are read directly, unless --unzip-files is given.
     """
     input_dir = os.path.abspath(os.path.expanduser(input_dir))
+    # The tolerance is part of the settings, a tile simplified with another tolerance is converted again
+    simplify = simplify_tolerance if simplify else None
+    try:
+        get_json_loads(json_backend, ignore_duplicate)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--json-backend")
+    if metrics_file is not None:
+        metrics_file = os.path.abspath(os.path.expanduser(metrics_file))
+    quarantine_file = os.path.abspath(os.path.expanduser(quarantine_file or os.path.join(input_dir, QUARANTINE_NAME)))
+    if no_manifest:
+        manifest_file = None
+    else:
+        manifest_file = os.path.abspath(os.path.expanduser(manifest_file or os.path.join(input_dir, MANIFEST_NAME)))
 
     if unzip_files:
-        unzip_cityjson_files(input_dir)
+        unzip_cityjson_files(input_dir, num_workers)
+
+    cityjson_files = find_cityjson_files(input_dir)
+    click.echo(f"Found {len(cityjson_files)} CityJSON files.")
+
+    if shard is not None:
+        try:
+            shard = parse_shard(shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--shard")
+        cityjson_files = [
+            cityjson_file for cityjson_file in cityjson_files if in_shard(get_tile_key(cityjson_file, input_dir), shard)
+        ]
+        click.echo(f"{len(cityjson_files)} CityJSON files are in shard {shard[0]}/{shard[1]}.")
+
+    quarantined = read_quarantine(quarantine_file)
+    if quarantined:
+        count = len(cityjson_files)
+        cityjson_files = [cityjson_file for cityjson_file in cityjson_files if cityjson_file not in quarantined]
+        click.echo(f"Skipping {count - len(cityjson_files)} files that are quarantined in {quarantine_file}.")
 
-    cityjson_files = glob.glob(os.path.join(input_dir, "**", "*.city.json"), recursive=True)
-    click.echo(f"Found {len(cityjson_files)} .city.json files.")
+    if manifest_file is not None:
+        # Files that did not change since their conversion are skipped without opening them
+        settings = get_settings(tessellated, compression, compression_level, gltf, simplify)
+        with Manifest(manifest_file, shared=leases) as manifest:
+            cityjson_files = [
+                cityjson_file for cityjson_file in cityjson_files
+                if not manifest.is_unchanged(cityjson_file, get_zip_filename(cityjson_file), CONVERTER_VERSION, LODS,
+                                             settings)
+            ]
+        click.echo(f"{len(cityjson_files)} CityJSON files are new or changed.")
 
 
-    # Use multiprocessing.Pool so workers restart every 5 files (prevents C-level memory leaks)
-    with Pool(num_workers, maxtasksperchild=5) as pool:
-        results = [pool.apply_async(process_cityjson_file, (cityjson_file, ignore_duplicate)) for cityjson_file in cityjson_files]
-        for r in results:
-            r.get()
+    # The largest files are converted first. Workers are restarted when their memory has grown too much
+    # (prevents C-level memory leaks)
+    if chunks is None:
+        chunks = min(4, os.cpu_count() or 1)
+    tasks = []
+    for cityjson_file in cityjson_files:
+        size = estimate_size(cityjson_file)
+        # A few very large files would otherwise be converted long after all other files are done
+        file_chunks = chunks if size > chunk_size * 1024 * 1024 else 1
+        tasks.append((
+            cityjson_file,
+            (cityjson_file, ignore_duplicate, tessellated, compression, compression_level, metrics_file,
+             manifest_file, patch, file_chunks, json_backend, step_geometry, gltf, simplify),
+            size,
+        ))
+    function = process_cityjson_file
+    if leases:
+        # Every node goes over all files, a file is converted by the node that claims it first
+        lease_dir = os.path.abspath(os.path.expanduser(lease_dir or os.path.join(input_dir, ".ifc_leases")))
+        lease_directory = LeaseDirectory(lease_dir, input_dir, lease_timeout)
+        function = process_leased_cityjson_file
+        tasks = [(name, (lease_directory,) + args, cost) for name, args, cost in tasks]
+    scheduler = Scheduler(
+        function,
+        num_workers,
+        max_rss_growth=max_worker_memory_growth * 1024 * 1024,
+        timeout=tile_timeout,
+        max_rss=max_worker_memory * 1024 * 1024 if max_worker_memory is not None else None,
+        retries=retries,
+        backoff=retry_backoff,
+        quarantine_file=quarantine_file,
+    )
+    failed = scheduler.run(tasks)
 
+    if failed:
+        click.echo(f"{len(failed)} CityJSON files could not be processed, they are listed in {quarantine_file}.")
     click.echo("All CityJSON files have been processed.")
 
 if __name__ == "__main__":
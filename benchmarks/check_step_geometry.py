@@ -0,0 +1,180 @@
+"""
+Checks that the geometry written as STEP text (--step-geometry) gives the same IFC files as the geometry that is
+created with ifcopenshell, on synthetic tiles from generate.py.
+
+A tile is converted both ways, with faces and with tessellated geometry. For every LoD the number of entities of
+each IFC class must be the same, as well as the points and the geometry of every product. The GlobalIds differ
+between two conversions, so the products are compared by the name of their building, their class and their
+faces, a face by the coordinates of its loops. The run fails when a file differs:
+
+    python benchmarks/check_step_geometry.py --buildings 350
+"""
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+import zipfile
+from collections import Counter
+
+import click
+import ifcopenshell
+
+# The converter modules are in the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from batch_converter import process_cityjson_file  # noqa: E402
+
+from generate import generate_tile  # noqa: E402
+
+# Decimals of the coordinates that are compared
+DECIMALS = 6
+
+
+def convert(tile, directory, tessellated, step_geometry):
+    """
+    Convert the tile in ``directory`` like batch_converter does, returns the STEP text of every IFC file of the
+    zip by its LoD.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "tile.city.json")
+    shutil.copyfile(tile, path)
+    zip_file = os.path.join(directory, "tile.ifc.zip")
+    if os.path.exists(zip_file):
+        os.remove(zip_file)
+    # Keep the output of the converter out of the report
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            process_cityjson_file(path, False, tessellated=tessellated, step_geometry=step_geometry)
+        finally:
+            sys.stdout = stdout
+    with zipfile.ZipFile(zip_file) as archive:
+        return {
+            member[len("tile-"):-len(".ifc")]: archive.read(member).decode("utf-8")
+            for member in archive.namelist() if member.endswith(".ifc")
+        }
+
+
+def get_data_size(text):
+    return len(text) - text.index("\nDATA;")
+
+
+def get_coordinates(point):
+    return tuple(round(value, DECIMALS) for value in point)
+
+
+def normalize_ring(points):
+    """The ring rotated to start at its smallest point, so that the same ring has the same key."""
+    start = points.index(min(points))
+    return tuple(points[start:] + points[:start])
+
+
+def get_faces(item):
+    """The faces of a representation item as rings of coordinates, in the orientation of their bounds."""
+    if item.is_a("IfcPolygonalFaceSet"):
+        coordinates = [get_coordinates(point) for point in item.Coordinates.CoordList]
+        faces = []
+        for face in item.Faces:
+            rings = [face.CoordIndex] + list(getattr(face, "InnerCoordIndices", None) or [])
+            faces.append(tuple(normalize_ring([coordinates[index - 1] for index in ring]) for ring in rings))
+        return faces
+    if item.is_a("IfcShellBasedSurfaceModel"):
+        shells = item.SbsmBoundary
+    elif item.is_a("IfcFacetedBrep"):
+        shells = [item.Outer]
+    else:
+        raise ValueError(f"Cannot compare the geometry of {item.is_a()}")
+    faces = []
+    for shell in shells:
+        for face in shell.CfsFaces:
+            rings = []
+            for bound in face.Bounds:
+                points = [get_coordinates(point.Coordinates) for point in bound.Bound.Polygon]
+                rings.append(normalize_ring(points if bound.Orientation else points[::-1]))
+            faces.append(tuple(rings))
+    return faces
+
+
+def get_owner(product):
+    """The name of the building of a product, which is the same in both conversions."""
+    while product is not None and not product.is_a("IfcBuilding"):
+        relations = list(product.ContainedInStructure or []) + list(product.Decomposes or [])
+        if not relations:
+            break
+        relation = relations[0]
+        if relation.is_a("IfcRelContainedInSpatialStructure"):
+            product = relation.RelatingStructure
+        else:
+            product = relation.RelatingObject
+    return product.Name if product is not None else None
+
+
+def summarize(text):
+    """The entity counts, the points and the geometry of the products of an IFC file."""
+    model = ifcopenshell.file.from_string(text)
+    counts = Counter(entity.is_a() for entity in model)
+    points = Counter(get_coordinates(point.Coordinates) for point in model.by_type("IfcCartesianPoint"))
+    products = Counter()
+    for product in model.by_type("IfcProduct"):
+        if product.Representation is None:
+            continue
+        for representation in product.Representation.Representations:
+            faces = sorted(face for item in representation.Items for face in get_faces(item))
+            key = (get_owner(product), product.is_a(), representation.RepresentationIdentifier, tuple(faces))
+            products[key] += 1
+    return counts, points, products
+
+
+def compare_files(reference, fast):
+    """The differences between the summaries of two IFC files, as messages."""
+    differences = []
+    (counts, points, products), (fast_counts, fast_points, fast_products) = summarize(reference), summarize(fast)
+    for IFC_class in sorted(set(counts) | set(fast_counts)):
+        if counts[IFC_class] != fast_counts[IFC_class]:
+            differences.append(
+                f"{IFC_class}: {counts[IFC_class]} entities, {fast_counts[IFC_class]} with STEP geometry"
+            )
+    if points != fast_points:
+        differences.append(f"{sum((points - fast_points).values())} points are missing with STEP geometry, "
+                           f"{sum((fast_points - points).values())} are extra")
+    if products != fast_products:
+        owners = sorted({key[0] for key in (products - fast_products) + (fast_products - products)}, key=str)
+        differences.append(f"the geometry of {len(owners)} buildings differs, eg. {', '.join(map(str, owners[:5]))}")
+    return differences
+
+
+@click.command()
+@click.option('--buildings', type=int, default=350, show_default=True, help="Number of buildings in the tile.")
+@click.option('--seed', type=int, default=0, show_default=True, help="Seed of the random generator.")
+def main(buildings, seed):
+    """Compare the IFC files that are written with and without --step-geometry."""
+    warnings.simplefilter("ignore")
+    failed = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        tile = generate_tile(os.path.join(workdir, "tile.json"), buildings, seed)
+        for tessellated in [False, True]:
+            mode = "tessellated" if tessellated else "faces"
+            reference = convert(tile, os.path.join(workdir, "reference"), tessellated, step_geometry=False)
+            fast = convert(tile, os.path.join(workdir, "step"), tessellated, step_geometry=True)
+            if set(reference) != set(fast):
+                raise click.ClickException(f"The LoDs differ: {sorted(reference)} and {sorted(fast)}")
+            for lod in sorted(reference):
+                differences = compare_files(reference[lod], fast[lod])
+                # The header has the path of the file
+                sizes = f"{get_data_size(reference[lod])} and {get_data_size(fast[lod])} bytes of data"
+                if differences:
+                    failed += 1
+                    click.echo(f"LoD {lod} {mode}: differs ({sizes})")
+                    for difference in differences:
+                        click.echo(f"  {difference}")
+                else:
+                    click.echo(f"LoD {lod} {mode}: identical ({sizes})")
+    if failed:
+        raise click.ClickException(f"{failed} files differ with STEP geometry.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Generates synthetic 3DBAG-like CityJSON tiles for the benchmarks.
+
+Every building is a Building with a LoD0 footprint and a BuildingPart child with LoD 1.2, 1.3 and 2.2 solids
+with semantic surfaces, like in 3DBAG. The buildings are placed in blocks of row houses that share their
+party walls, so the tiles also have shared vertices and shared rings.
+
+    python benchmarks/generate.py --buildings 1000 tile.city.json
+"""
+import gzip
+import json
+import math
+import random
+
+import click
+
+# Size of a 3DBAG tile, in millimetres
+TILE_SIZE = 1000000
+BLOCK_SPACING = 40000
+TRANSLATE = [85000.0, 446000.0, -1.5]
+SEMANTIC_SURFACES = [{"type": "GroundSurface"}, {"type": "RoofSurface"}, {"type": "WallSurface"}]
+GROUND, ROOF, WALL = 0, 1, 2
+
+
+class TileGenerator:
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.vertices = []
+        self.vertex_ids = {}
+        self.cityobjects = {}
+
+    def vertex(self, x, y, z):
+        key = (x, y, z)
+        index = self.vertex_ids.get(key)
+        if index is None:
+            index = len(self.vertices)
+            self.vertex_ids[key] = index
+            self.vertices.append([x, y, z])
+        return index
+
+    def ring(self, footprint, z):
+        return [self.vertex(x, y, z) for x, y in footprint]
+
+    def prism(self, footprint, ground, height):
+        """A LoD1 solid: the footprint extruded to a flat roof."""
+        bottom = self.ring(footprint, ground)
+        top = self.ring(footprint, height)
+        faces = [[bottom[::-1]], [top]]
+        values = [GROUND, ROOF]
+        n = len(footprint)
+        for i in range(n):
+            j = (i + 1) % n
+            faces.append([[bottom[i], bottom[j], top[j], top[i]]])
+            values.append(WALL)
+        return faces, values
+
+    def hipped(self, footprint, ground, eaves, ridge):
+        """A LoD2 solid: walls up to the eaves and a roof face from every eave to the top of the roof."""
+        bottom = self.ring(footprint, ground)
+        top = self.ring(footprint, eaves)
+        cx = sum(x for x, y in footprint) // len(footprint)
+        cy = sum(y for x, y in footprint) // len(footprint)
+        apex = self.vertex(cx, cy, ridge)
+        faces = [[bottom[::-1]]]
+        values = [GROUND]
+        n = len(footprint)
+        for i in range(n):
+            j = (i + 1) % n
+            faces.append([[bottom[i], bottom[j], top[j], top[i]]])
+            values.append(WALL)
+        for i in range(n):
+            j = (i + 1) % n
+            faces.append([[top[i], top[j], apex]])
+            values.append(ROOF)
+        return faces, values
+
+    def solid(self, lod, faces, values):
+        return {
+            "type": "Solid",
+            "lod": lod,
+            "boundaries": [faces],
+            "semantics": {"surfaces": SEMANTIC_SURFACES, "values": [values]},
+        }
+
+    def attributes(self, identificatie, footprint, eaves, ridge, ground):
+        r = self.random
+        area = polygon_area(footprint) / 1e6
+        year = r.randint(1850, 2023)
+        return {
+            "identificatie": identificatie,
+            "status": r.choice(["Pand in gebruik", "Pand in gebruik (niet ingemeten)", "Verbouwing pand"]),
+            "oorspronkelijkbouwjaar": year,
+            "begingeldigheid": f"{r.randint(2010, 2023)}-0{r.randint(1, 9)}-1{r.randint(0, 9)}",
+            "eindgeldigheid": None,
+            "documentnummer": f"{r.randint(0, 99999):05d}",
+            "documentdatum": f"{year}-01-01",
+            "voorkomenidentificatie": 1,
+            "geconstateerd": False,
+            "b3_bag_bag_overlap": 0.0,
+            "b3_bouwlagen": max(1, (eaves - ground) // 3000),
+            "b3_dak_type": r.choice(["slanted", "horizontal", "multiple horizontal"]),
+            "b3_h_maaiveld": ground / 1000,
+            "b3_h_dak_min": eaves / 1000,
+            "b3_h_dak_50p": (eaves + ridge) / 2000,
+            "b3_h_dak_70p": (eaves + 0.7 * (ridge - eaves)) / 1000,
+            "b3_h_dak_max": ridge / 1000,
+            "b3_kas_warenhuis": False,
+            "b3_mutatie_ahn3_ahn4": r.random() < 0.05,
+            "b3_nodata_fractie_ahn3": round(r.random() * 0.1, 3),
+            "b3_nodata_fractie_ahn4": round(r.random() * 0.1, 3),
+            "b3_nodata_radius_ahn3": round(r.random(), 3),
+            "b3_nodata_radius_ahn4": round(r.random(), 3),
+            "b3_opp_buitenmuur": round(area * 1.5, 2),
+            "b3_opp_dak_plat": 0.0,
+            "b3_opp_dak_schuin": round(area * 1.2, 2),
+            "b3_opp_grond": round(area, 2),
+            "b3_opp_scheidingsmuur": round(area * 0.4, 2),
+            "b3_puntdichtheid_ahn3": round(r.uniform(5, 20), 2),
+            "b3_puntdichtheid_ahn4": round(r.uniform(10, 30), 2),
+            "b3_pw_bron": "AHN4",
+            "b3_pw_datum": r.choice([2019, 2020, 2022]),
+            "b3_pw_selectie_reden": "PREFERRED_AND_LATEST",
+            "b3_reconstructie_onvolledig": False,
+            "b3_rmse_lod12": round(r.random(), 3),
+            "b3_rmse_lod13": round(r.random(), 3),
+            "b3_rmse_lod22": round(r.random(), 3),
+            "b3_val3dity_lod12": [],
+            "b3_val3dity_lod13": [],
+            "b3_val3dity_lod22": [] if r.random() < 0.9 else ["203"],
+            "b3_volume_lod12": round(area * (eaves - ground) / 1000, 2),
+            "b3_volume_lod13": round(area * (eaves - ground) / 1000, 2),
+            "b3_volume_lod22": round(area * (ridge - ground) / 1000, 2),
+        }
+
+    def add_building(self, footprint, ground, eaves, ridge):
+        index = len(self.cityobjects) // 2
+        building_id = f"NL.IMBAG.Pand.{index:016d}"
+        part_id = building_id + "-0"
+        lod12 = self.prism(footprint, ground, eaves)
+        lod13 = self.prism(footprint, ground, (eaves + ridge) // 2)
+        lod22 = self.hipped(footprint, ground, eaves, ridge)
+        self.cityobjects[building_id] = {
+            "type": "Building",
+            "attributes": self.attributes(building_id, footprint, eaves, ridge, ground),
+            "children": [part_id],
+            "geometry": [{"type": "MultiSurface", "lod": "0", "boundaries": [[self.ring(footprint, ground)]]}],
+        }
+        self.cityobjects[part_id] = {
+            "type": "BuildingPart",
+            "parents": [building_id],
+            "geometry": [self.solid("1.2", *lod12), self.solid("1.3", *lod13), self.solid("2.2", *lod22)],
+        }
+
+    def add_block(self, x, y):
+        """A row of houses with shared party walls, or a detached house with an irregular footprint."""
+        r = self.random
+        ground = r.randint(-2000, 2000)
+        if r.random() < 0.2:
+            corners = r.randint(5, 9)
+            radius = r.randint(5000, 12000)
+            footprint = [
+                (x + int(radius * math.cos(2 * math.pi * i / corners)), y + int(radius * math.sin(2 * math.pi * i / corners)))
+                for i in range(corners)
+            ]
+            eaves = ground + r.randint(3000, 9000)
+            self.add_building(footprint, ground, eaves, eaves + r.randint(0, 5000))
+            return 1
+        houses = r.randint(2, 8)
+        depth = r.randint(8000, 12000)
+        eaves = ground + r.randint(5000, 9000)
+        ridge = eaves + r.randint(2000, 5000)
+        x0 = x
+        for _ in range(houses):
+            x1 = x0 + r.randint(5000, 7000)
+            self.add_building([(x0, y), (x1, y), (x1, y + depth), (x0, y + depth)], ground, eaves, ridge)
+            x0 = x1
+        return houses
+
+    def generate(self, buildings):
+        blocks_per_row = TILE_SIZE // BLOCK_SPACING
+        count = 0
+        block = 0
+        while count < buildings:
+            x = (block % blocks_per_row) * BLOCK_SPACING
+            y = (block // blocks_per_row) * BLOCK_SPACING
+            count += self.add_block(x, y)
+            block += 1
+        return {
+            "type": "CityJSON",
+            "version": "2.0",
+            "transform": {"scale": [0.001, 0.001, 0.001], "translate": TRANSLATE},
+            "metadata": {"referenceSystem": "https://www.opengis.net/def/crs/EPSG/0/7415"},
+            "CityObjects": self.cityobjects,
+            "vertices": self.vertices,
+        }
+
+
+def polygon_area(footprint):
+    n = len(footprint)
+    return abs(sum(
+        footprint[i][0] * footprint[(i + 1) % n][1] - footprint[(i + 1) % n][0] * footprint[i][1] for i in range(n)
+    )) / 2
+
+
+def generate_tile(path, buildings, seed=0):
+    """Write a synthetic tile with at least ``buildings`` buildings, gzip compressed when the path ends with .gz."""
+    tile = TileGenerator(seed).generate(buildings)
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as file:
+        json.dump(tile, file, separators=(",", ":"))
+    return path
+
+
+@click.command()
+@click.option('--buildings', type=int, default=1000, show_default=True, help="Number of buildings in the tile.")
+@click.option('--seed', type=int, default=0, show_default=True, help="Seed of the random generator.")
+@click.argument('output', type=click.Path(dir_okay=False))
+def main(buildings, seed, output):
+    """Generate a synthetic 3DBAG-like CityJSON tile."""
+    generate_tile(output, buildings, seed)
+    click.echo(f"Generated {output}.")
+
+
+if __name__ == "__main__":
+    main()
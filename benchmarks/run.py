@@ -0,0 +1,217 @@
+"""
+Benchmarks of the conversion, on synthetic tiles from generate.py so that they run offline.
+
+The micro benchmarks time the building blocks of a conversion: the IfcCartesianPoints of the vertices, the
+faces of the LoD 2.2 solids and the property sets of the buildings. The end-to-end benchmarks time
+process_cityjson_file on a whole tile. Each benchmark is repeated and the median time is kept.
+
+The results are saved as JSON. Given the results of an earlier run with --compare, the run fails when a
+benchmark got slower by more than --threshold:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json --threshold 0.1
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+
+import click
+import ifcopenshell
+
+# The converter modules are in the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from batch_converter import process_cityjson_file  # noqa: E402
+from geometry import GeometryIO  # noqa: E402
+from property_sets import PropertySetWriter  # noqa: E402
+from reader import CityJSONStream  # noqa: E402
+
+from generate import generate_tile  # noqa: E402
+
+# Number of buildings of the tiles of each size
+SIZES = {"small": [200], "medium": [200, 2000], "large": [200, 2000, 10000]}
+
+
+def median_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        setup = function()
+        start = time.perf_counter()
+        setup()
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times), "repeat": repeat}
+
+
+def new_model():
+    return ifcopenshell.file(schema="IFC4")
+
+
+def read_features(path):
+    stream = CityJSONStream(path)
+    return stream, list(stream.features())
+
+
+def bench_vertices(features):
+    """Create the IfcCartesianPoints of all vertices of the tile."""
+    def setup():
+        model = new_model()
+        geometry = GeometryIO()
+        vertex_pool = features[0][1]
+        geometry.set_vertex_pool(vertex_pool)
+        return lambda: [geometry.get_vertex(model, index) for index in range(len(vertex_pool))]
+    return setup
+
+
+def bench_faces(features):
+    """Create the IfcFaces of the LoD 2.2 solids, with their points."""
+    def setup():
+        model = new_model()
+        geometry = GeometryIO()
+        geometry.set_vertex_pool(features[0][1])
+        faces = [
+            face
+            for cityobjects, _ in features
+            for obj in cityobjects.values()
+            for solid in obj.geometry
+            if solid.lod == "2.2"
+            for face in solid.boundaries[0]
+        ]
+        return lambda: [geometry.create_IFC_face(model, face) for face in faces]
+    return setup
+
+
+def bench_psets(features):
+    """Create the 3DBAG_attributes and Pset_BuildingCommon property sets of all buildings."""
+    def setup():
+        model = new_model()
+        writer = PropertySetWriter()
+        buildings = [
+            (model.create_entity("IfcBuilding", GlobalId=ifcopenshell.guid.new()), obj.attributes)
+            for cityobjects, _ in features
+            for obj in cityobjects.values()
+            if obj.attributes
+        ]
+
+        def run():
+            for building, attributes in buildings:
+                writer.create_attributes_property_set(model, building, attributes)
+                writer.create_building_common_property_set(model, building, attributes)
+        return run
+    return setup
+
+
+def bench_process(tile, workdir):
+    """Convert a tile to the zip with all LoDs, like batch_converter does for every file."""
+    def setup():
+        path = os.path.join(workdir, "tile.city.json")
+        shutil.copyfile(tile, path)
+        zip_file = os.path.join(workdir, "tile.ifc.zip")
+        if os.path.exists(zip_file):
+            os.remove(zip_file)
+        return lambda: process_cityjson_file(path, False)
+    return setup
+
+
+def run_benchmarks(sizes, repeat, workdir):
+    results = {}
+    for buildings in sizes:
+        tile = generate_tile(os.path.join(workdir, f"bench-{buildings}.city.json"), buildings)
+        stream, features = read_features(tile)
+        micro = {
+            "vertices": bench_vertices(features),
+            "faces": bench_faces(features),
+            "psets": bench_psets(features),
+        }
+        for name, benchmark in micro.items():
+            key = f"{name}[{buildings}]"
+            results[key] = median_time(benchmark, repeat)
+            click.echo(f"{key}: {results[key]['median']:.4f} s")
+
+        key = f"process_cityjson_file[{buildings}]"
+        with tempfile.TemporaryDirectory(dir=workdir) as process_dir:
+            # Keep the output of the converter out of the results
+            with open(os.devnull, "w") as devnull:
+                stdout = sys.stdout
+                sys.stdout = devnull
+                try:
+                    results[key] = median_time(bench_process(tile, process_dir), repeat)
+                finally:
+                    sys.stdout = stdout
+        click.echo(f"{key}: {results[key]['median']:.4f} s")
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every benchmark and return the benchmarks that are slower than allowed."""
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result["median"] / baseline[key]["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        click.echo(f"{key}: {baseline[key]['median']:.4f} s -> {result['median']:.4f} s ({ratio - 1:+.1%}){flag}")
+    return regressions
+
+
+@click.command()
+@click.option('--size', type=click.Choice(list(SIZES)), default="small", show_default=True,
+              help="Size of the tiles: small (200 buildings), medium (also 2000) or large (also 10000).")
+@click.option('--repeat', type=int, default=5, show_default=True, help="Number of runs of each benchmark.")
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help="Save the results as JSON, by default in benchmarks/results/<commit>.json.")
+@click.option('--compare', 'baseline_file', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Results of an earlier run to compare with.")
+@click.option('--threshold', type=float, default=0.1, show_default=True,
+              help="Fail when a benchmark is slower than in the compared results by more than this fraction.")
+def main(size, repeat, output, baseline_file, threshold):
+    """Run the benchmarks and compare them with an earlier run."""
+    warnings.simplefilter("ignore")
+    commit = get_commit()
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(SIZES[size], repeat, workdir)
+
+    if output is None:
+        output = os.path.join(ROOT, "benchmarks", "results", f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({
+            "commit": commit,
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "ifcopenshell": ifcopenshell.version,
+            "machine": platform.machine(),
+            "results": results,
+        }, file, indent=2)
+    click.echo(f"Saved the results in {output}.")
+
+    if baseline_file is not None:
+        with open(baseline_file) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, threshold)
+        if regressions:
+            raise click.ClickException(f"{len(regressions)} benchmarks regressed by more than {threshold:.0%}.")
+
+
+if __name__ == "__main__":
+    main()
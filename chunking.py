@@ -0,0 +1,179 @@
+"""
+Converts a large file in chunks of buildings in parallel processes and merges the chunks into one IFC file per LoD.
+
+Every chunk converts every n-th block of buildings of the file, with their parts, to a model per LoD. The models of the
+chunks are created in the same way, so the entities that are created before the first building, the
+project, site, owner history, contexts and placement, have the same ids in every chunk. The chunks are
+merged as STEP text: the entities of the first chunk are kept, the buildings of the other chunks are
+added with their ids moved past those of the first chunk and refer to the shared entities of the first
+chunk. The site of the merged model aggregates the buildings of all chunks.
+
+The chunks write their models to temporary files next to the output, which are merged and written one
+LoD at a time, so that the process that merges them does not hold the models of all LoDs of all chunks.
+"""
+import multiprocessing
+import os
+import pickle
+import re
+import tempfile
+
+from cityjson2ifc import Cityjson2ifc
+from metrics import get_max_rss, reset_peak_rss
+from reader import CityJSONStream
+from step import StepFile, shift_references
+
+# The last attribute of the IfcRelAggregates of the site, its RelatedObjects
+RELATED_OBJECTS = re.compile(r"\([^()]*\)\);$")
+ENTITY_ID = re.compile(r"^#(\d+)=", re.MULTILINE)
+
+
+def convert_chunk(path, properties, chunk, directory, ignore_duplicate_keys=False, json_backend="auto"):
+    """
+    Convert the buildings of a chunk (index, count) of the file to a model per LoD. The STEP text and the
+    glTF nodes of the models are written to files in ``directory``. Returns the files of the models with
+    what is needed to merge them, the errors of the LoDs that failed, the metrics, the hashes of the
+    buildings and the peak resident set size of the process during the chunk in bytes.
+    """
+    # A process of the pool can convert more than one chunk
+    reset_peak_rss()
+    converter = Cityjson2ifc()
+    converter.properties.update(properties, chunk=chunk, archive=None)
+    converter.city_model = CityJSONStream(path, ignore_duplicate_keys=ignore_duplicate_keys, json_backend=json_backend)
+    converter.update_metadata()
+    converter.create_lod_models()
+    lods = {}
+    for lod, target in converter.targets.items():
+        relation = next(
+            relation for relation in target.IFC_site.IsDecomposedBy if relation.id() > target.prefix_size
+        )
+        text = target.to_string()
+        file = os.path.join(directory, f"{chunk[0]}-{lod}.ifc")
+        with open(file, "w", encoding="utf-8") as output:
+            output.write(text)
+        gltf_file = None
+        if target.gltf is not None:
+            gltf_file = os.path.join(directory, f"{chunk[0]}-{lod}.gltf")
+            with open(gltf_file, "wb") as output:
+                pickle.dump(target.gltf.nodes, output, protocol=pickle.HIGHEST_PROTOCOL)
+        lods[lod] = {
+            "file": file,
+            "last_id": max(int(entity_id) for entity_id in ENTITY_ID.findall(text)),
+            "prefix_size": target.prefix_size,
+            "site_relation": relation.id(),
+            "children": [child.id() for child in relation.RelatedObjects],
+            "metrics": target.metrics.to_dict(),
+            "gltf": gltf_file,
+        }
+        del text
+    failed_lods = {lod: f"{type(error).__name__}: {error}" for lod, error in converter.failed_lods.items()}
+    return lods, failed_lods, converter.metrics.to_dict(), converter.feature_hashes, get_max_rss()
+
+
+def read_part(part):
+    """The StepFile of the model of a chunk, the file is removed once it is read."""
+    with open(part["file"], encoding="utf-8") as file:
+        step = StepFile(file.read())
+    os.remove(part["file"])
+    return step
+
+
+def merge_chunks(parts):
+    """
+    Merge the models of a LoD of all chunks, as returned by ``convert_chunk``, into STEP text. Returns the
+    text as a list of pieces, a piece per chunk, and the number of entities. The models of the chunks are
+    read one at a time.
+    """
+    base = parts[0]
+    prefix_size = base["prefix_size"]
+    if any(part["prefix_size"] != prefix_size for part in parts):
+        raise ValueError("The chunks were not created in the same way")
+    # The ids of every chunk are moved past those of the chunks before it
+    children = list(base["children"])
+    offsets = []
+    last_id = base["last_id"]
+    for part in parts[1:]:
+        offset = last_id - prefix_size
+        offsets.append(offset)
+        children.extend(child + offset for child in part["children"])
+        last_id = max(last_id, part["last_id"] + offset)
+
+    step = read_part(base)
+    step.lines[base["site_relation"]] = RELATED_OBJECTS.sub(
+        f"({','.join(f'#{child}' for child in children)}));", step.lines[base["site_relation"]]
+    )
+    pieces = [step.header, "".join(step.lines[entity_id] + "\n" for entity_id in sorted(step.lines))]
+    footer = step.footer
+    entities = len(step.lines)
+    del step
+    for part, offset in zip(parts[1:], offsets):
+        lines = read_part(part).lines
+        entity_ids = sorted(
+            entity_id for entity_id in lines if entity_id > prefix_size and entity_id != part["site_relation"]
+        )
+        pieces.append("".join(
+            shift_references(lines[entity_id], offset, prefix_size + 1) + "\n" for entity_id in entity_ids
+        ))
+        entities += len(entity_ids)
+        del lines
+    pieces.append(footer)
+    return pieces, entities
+
+
+def write_merged(target, parts):
+    with target.metrics.time("merge"):
+        pieces, entities = merge_chunks(parts)
+    target.metrics.count("entities", entities)
+    target.write_text(pieces)
+    del pieces
+    if target.properties["gltf"]:
+        # The nodes are named after GlobalIds, which do not change when the chunks are merged
+        target.reset_gltf()
+        for part in parts:
+            with open(part["gltf"], "rb") as file:
+                target.gltf.extend(pickle.load(file))
+            os.remove(part["gltf"])
+        target.write_gltf()
+
+
+def convert_in_chunks(converter, city_model, chunks, ignore_duplicate_keys=False):
+    """
+    Convert the LoDs of ``lods`` of the file of the CityJSONStream ``city_model`` like ``converter.convert``,
+    in ``chunks`` processes. The merged models are written to the file or archive of the converter.
+    Returns the largest peak resident set size of the chunk processes in bytes.
+    """
+    properties = dict(converter.properties, archive=None)
+    # Next to the output rather than in the temp directory, which can be in memory
+    output_directory = os.path.dirname(os.path.abspath(converter.properties["file_destination"]))
+    with tempfile.TemporaryDirectory(prefix=".chunks-", dir=output_directory) as directory:
+        with multiprocessing.Pool(chunks) as pool:
+            results = pool.starmap(
+                convert_chunk,
+                [
+                    (
+                        city_model.path, properties, (index, chunks), directory, ignore_duplicate_keys,
+                        city_model.json_backend,
+                    )
+                    for index in range(chunks)
+                ],
+            )
+
+        converter.city_model = city_model
+        converter.reset_targets()
+        for lods, failed_lods, metrics, feature_hashes, _ in results:
+            converter.metrics.add(metrics)
+            converter.feature_hashes.update(feature_hashes)
+            for lod, error in failed_lods.items():
+                converter.failed_lods.setdefault(lod, RuntimeError(error))
+        converter.metrics.count("chunks", chunks)
+        for lod in converter.properties["lods"]:
+            if lod in converter.failed_lods:
+                continue
+            target = converter.create_target(lod)
+            parts = [result[0][lod] for result in results]
+            for part in parts:
+                target.metrics.add(part["metrics"])
+            if converter.run_target(lod, write_merged, target, parts):
+                converter.output_files[lod] = (
+                    target.properties["file_destination"] + target.properties["file_extension"]
+                )
+    return max(result[4] for result in results)
@@ -21,9 +21,25 @@ import os
 import ifcopenshell
 import ifcopenshell.api
 import ifcopenshell.guid
+import ifcopenshell.util.element
 from datetime import datetime,timezone
 
-from geometry  import GeometryIO
+from geometry  import GeometryIO, StepGeometryIO, VertexPool, count_faces
+from gltf import GltfBuilder
+from interning import EntityCache
+from metrics import Metrics
+from pipeline import ArchiveWriter, write_member
+from property_sets import PropertySetWriter
+from step import StepFile
+from reader import CityJSONStream, get_feature_key, hash_feature, resolve_geometry, select_cityobjects, select_features
+from simplify import Simplifier
+
+# Version of the converter, change it when the IFC output changes so that converted tiles are converted again
+CONVERTER_VERSION = "0.2.1"
+
+
+# Number of consecutive buildings of a file that go to the same chunk, neighbours share vertices
+CHUNK_FEATURES = 100
 
 JSON_TO_IFC = {
     "Building": ["IfcBuilding"],
@@ -101,7 +117,22 @@ class Cityjson2ifc:
         self.city_model = None
         self.IFC_model = None
         self.properties = {}
-        self.geometry = GeometryIO()
+        self.cityobjects = {}
+        self.parent_ids = {}
+        self.targets = {}
+        self.failed_lods = {}
+        self.output_files = {}
+        self.feature_hashes = {}
+        self.metrics = Metrics()
+        self.lod_metrics = {}
+        self.prefix_size = None
+        # Identical entities are created once per IFC model, the cache is shared by geometry and properties
+        self.entities = EntityCache()
+        self.geometry = GeometryIO(entities=self.entities)
+        self.property_sets = PropertySetWriter(entities=self.entities)
+        # The GLB file of the model, with ``gltf``
+        self.gltf = None
+        self.gltf_groups = {}
         self.configuration()
 
     def configuration(
@@ -110,6 +141,15 @@ class Cityjson2ifc:
         name_attribute=None,
         split=True,
         lod=None,
+        lods=None,
+        tessellated=False,
+        archive=None,
+        hash_features=False,
+        object_ids=None,
+        chunk=None,
+        step_geometry=False,
+        gltf=False,
+        simplify=None,
         name_project=None,
         name_site=None,
         name_person_family=None,
@@ -119,6 +159,16 @@ class Cityjson2ifc:
         self.properties["name_attribute"] = name_attribute
         self.properties["split"] = split
         self.properties["lod"] = lod
+        self.properties["lods"] = lods
+        self.properties["tessellated"] = tessellated
+        self.properties["archive"] = archive
+        self.properties["hash_features"] = hash_features
+        self.properties["object_ids"] = set(object_ids) if object_ids is not None else None
+        self.properties["chunk"] = chunk
+        self.properties["step_geometry"] = step_geometry
+        self.properties["gltf"] = gltf
+        # Tolerance in metres of merging coplanar faces and dropping collinear vertices, None to keep the faces
+        self.properties["simplify"] = simplify
         self.properties["name_project"] = name_project
         self.properties["name_site"] = name_site
         self.properties["name_person_family"] = name_person_family
@@ -126,14 +176,14 @@ class Cityjson2ifc:
 
     def convert(self, city_model):
         self.city_model = city_model
-        self.create_new_file()
-        self.create_metadata()
-        self.geometry.set_scale(self.properties["local_scale"],self.properties["verticalT"])
-        # self.geometry.build_vertices(self.IFC_model,
-        #                             coords=city_model.j["vertices"],
-        #                             scale=self.properties["local_scale"])
-        # self.build_vertices()
-        self.create_IFC_classes()
+        self.update_metadata()
+        if self.properties["lods"]:
+            self.convert_lods()
+            return
+        if self.properties["gltf"] and self.properties["split"] and not self.properties["lod"]:
+            # The GLB file is built per IFC model, a model with all LoDs has no GLB file of every LoD
+            raise ValueError("A GLB file can only be written per LoD, use lod or lods with gltf")
+        self.create_model()
         if self.properties["lod"]:
             self.write_file()
         elif self.properties["split"]:
@@ -141,6 +191,173 @@ class Cityjson2ifc:
         else:
             self.write_file()
 
+    def create_model(self):
+        """Convert the city model to ``IFC_model`` in memory, without writing it."""
+        self.create_new_file()
+        self.create_metadata()
+        self.geometry.set_scale(self.properties["local_scale"],self.properties["verticalT"])
+        self.geometry.set_tessellated(self.properties["tessellated"])
+        if self.properties["lod"] or not self.properties["split"]:
+            self.reset_gltf()
+        self.create_IFC_classes()
+
+    def convert_lods(self):
+        """Convert every LoD of ``lods`` in a single pass over the CityObjects.
+
+        Each LoD is written by its own target converter with its own IFC model. The CityObjects
+        are walked once, the LoD independent work is done once per object and every geometry
+        is sent to the target of its LoD. A LoD that fails is recorded in ``failed_lods`` and
+        does not stop the other LoDs.
+        """
+        self.create_lod_models()
+        self.write_targets()
+
+    def create_lod_models(self):
+        """Create the IFC model of every LoD of ``lods`` in its target, without writing them."""
+        self.reset_targets()
+        for lod in self.properties["lods"]:
+            target = self.create_target(lod)
+            self.run_target(lod, self.prepare_target, target)
+
+        for cityobjects, vertex_pool in self.metrics.iterate("parse", self.iter_features()):
+            self.convert_feature(cityobjects, vertex_pool)
+
+        for lod, target in list(self.targets.items()):
+            self.run_target(lod, target.finish_IFC_classes)
+
+    def patch_lods(self, city_model, IFC_models, features, object_ids):
+        """Replace CityObjects in the IFC models of an earlier ``convert_lods``, instead of converting the whole file.
+
+        The IFC objects of the CityObjects ``object_ids`` are removed from every model of ``IFC_models``,
+        with their semantic surfaces, geometry and property sets. Then the CityObjects of ``features``,
+        a list of (cityobjects, vertex_pool), are converted into the models. The rest of the models is
+        kept as it is.
+        """
+        self.city_model = city_model
+        self.reset_targets()
+        for lod, IFC_model in IFC_models.items():
+            target = self.create_target(lod)
+            self.run_target(lod, self.attach_target, target, IFC_model, object_ids)
+
+        for cityobjects, vertex_pool in features:
+            self.convert_feature(cityobjects, vertex_pool)
+
+        for lod, target in list(self.targets.items()):
+            self.run_target(lod, target.finish_attached_IFC_classes)
+        self.write_targets()
+
+    def reset_targets(self):
+        self.targets = {}
+        self.failed_lods = {}
+        self.output_files = {}
+        self.lod_metrics = {}
+
+    def create_target(self, lod):
+        target = Cityjson2ifc()
+        target.properties = dict(self.properties)
+        target.properties["lod"] = lod
+        target.properties["lods"] = None
+        target.properties["file_destination"] = f"{self.properties['file_destination']}-{lod}"
+        target.city_model = self.city_model
+        # The value types of the attributes are worked out once for all LoDs
+        target.property_sets = PropertySetWriter(self.property_sets.value_types, target.entities)
+        self.targets[lod] = target
+        self.lod_metrics[lod] = target.metrics
+        return target
+
+    def convert_feature(self, cityobjects, vertex_pool):
+        """Send the geometries of the CityObjects of a feature to the target of their LoD."""
+        self.cityobjects = cityobjects
+        self.parent_ids = {}
+        for target in self.targets.values():
+            target.geometry.set_vertex_pool(vertex_pool)
+        for obj_id, obj in cityobjects.items():
+            resolved = self.resolve_IFC_object(obj_id, obj)
+            if resolved is None:
+                continue
+            geometries = {}
+            for geometry in obj.geometry:
+                geometries.setdefault(geometry.lod, []).append(geometry)
+            for lod, target in list(self.targets.items()):
+                if lod in geometries:
+                    with target.metrics.time("create_IFC_classes"):
+                        self.run_target(lod, target.create_IFC_object, obj_id, obj, geometries[lod], *resolved)
+
+    def write_targets(self):
+        for lod, target in list(self.targets.items()):
+            if self.run_target(lod, target.write_file):
+                self.output_files[lod] = target.properties["file_destination"] + target.properties["file_extension"]
+
+    def attach_target(self, target, IFC_model, object_ids):
+        target.attach_IFC_model(IFC_model)
+        target.remove_IFC_objects(object_ids)
+        # The buildings that are added share the entities that are left, as in a full conversion
+        target.geometry.add_existing_entities(IFC_model)
+        target.property_sets.add_existing_properties(IFC_model)
+
+    def prepare_target(self, target):
+        target.create_new_file()
+        target.create_metadata()
+        target.geometry.set_scale(target.properties["local_scale"], target.properties["verticalT"])
+        target.geometry.set_tessellated(target.properties["tessellated"])
+        target.reset_gltf()
+        target.prepare_IFC_classes()
+        # The entities up to here are the same in every model of the file, see chunking.merge_chunks
+        target.prefix_size = max(entity.id() for entity in target.IFC_model)
+
+    def run_target(self, lod, method, *args):
+        try:
+            method(*args)
+        except Exception as ex:
+            self.failed_lods[lod] = ex
+            del self.targets[lod]
+            return False
+        return True
+
+    def iter_features(self):
+        """Yield the CityObjects with the VertexPool of their coordinates, one feature at a time.
+
+        A CityJSONStream yields every building with its parts separately, a cjio city model is
+        a single feature. The coordinates are transformed once and shared by all LoDs. With
+        ``object_ids`` only those CityObjects and their parents and children are yielded. With
+        ``chunk`` (index, count) only every count-th block of CHUNK_FEATURES buildings is yielded,
+        from the index-th on, the buildings of the other chunks are not built.
+        """
+        chunk = self.properties["chunk"]
+        select = None
+        if chunk is not None:
+            def select(index):
+                return index // CHUNK_FEATURES % chunk[1] == chunk[0]
+        if isinstance(self.city_model, CityJSONStream):
+            features = self.city_model.features(select)
+        else:
+            transform = self.city_model.transform
+            vertex_pool = VertexPool(self.city_model.j["vertices"], transform["scale"], transform["translate"][2])
+            features = select_features([(self.city_model.get_cityobjects(), vertex_pool)], select)
+        previous_pool = None
+        for cityobjects, vertex_pool in features:
+            if self.properties["object_ids"] is not None:
+                # Only the selected CityObjects are converted, with their parents and children
+                cityobjects = select_cityobjects(cityobjects, self.properties["object_ids"])
+                if not cityobjects:
+                    continue
+            self.metrics.count("cityobjects", len(cityobjects))
+            if vertex_pool is not previous_pool:
+                self.metrics.count("vertices", len(vertex_pool))
+                previous_pool = vertex_pool
+            self.cityobjects = cityobjects
+            self.parent_ids = {}
+            if self.properties["hash_features"]:
+                # Used to find the buildings that changed in a next version of the file, see patch_lods
+                self.feature_hashes[get_feature_key(cityobjects)] = (
+                    hash_feature(cityobjects, vertex_pool), list(cityobjects)
+                )
+            yield cityobjects, vertex_pool
+
+    def update_metadata(self):
+        if not self.city_model.has_metadata() or "presentLoDs" not in self.city_model.j["metadata"]:
+            self.city_model.update_metadata()
+
     def create_metadata(self):
         # Georeferencing
         self.properties["local_translation"] = {}
@@ -166,6 +383,8 @@ class Cityjson2ifc:
 
     def create_new_file(self):
         self.IFC_model = self.create_file()
+        self.entities.clear()
+        self.reset_geometry()
         self.IFC_project = ifcopenshell.api.run(
             "root.create_entity",
             self.IFC_model,
@@ -177,9 +396,6 @@ class Cityjson2ifc:
             "context.add_context", self.IFC_model, **{"context_type": "Model"}
         )
 
-        if not self.city_model.has_metadata() or "presentLoDs" not in self.city_model.j["metadata"]:
-            self.city_model.update_metadata()
-
         # create IFC representation subcontexts from lods
         self.create_representation_sub_contexts()
 
@@ -199,6 +415,10 @@ class Cityjson2ifc:
 
     def create_representation_sub_contexts(self):
         self.IFC_representation_sub_contexts = {}
+        if self.properties["lod"] is not None:
+            self.IFC_representation_sub_contexts[self.properties["lod"]] = self.create_representation_sub_context(
+                self.properties["lod"]
+            )
         # for lod in self.city_model.j["metadata"]["presentLoDs"]:
         #     self.IFC_representation_sub_contexts[str(lod)] = self.create_representation_sub_context(lod)
 
@@ -237,7 +457,7 @@ class Cityjson2ifc:
             "IfcOpenShell, an open source (LGPL) software library that helps users and software developers to work with the IFC file format.",
         )
         p_o = self.IFC_model.createIfcPersonAndOrganization(person, organization)
-        application = self.IFC_model.createIfcApplication(organization, "0.1.0", "ifccityjson", "ifccityjson")
+        application = self.IFC_model.createIfcApplication(organization, CONVERTER_VERSION, "ifccityjson", "ifccityjson")
         timestamp = int(datetime.now().timestamp())
         ownerHistory = self.IFC_model.createIfcOwnerHistory(
             p_o, application, "READWRITE", None, None, None, None, timestamp
@@ -245,38 +465,159 @@ class Cityjson2ifc:
 
         return ownerHistory
 
+    def reset_geometry(self):
+        """Start the geometry of a new IFC model, written as STEP text with ``step_geometry``."""
+        geometry_class = StepGeometryIO if self.properties.get("step_geometry") else GeometryIO
+        self.geometry = geometry_class(entities=self.entities)
+
+    def reset_gltf(self):
+        """Start the GLB file of a new IFC model with ``gltf``, its coordinates are those of the IFC model."""
+        if not self.properties["gltf"]:
+            self.gltf = None
+            return
+        translate = self.city_model.transform["translate"]
+        extras = {"translation": [translate[0], translate[1], 0]}
+        epsg = self.city_model.get_epsg()
+        if epsg:
+            extras["crs"] = f"EPSG:{epsg}"
+        if self.properties["lod"]:
+            extras["lod"] = self.properties["lod"]
+        self.gltf = GltfBuilder(os.path.basename(self.properties["file_destination"]), extras)
+
+    def add_gltf_faces(self, surface_type, IFC_class, faces, global_id):
+        """
+        Add the faces of an IFC object to the primitive of its semantic surface type, or of its IFC class when
+        it has none, in the node of the current CityObject.
+        """
+        if not faces:
+            return
+        group = self.gltf_groups.setdefault((surface_type, IFC_class), ([], []))
+        group[0].extend(faces)
+        group[1].append(global_id)
+
+    def write_gltf(self):
+        """Write the GLB file of the model next to its IFC file, or into the archive."""
+        file = self.properties["file_destination"] + ".glb"
+        with self.metrics.time("gltf"):
+            data = self.gltf.to_bytes()
+        self.metrics.count("triangles", self.gltf.triangles)
+        if self.properties["archive"] is not None:
+            self.write_to_archive(os.path.basename(file), data)
+        else:
+            with self.metrics.time("write"):
+                with open(file, "wb") as output:
+                    output.write(data)
+            self.metrics.count("output_bytes", len(data))
+
+    def to_string(self):
+        """The STEP text of ``IFC_model`` with its geometry."""
+        return self.geometry.stitch(self.IFC_model.to_string())
+
     def write_file(self):
         file = self.properties["file_destination"] + self.properties["file_extension"]
-        self.IFC_model.write(file)
+        self.metrics.count("entities", len(self.IFC_model.entity_names()) + self.geometry.written_entities)
+        if self.properties["archive"] is not None:
+            # The model is serialized in memory and compressed into the archive, nothing is written uncompressed to disk
+            with self.metrics.time("write"):
+                data = self.to_string()
+            self.write_to_archive(os.path.basename(file), data)
+        elif self.properties["step_geometry"]:
+            with self.metrics.time("write"):
+                data = self.to_string()
+            self.write_text(data)
+        else:
+            with self.metrics.time("write"):
+                self.IFC_model.write(file)
+            self.metrics.count("output_bytes", os.path.getsize(file))
+        if self.gltf is not None:
+            self.write_gltf()
+
+    def write_text(self, data, file=None):
+        """
+        Write the STEP text of a model instead of ``IFC_model``, to the file or the archive. The text can be
+        a list of pieces, eg. of a merged model, which are written one after the other. The file is that of
+        the model unless ``file`` is given.
+        """
+        if file is None:
+            file = self.properties["file_destination"] + self.properties["file_extension"]
+        if self.properties["archive"] is not None:
+            self.write_to_archive(os.path.basename(file), data)
+        else:
+            with self.metrics.time("write"):
+                with open(file, "w", encoding="utf-8") as output:
+                    output.writelines([data] if isinstance(data, str) else data)
+            self.metrics.count("output_bytes", os.path.getsize(file))
+
+    def write_to_archive(self, name, data):
+        archive = self.properties["archive"]
+        if isinstance(archive, ArchiveWriter):
+            # Compressed in the thread of the writer while the next model is serialized
+            archive.write(name, data, self.metrics)
+        else:
+            write_member(archive, name, data, self.metrics)
+
+    def get_metrics(self):
+        """Return the metrics of the conversion, with the metrics of each LoD when ``lods`` are converted."""
+        record = self.metrics.to_dict()
+        if self.lod_metrics:
+            record["lods"] = {lod: metrics.to_dict() for lod, metrics in self.lod_metrics.items()}
+            for metrics in self.lod_metrics.values():
+                for name in ["write", "zip"]:
+                    if name in metrics.timings:
+                        record["timings"][name] = round(record["timings"].get(name, 0) + metrics.timings[name], 6)
+        return record
 
     def write_files(self):
+        """Write a file per LoD with the representations of its sub-context only.
+
+        The model is serialized once and split as STEP text: every file gets the entities that are
+        not part of any representation, eg. the products and property sets, and the representations
+        of its own sub-context with their geometry. The lists of representations of the products
+        are emptied of the representations of the other LoDs.
+        """
+        with self.metrics.time("write"):
+            step = StepFile(self.to_string())
+        representations = {}
+        for representation in self.IFC_model.by_type("IfcShapeRepresentation"):
+            representations.setdefault(representation.ContextOfItems.id(), set()).add(representation.id())
+        all_representations = set().union(*representations.values())
+        sub_context_ids = {sub_context.id() for sub_context in self.IFC_representation_sub_contexts.values()}
+        shared = step.get_closure(step.get_roots() - sub_context_ids, stop=all_representations)
+        product_shapes = [shape.id() for shape in self.IFC_model.by_type("IfcProductDefinitionShape")]
+        self.output_files = {}
+
         for lod, IFC_representation_sub_context in self.IFC_representation_sub_contexts.items():
             sub_context_id = IFC_representation_sub_context.id()
-
-            # TODO this method makes a copy of the IFC_model by writing it and importing it,
-            # TODO but maybe there is a better method.
+            own_representations = representations.get(sub_context_id, set())
+            entity_ids = shared | step.get_closure(own_representations | {sub_context_id})
+            other_representations = all_representations - own_representations
+            lines = {shape: step.remove_references(shape, other_representations) for shape in product_shapes}
             file = self.properties["file_destination"] + lod + self.properties["file_extension"]
-            self.IFC_model.write(file)
-            IFC_copied_model = ifcopenshell.open(file)
-            IFC_copied_model_sub_contexts = IFC_copied_model.by_type("IfcGeometricRepresentationSubContext")
-            for sub_context in IFC_copied_model_sub_contexts:
-                if sub_context.id() == sub_context_id:
-                    continue
-
-                representations_in_context = sub_context.RepresentationsInContext
-                for element in representations_in_context:
-                    IFC_copied_model.remove(element)
-                    # slow:
-                    # ifcopenshell.api.run("geometry.remove_representation", IFC_copied_model, representation=element)
-
-                ifcopenshell.api.run("context.remove_context", IFC_copied_model, context=sub_context)
-
-            IFC_copied_model.write(file)
-            del IFC_copied_model
+            self.metrics.count("entities", len(entity_ids))
+            with self.metrics.time("write"):
+                data = step.to_string(entity_ids, lines)
+            self.write_text(data, file)
+            self.output_files[lod] = file
 
     def create_IFC_classes(self):
-        parents_children_relations = {"IfcSite": {"Parent": self.IFC_site, "Children": []}}
-        geometries = {}
+        self.prepare_IFC_classes()
+        for cityobjects, vertex_pool in self.metrics.iterate("parse", self.iter_features()):
+            self.geometry.set_vertex_pool(vertex_pool)
+            for obj_id, obj in cityobjects.items():
+                resolved = self.resolve_IFC_object(obj_id, obj)
+                if resolved is None:
+                    continue
+                geometries = [
+                    geometry
+                    for geometry in obj.geometry
+                    if self.properties["lod"] is None or geometry.lod == self.properties["lod"]
+                ]
+                with self.metrics.time("create_IFC_classes"):
+                    self.create_IFC_object(obj_id, obj, geometries, *resolved)
+        self.finish_IFC_classes()
+
+    def prepare_IFC_classes(self):
+        self.parents_children_relations = {"IfcSite": {"Parent": self.IFC_site, "Children": []}}
         existing_placements = self.IFC_model.by_type("IfcAxis2Placement3D")
         target_placement = None
         for placement in existing_placements:
@@ -286,106 +627,74 @@ class Cityjson2ifc:
         if not target_placement:
             placement_origin = self.IFC_model.create_entity("IfcCartesianPoint", [0.0, 0.0, 0.0])  # Example origin
             target_placement = self.IFC_model.create_entity("IfcAxis2Placement3D", Location=placement_origin)
-        local_placement = self.IFC_model.create_entity("IfcLocalPlacement", PlacementRelTo=None, RelativePlacement=target_placement)
-
-        for obj_id, obj in self.city_model.get_cityobjects().items():
-            # CityJSON type to class
-            try:
-                mapping = JSON_TO_IFC[obj.type]
-            except KeyError:
-                # skip CityObject types that are not supported, eg. from extensions
-                continue
-            IFC_class = mapping[0]
-            data = {}
-            # Add attributes if it is specified in mapping
-            # Example: BuildingPart to IfcBuilding with CompositionType: Partial
-            if len(mapping) > 1:
-                data.update(mapping[1])
-
-            # attributes
-            IFC_name = obj_id
-            if "name_attribute" in self.properties and self.properties["name_attribute"] in obj.attributes:
-                IFC_name = obj.attributes[self.properties["name_attribute"]]
-
-            if len(obj.geometry) == 0:
-                print(f"Warning: Object {obj_id} has no geometry.")
-
-            IFC_semantic_surface_children = []
-            IFC_shape_representations = []
-            for geometry in obj.geometry:
-                lod = geometry.lod
-                if self.properties["lod"] is not None and lod != self.properties["lod"]:
-                    continue
-                if lod not in self.IFC_representation_sub_contexts:
-                    self.IFC_representation_sub_contexts[lod] = self.create_representation_sub_context(lod)
-                IFC_geometry, shape_representation_type = None, None
-
-                if geometry and geometry.surfaces:
-                    IFC_semantic_surface_children.extend(self.create_IFC_semantic_surface_children(geometry, lod, local_placement))
-                elif geometry:
-                    IFC_geometry, shape_representation_type = self.geometry.create_IFC_geometry(
-                        self.IFC_model, geometry
-                    )
-                if IFC_geometry:
-                    IFC_shape_representation = self.create_IFC_shape_representation(
-                        IFC_geometry, shape_representation_type, lod
-                    )
-                    IFC_shape_representations.append(IFC_shape_representation)
-
-                if len(IFC_shape_representations) > 0:
-                    IFC_child_class = "IfcBuildingElementProxy"
-                    child_data = {"GlobalId": ifcopenshell.guid.new(), "Name": IFC_child_class}
-                    child_data["Representation"] = self.IFC_model.create_entity("IfcProductDefinitionShape", Representations=IFC_shape_representations)
-                    child_data["ObjectPlacement"] = local_placement
-                    IFC_semantic_surface_children.append(self.IFC_model.create_entity(IFC_child_class, **child_data))
-                data["GlobalId"] = ifcopenshell.guid.new()
-                data["Name"] = IFC_name
-
-                IFC_object = self.IFC_model.create_entity(IFC_class, **data)
-
-                # Define aggregation
-                parents_children_relations["IfcSite"]["Children"].append(IFC_object)
-
-                for parent in obj.parents:
-                    if parent not in parents_children_relations:
-                        parents_children_relations[parent] = {"Parent": None, "Children": [], "ChildrenID": []}
-                    parents_children_relations[parent]["Children"].append(IFC_object)
-                    parents_children_relations[parent]["ChildrenID"].append(obj.id)
-                    if obj_id not in parents_children_relations:
-                        parents_children_relations[obj_id] = {"ParentID": parent}
-
-
-                if len(obj.children) > 0:
-                    if obj_id not in parents_children_relations:
-                        parents_children_relations[obj_id] = {"Parent": None, "Children": [], "ChildrenID": []}
-                    for child in obj.children:
-                        if child not in parents_children_relations:
-                            parents_children_relations[child] = {"ParentID": None}
-                        parents_children_relations[child]["ParentID"] = obj_id
-                    parents_children_relations[obj_id]["Parent"] = IFC_object
-
-
-                if "ParentID" not in parents_children_relations[obj_id]:
-                    self.create_property_set(obj.attributes, IFC_object)
+        self.local_placement = self.IFC_model.create_entity("IfcLocalPlacement", PlacementRelTo=None, RelativePlacement=target_placement)
+
+    def attach_IFC_model(self, IFC_model):
+        """Continue an IFC model that was written by an earlier conversion, eg. to replace some of its objects."""
+        self.IFC_model = IFC_model
+        self.entities.clear()
+        self.reset_geometry()
+        # Only the new objects would be in a GLB file, see batch_converter
+        self.gltf = None
+        self.IFC_project = IFC_model.by_type("IfcProject")[0]
+        self.IFC_site = IFC_model.by_type("IfcSite")[0]
+        owner_histories = IFC_model.by_type("IfcOwnerHistory")
+        self.properties["owner_history"] = min(owner_histories, key=lambda entity: entity.id()) if owner_histories else None
+        self.IFC_representation_context = None
+        self.IFC_representation_sub_contexts = {}
+        for context in IFC_model.by_type("IfcGeometricRepresentationContext"):
+            if context.is_a("IfcGeometricRepresentationSubContext"):
+                self.IFC_representation_sub_contexts[context.UserDefinedTargetView[len("LOD"):]] = context
+            else:
+                self.IFC_representation_context = context
+        transform = self.city_model.transform
+        self.geometry.set_scale(transform["scale"], transform["translate"][2])
+        self.geometry.set_tessellated(self.properties["tessellated"])
+        self.parents_children_relations = {"IfcSite": {"Parent": self.IFC_site, "Children": []}}
+        # The objects of a conversion share a single placement
+        placements = IFC_model.by_type("IfcLocalPlacement")
+        if placements:
+            self.local_placement = placements[0]
+        else:
+            self.prepare_IFC_classes()
+
+    def remove_IFC_objects(self, object_ids):
+        """Remove the IFC objects of CityObjects with their semantic surfaces, geometry and property sets."""
+        object_ids = set(object_ids)
+        protected = set(self.IFC_model.by_type("IfcGeometricRepresentationContext"))
+        protected.update(self.IFC_model.by_type("IfcOwnerHistory"))
+        protected.update([self.IFC_project, self.IFC_site, self.local_placement])
+        IFC_objects = [
+            IFC_object
+            for IFC_class in {mapping[0] for mapping in JSON_TO_IFC.values()}
+            for IFC_object in self.IFC_model.by_type(IFC_class, include_subtypes=False)
+            if IFC_object.Name in object_ids
+        ]
+        for IFC_object in IFC_objects:
+            for relation in IFC_object.Decomposes:
+                related_objects = [related for related in relation.RelatedObjects if related != IFC_object]
+                if related_objects:
+                    relation.RelatedObjects = related_objects
                 else:
-                    objParentId = parents_children_relations[obj_id]["ParentID"]
-                    attributes = self.city_model.cityobjects[objParentId].attributes
-                    self.create_property_set(attributes, IFC_object)
-
-                
-            if IFC_semantic_surface_children:
-                self.IFC_model.create_entity(
-                    "IfcRelContainedInSpatialStructure",
-                    **{
-                        "GlobalId": ifcopenshell.guid.new(),
-                        "RelatedElements": IFC_semantic_surface_children,
-                        "RelatingStructure": IFC_object,
-                    },
-                )
-
-
+                    self.IFC_model.remove(relation)
+            # The relations go first, remove_deep2 only removes entities that nothing else refers to
+            for relation in list(IFC_object.IsDefinedBy) + list(getattr(IFC_object, "ContainsElements", ())):
+                ifcopenshell.util.element.remove_deep2(self.IFC_model, relation, do_not_delete=protected | {IFC_object})
+            ifcopenshell.util.element.remove_deep2(self.IFC_model, IFC_object, do_not_delete=protected)
+        return len(IFC_objects)
+
+    def finish_attached_IFC_classes(self):
+        """Add the new objects to the IfcSite of a model that was continued with ``attach_IFC_model``."""
+        children = self.parents_children_relations["IfcSite"]["Children"]
+        if not children:
+            return
+        for relation in self.IFC_site.IsDecomposedBy:
+            relation.RelatedObjects = list(relation.RelatedObjects) + children
+            return
+        self.finish_IFC_classes()
 
-        for parent, parent_children in parents_children_relations.items():
+    def finish_IFC_classes(self):
+        for parent, parent_children in self.parents_children_relations.items():
             if parent == 'IfcSite':
                 self.IFC_model.create_entity(
                     "IfcRelAggregates",
@@ -396,21 +705,169 @@ class Cityjson2ifc:
                     },
                 )
 
-    def create_IFC_semantic_surface_children(self, geometry, lod, local_placement):
+    def resolve_IFC_object(self, obj_id, obj):
+        """Work out the LoD independent part of a CityObject: IFC class, attributes and name.
+
+        Returns None for CityObject types that are not supported.
+        """
+        # Children take the attributes of their parent, eg. a BuildingPart of a Building
+        for child in obj.children:
+            self.parent_ids[child] = obj_id
+        for parent in obj.parents:
+            self.parent_ids[obj_id] = parent
+
+        # CityJSON type to class
+        try:
+            mapping = JSON_TO_IFC[obj.type]
+        except KeyError:
+            # skip CityObject types that are not supported, eg. from extensions
+            return None
+        IFC_class = mapping[0]
+        data = {}
+        # Add attributes if it is specified in mapping
+        # Example: BuildingPart to IfcBuilding with CompositionType: Partial
+        if len(mapping) > 1:
+            data.update(mapping[1])
+
+        # attributes
+        IFC_name = obj_id
+        if "name_attribute" in self.properties and self.properties["name_attribute"] in obj.attributes:
+            IFC_name = obj.attributes[self.properties["name_attribute"]]
+
+        if len(obj.geometry) == 0:
+            print(f"Warning: Object {obj_id} has no geometry.")
+
+        if self.parent_ids.get(obj_id) in self.cityobjects:
+            attributes = self.cityobjects[self.parent_ids[obj_id]].attributes
+        else:
+            attributes = obj.attributes
+
+        return IFC_class, data, IFC_name, attributes
+
+    def create_IFC_object(self, obj_id, obj, geometries, IFC_class, data, IFC_name, attributes):
+        parents_children_relations = self.parents_children_relations
+        data = dict(data)
+        IFC_object = None
         IFC_semantic_surface_children = []
-        for surface_id in geometry.surfaces:
-            IFC_child_class = JSON_TO_IFC[geometry.surfaces[surface_id]["type"]][0]
+        IFC_shape_representations = []
+        self.gltf_groups = {}
+        gltf_faces = []
+        self.metrics.count("converted_cityobjects")
+        # The surfaces and solids of the LoD are flattened now, those of the other LoDs are left as they are
+        geometries = [resolve_geometry(geometry) for geometry in geometries]
+        if self.properties["simplify"] is not None:
+            geometries = self.simplify_geometries(geometries)
+        for geometry in geometries:
+            self.metrics.count("geometries")
+            self.metrics.count("faces", count_faces(geometry))
+            lod = geometry.lod
+            if lod not in self.IFC_representation_sub_contexts:
+                self.IFC_representation_sub_contexts[lod] = self.create_representation_sub_context(lod)
+            IFC_geometry, shape_representation_type = None, None
+
+            surface_types = self.geometry.get_surface_types(geometry) if geometry else None
+            if surface_types:
+                IFC_semantic_surface_children.extend(
+                    self.create_IFC_semantic_surface_children(geometry, surface_types, lod, self.local_placement)
+                )
+            elif geometry:
+                IFC_geometry, shape_representation_type = self.geometry.create_IFC_geometry(
+                    self.IFC_model, geometry
+                )
+                if IFC_geometry and self.gltf is not None:
+                    gltf_faces.extend(self.geometry.get_faces(geometry))
+            if IFC_geometry:
+                IFC_shape_representation = self.create_IFC_shape_representation(
+                    IFC_geometry, shape_representation_type, lod
+                )
+                IFC_shape_representations.append(IFC_shape_representation)
+
+            if len(IFC_shape_representations) > 0:
+                IFC_child_class = "IfcBuildingElementProxy"
+                child_data = {"GlobalId": ifcopenshell.guid.new(), "Name": IFC_child_class}
+                child_data["Representation"] = self.IFC_model.create_entity("IfcProductDefinitionShape", Representations=IFC_shape_representations)
+                child_data["ObjectPlacement"] = self.local_placement
+                IFC_semantic_surface_children.append(self.IFC_model.create_entity(IFC_child_class, **child_data))
+                if self.gltf is not None:
+                    self.add_gltf_faces(None, IFC_child_class, gltf_faces, child_data["GlobalId"])
+                    gltf_faces = []
+            data["GlobalId"] = ifcopenshell.guid.new()
+            data["Name"] = IFC_name
+
+            IFC_object = self.IFC_model.create_entity(IFC_class, **data)
+
+            # Define aggregation
+            parents_children_relations["IfcSite"]["Children"].append(IFC_object)
+
+            for parent in obj.parents:
+                if parent not in parents_children_relations:
+                    parents_children_relations[parent] = {"Parent": None, "Children": [], "ChildrenID": []}
+                parents_children_relations[parent]["Children"].append(IFC_object)
+                parents_children_relations[parent]["ChildrenID"].append(obj.id)
+
+            if len(obj.children) > 0:
+                if obj_id not in parents_children_relations:
+                    parents_children_relations[obj_id] = {"Parent": None, "Children": [], "ChildrenID": []}
+                parents_children_relations[obj_id]["Parent"] = IFC_object
+
+            self.create_property_set(attributes, IFC_object)
+
+        if IFC_semantic_surface_children:
+            self.IFC_model.create_entity(
+                "IfcRelContainedInSpatialStructure",
+                **{
+                    "GlobalId": ifcopenshell.guid.new(),
+                    "RelatedElements": IFC_semantic_surface_children,
+                    "RelatingStructure": IFC_object,
+                },
+            )
+        if self.gltf is not None and IFC_object is not None and self.gltf_groups:
+            # The node of the CityObject is named after the IFC object that contains its surfaces
+            groups = [
+                (surface_type, IFC_class, faces, global_ids)
+                for (surface_type, IFC_class), (faces, global_ids) in self.gltf_groups.items()
+            ]
+            with self.metrics.time("gltf"):
+                self.gltf.add_node(IFC_object.GlobalId, {"cityObject": obj_id}, groups, self.geometry.vertex_pool.coordinates)
+
+    def simplify_geometries(self, geometries):
+        """The geometries with their coplanar faces merged and their collinear vertices dropped."""
+        simplifier = Simplifier(self.properties["simplify"])
+        simplified = []
+        with self.metrics.time("simplify"):
+            for geometry in geometries:
+                geometry, removed_faces, removed_vertices = simplifier.simplify(
+                    geometry, self.geometry.vertex_pool.coordinates
+                )
+                self.metrics.count("simplified_faces", removed_faces)
+                self.metrics.count("simplified_vertices", removed_vertices)
+                simplified.append(geometry)
+        return simplified
+
+    def create_IFC_semantic_surface_children(self, geometry, surface_types, lod, local_placement):
+        IFC_semantic_surface_children = []
+        for surface_id, surface_type in surface_types:
+            IFC_child_class = JSON_TO_IFC[surface_type][0]
             child_data = {"GlobalId": ifcopenshell.guid.new(), "Name": IFC_child_class}
 
             # CREATE ENTITY
             surface_geometry = self.geometry.create_IFC_surface(self.IFC_model, geometry, surface_id)
             if surface_geometry:
-                IFC_shape_representation = self.create_IFC_shape_representation(surface_geometry, "SurfaceModel", lod)
+                IFC_shape_representation = self.create_IFC_shape_representation(
+                    surface_geometry, self.geometry.surface_representation_type, lod
+                )
 
                 child_data["Representation"] = self.IFC_model.create_entity(
                     "IfcProductDefinitionShape", Representations=[IFC_shape_representation]
                 )
                 child_data["ObjectPlacement"] = local_placement
+                if self.gltf is not None:
+                    self.add_gltf_faces(
+                        surface_type,
+                        IFC_child_class,
+                        self.geometry.get_surface_faces(geometry, surface_id),
+                        child_data["GlobalId"],
+                    )
             IFC_semantic_surface_children.append(self.IFC_model.create_entity(IFC_child_class, **child_data))
 
         return IFC_semantic_surface_children
@@ -428,30 +885,25 @@ class Cityjson2ifc:
         )
         return shape_representation
 
+    def get_entity_stats(self):
+        """Return the number of created and reused entities per IFC class, summed over the LoD targets."""
+        caches = [target.entities for target in self.targets.values()] or [self.entities]
+        stats = {}
+        for cache in caches:
+            for IFC_class, counts in cache.get_stats().items():
+                total = stats.setdefault(IFC_class, {"created": 0, "reused": 0})
+                total["created"] += counts["created"]
+                total["reused"] += counts["reused"]
+        return stats
+
     def create_property_set(self, CJ_attributes, IFC_entity):
         if len(CJ_attributes) == 0:
             return
 
-        pset = ifcopenshell.api.run("pset.add_pset", self.IFC_model, product=IFC_entity, name="3DBAG_attributes")
-        ifcopenshell.api.run("pset.edit_pset", self.IFC_model, pset=pset, properties=CJ_attributes)
-        psetPand = ifcopenshell.api.run("pset.add_pset", self.IFC_model, product=IFC_entity, name="Pset_BuildingCommon")
-        if "identificatie" in CJ_attributes:
-            value = CJ_attributes["identificatie"]
-            value = value[len("NL.IMBAG.Pand."):]
-            properties_to_add = {"BuildingID": value}
-
-        if "oorspronkelijkbouwjaar" in CJ_attributes:
-            properties_to_add["NumberOfStories"] = CJ_attributes["b3_bouwlagen"]
-        
-        if "b3_bouwlagen" in CJ_attributes:
-            properties_to_add["YearOfConstruction"] = CJ_attributes["oorspronkelijkbouwjaar"]
-
-        ifcopenshell.api.run(
-            "pset.edit_pset",
-            self.IFC_model,
-            pset=psetPand,
-            properties=properties_to_add
-        )
+        owner_history = self.properties["owner_history"]
+        with self.metrics.time("psets"):
+            self.property_sets.create_attributes_property_set(self.IFC_model, IFC_entity, CJ_attributes, owner_history)
+            self.property_sets.create_building_common_property_set(self.IFC_model, IFC_entity, CJ_attributes, owner_history)
 
     def create_file(self) -> ifcopenshell.file:
         version: str = "IFC4"
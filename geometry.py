@@ -16,33 +16,336 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with ifccityjson.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+import json
+import re
+import sys
 import warnings
 from collections.abc import Iterable
+from contextlib import contextmanager
+
+import numpy as np
+
+from interning import EntityCache, canonical_ring
+from step import format_list, format_real, format_references
+
+# Depth of the rings in the boundaries of each CityJSON surface geometry
+RING_DEPTH = {"MultiSurface": 2, "CompositeSurface": 2, "Solid": 3, "MultiSolid": 4, "CompositeSolid": 4}
+# The levels of the boundaries of a CompactGeometry above its vertex indices, from the outer level in
+BOUNDARY_LEVELS = ["solids", "shells", "faces", "rings"]
+# Number of different lists of semantic surfaces that are shared by the geometries that have them
+SEMANTIC_SURFACES_CACHE_SIZE = 4096
+
+# The empty geometry items that StepGeometryIO creates in the IFC model, as ifcopenshell writes them
+PLACEHOLDER = re.compile(r"^#(\d+)=IFC(?:SHELLBASEDSURFACEMODEL\(\$\)|POLYGONALFACESET\(\$,\$,\$,\$\));$", re.M)
+
+
+def count_faces(geometry):
+    """The number of surfaces of a CityJSON surface or solid geometry, 0 for other geometry types."""
+    if geometry.type not in RING_DEPTH:
+        return 0
+    if isinstance(geometry, CompactGeometry):
+        return len(geometry.faces) - 1
+    items = geometry.boundaries
+    for _ in range(RING_DEPTH[geometry.type] - 2):
+        items = [item for boundary in items for item in boundary]
+    return len(items)
+
+
+class VertexPool:
+    """The transformed coordinates of all the vertices of a CityJSON file.
+
+    The integer CityJSON vertices are scaled and moved by the vertical translation in one go,
+    the horizontal translation is stored in the IfcMapConversion. The pool does not depend on
+    an IFC model, so the same pool can be shared by every LoD that is converted from a file.
+    """
+
+    def __init__(self, vertices, scale=None, height=None):
+        coordinates = np.array(vertices, dtype=np.float64).reshape(-1, 3)
+        if scale:
+            coordinates *= np.asarray(scale, dtype=np.float64)
+        if height:
+            coordinates[:, 2] += float(height)
+        self.coordinates = coordinates
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def get_coordinates(self, indices):
+        return self.coordinates[indices].tolist()
+
+
+def flatten_boundary(boundary, offsets, vertices):
+    """Append the vertex indices of ``boundary`` to ``vertices`` and the end of every item to its level of ``offsets``."""
+    if len(offsets) == 2:
+        # The faces, the level that most geometries have most items of
+        face_ends, ring_ends = offsets
+        for face in boundary:
+            for ring in face:
+                vertices.extend(ring)
+                ring_ends.append(len(vertices))
+            face_ends.append(len(ring_ends) - 1)
+        return
+    ends = offsets[0]
+    inner = offsets[1]
+    for item in boundary:
+        flatten_boundary(item, offsets[1:], vertices)
+        ends.append(len(inner) - 1)
+
+
+def flatten_values(boundary, values, depth, face_values):
+    """Append the semantic value of every face of ``boundary`` to ``face_values``, ``depth`` levels above the faces."""
+    if depth == 0:
+        face_values.extend(values if values is not None else [None] * len(boundary))
+        return
+    for i, item in enumerate(boundary):
+        flatten_values(item, values[i] if values is not None and i < len(values) else None, depth - 1, face_values)
+
+
+@functools.lru_cache(maxsize=SEMANTIC_SURFACES_CACHE_SIZE)
+def get_semantic_surfaces(text):
+    """The semantic surfaces of the JSON ``text``, the same list for the many geometries that have the same ones."""
+    return json.loads(text)
+
+
+class CompactGeometry:
+    """A CityJSON surface or solid geometry with its boundaries in a flat int32 array instead of nested lists.
+
+    ``vertices`` are the vertex indices of all rings one after the other. ``rings`` has the start of
+    every ring in ``vertices`` followed by the end of the last, ``faces`` the start of every face in
+    ``rings``, and so on for the ``shells`` of a Solid and the ``solids`` of a MultiSolid or
+    CompositeSolid. ``surface_values`` has the index of the semantic surface of every face in
+    ``semantic_surfaces``, -1 for faces without one. The arrays are views of the single array ``data``,
+    ``sections`` has the end of each of them in it.
+
+    ``boundaries`` and ``surfaces`` are built as cjio has them when they are used, GeometryIO reads
+    the arrays directly where it can.
+    """
+
+    __slots__ = ("type", "lod", "data", "sections", "semantic_surfaces")
+
+    def __init__(self, geometry_type, lod, boundaries, semantics=None):
+        self.type = sys.intern(geometry_type)
+        self.lod = sys.intern(lod) if isinstance(lod, str) else lod
+        levels = BOUNDARY_LEVELS[len(BOUNDARY_LEVELS) - RING_DEPTH[geometry_type]:]
+        offsets = [[0] for _ in levels]
+        vertices = []
+        try:
+            flatten_boundary(boundaries, offsets, vertices)
+        except TypeError:
+            vertices = None
+        # The same check as cjio, on the first vertex
+        if vertices is None or (vertices and not isinstance(vertices[0], int)):
+            raise TypeError(f"Boundary definition does not correspond to {geometry_type}")
+        # vertices, rings, faces, shells, solids and surface_values
+        sections = [vertices]
+        sections += [offsets[levels.index(name)] if name in levels else [] for name in reversed(BOUNDARY_LEVELS)]
+        self.semantic_surfaces = None
+        if semantics and semantics.get("values"):
+            face_values = []
+            flatten_values(boundaries, semantics["values"], len(levels) - 2, face_values)
+            sections.append([-1 if value is None else value for value in face_values])
+            self.semantic_surfaces = get_semantic_surfaces(json.dumps(semantics["surfaces"]))
+        else:
+            sections.append([])
+        self.data = np.array([item for section in sections for item in section], dtype=np.int32)
+        ends = []
+        for section in sections:
+            ends.append((ends[-1] if ends else 0) + len(section))
+        self.sections = tuple(ends)
+
+    def get_section(self, index):
+        """The array of section ``index`` of ``data``, None when it is empty."""
+        start = self.sections[index - 1] if index else 0
+        end = self.sections[index]
+        return self.data[start:end] if end > start else None
+
+    @property
+    def vertices(self):
+        return self.data[:self.sections[0]]
+
+    @property
+    def rings(self):
+        return self.get_section(1)
+
+    @property
+    def faces(self):
+        return self.get_section(2)
+
+    @property
+    def shells(self):
+        return self.get_section(3)
+
+    @property
+    def solids(self):
+        return self.get_section(4)
+
+    @property
+    def surface_values(self):
+        return self.get_section(5)
+
+    def get_faces(self, face_ids=None):
+        """The faces, all or those of ``face_ids``, as lists of rings of vertex indices."""
+        vertices = self.vertices.tolist()
+        rings = self.rings.tolist()
+        faces = self.faces.tolist()
+        if face_ids is None:
+            face_ids = range(len(faces) - 1)
+        return [[vertices[rings[r]:rings[r + 1]] for r in range(faces[f], faces[f + 1])] for f in face_ids]
+
+    def get_surface_faces(self):
+        """The faces of every semantic surface that has faces, {surface index: [face, ...]}, in a single pass."""
+        if self.surface_values is None:
+            return {}
+        surface_faces = {}
+        for face, value in zip(self.get_faces(), self.surface_values.tolist()):
+            if value >= 0:
+                surface_faces.setdefault(value, []).append(face)
+        return surface_faces
+
+    def get_vertex_indices(self):
+        """The vertex indices in the order in which they are first used."""
+        return list(dict.fromkeys(self.vertices.tolist()))
+
+    def get_face_paths(self):
+        """The index of every face in the boundaries, eg. [shell, face] for a Solid."""
+        face_ids = range(len(self.faces) - 1)
+        if self.shells is None:
+            return [[f] for f in face_ids]
+        shells = self.shells.tolist()
+        shell_ids = np.repeat(np.arange(len(shells) - 1), np.diff(self.shells)).tolist()
+        if self.solids is None:
+            return [[s, f - shells[s]] for f, s in zip(face_ids, shell_ids)]
+        solids = self.solids.tolist()
+        solid_ids = np.repeat(np.arange(len(solids) - 1), np.diff(self.solids)).tolist()
+        return [[solid_ids[s], s - solids[solid_ids[s]], f - shells[s]] for f, s in zip(face_ids, shell_ids)]
+
+    @property
+    def boundaries(self):
+        items = self.get_faces()
+        for name in ["shells", "solids"]:
+            offsets = getattr(self, name)
+            if offsets is None:
+                break
+            offsets = offsets.tolist()
+            items = [items[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return items
+
+    @property
+    def surfaces(self):
+        """The semantic surfaces as cjio has them, {index: {"surface_idx": [face path, ...], "type": ...}}."""
+        if self.surface_values is None:
+            return {}
+        surface_idx = {}
+        for path, value in zip(self.get_face_paths(), self.surface_values.tolist()):
+            if value >= 0:
+                surface_idx.setdefault(value, []).append(path)
+        surfaces = {}
+        for i, surface in enumerate(self.semantic_surfaces):
+            semantic_surface = {"surface_idx": surface_idx.get(i)}
+            attributes = {}
+            for key, value in surface.items():
+                if key in ["type", "children", "parent"]:
+                    semantic_surface[key] = value
+                else:
+                    attributes[key] = value
+            if attributes:
+                semantic_surface["attributes"] = attributes
+            surfaces[i] = semantic_surface
+        return surfaces
 
 
 class GeometryIO:
-    def __init__(self, scale=None, height=None):
+    def __init__(self, scale=None, height=None, tessellated=False, entities=None):
         self.vertices = {}
+        self.entities = EntityCache() if entities is None else entities
+        self.points = {}
+        # The IfcCartesianPoints of the model by their coordinates, when it was written by an earlier conversion
+        self.existing_points = {}
+        self.vertex_pool = None
+        # The faces of the semantic surfaces of the last CompactGeometry, which are written one after the other
+        self.surface_geometry = None
+        self.surface_faces = {}
         self.scale = scale
         self.height = height
+        # Entities that are written as STEP text instead of being created in the IFC model
+        self.written_entities = 0
+        self.set_tessellated(tessellated)
+
+    def set_tessellated(self, tessellated):
+        """Write surfaces and shells as IfcPolygonalFaceSet instead of faces made of IfcPolyLoops."""
+        self.tessellated = tessellated
+        self.surface_representation_type = "Tessellation" if tessellated else "SurfaceModel"
+        self.point_list_geometry = None
+        self.point_list = None
 
     def set_scale(self, scale, height):
         self.scale = scale
         self.height = height
 
-    def build_vertex(self, IFC_model, vertex):
+    def stitch(self, text):
+        """The STEP text of the IFC model with the geometry that is written as text, see StepGeometryIO."""
+        return text
+
+    def set_vertex_pool(self, vertex_pool):
+        """Use the coordinates of ``vertex_pool`` for geometries with vertex indices in their boundaries.
+
+        The IfcCartesianPoints are cached per vertex index, the cache is kept as long as the pool is the same.
+        Only the vertices that are used are in the cache, so that converting a single building of a large
+        tile does not cost the size of the tile.
+        """
+        if vertex_pool is self.vertex_pool:
+            return
+        self.vertex_pool = vertex_pool
+        self.points = {}
+
+    def get_reference(self, entity):
+        """How the geometry refers to an entity of the IFC model."""
+        return entity
+
+    def add_existing_entities(self, IFC_model):
+        """
+        Reuse the IfcCartesianPoints and IfcPolyLoops of the faces of a model that was written by an earlier
+        conversion, eg. when buildings are patched into it. The points are found by their coordinates, as
+        the vertex indices of the file changed.
+        """
+        for polyloop in IFC_model.by_type("IfcPolyLoop"):
+            points = polyloop.Polygon
+            for point in points:
+                self.existing_points[tuple(point.Coordinates)] = self.get_reference(point)
+            self.entities.add_existing(
+                "IfcPolyLoop", canonical_ring([point.id() for point in points]), self.get_reference(polyloop)
+            )
+
+    def get_point(self, IFC_model, index):
+        IFC_cartesian_point = self.points.get(index)
+        if IFC_cartesian_point is None:
+            coordinates = self.vertex_pool.coordinates[index].tolist()
+            if self.existing_points:
+                IFC_cartesian_point = self.existing_points.get(tuple(coordinates))
+            if IFC_cartesian_point is None:
+                IFC_cartesian_point = IFC_model.create_entity("IfcCartesianPoint", coordinates)
+            self.points[index] = IFC_cartesian_point
+        return IFC_cartesian_point
+
+    def transform_vertex(self, vertex):
         if self.scale:
             IFC_vertex = [float(xyz) * coord_scale for xyz, coord_scale in zip(vertex, self.scale)]
             IFC_vertex[2] = IFC_vertex[2] + float(self.height)
         else:
             IFC_vertex = [float(xyz) for xyz in vertex]
             IFC_vertex[2] = IFC_vertex[2] + float(self.height)
+        return IFC_vertex
 
+    def build_vertex(self, IFC_model, vertex):
+        IFC_vertex = self.transform_vertex(vertex)
         IFC_cartesian_point = IFC_model.create_entity("IfcCartesianPoint", IFC_vertex)
         self.vertices[tuple(vertex)] = IFC_cartesian_point
         return IFC_cartesian_point
 
     def get_vertex(self, IFC_model, vertex):
+        if isinstance(vertex, int):
+            return self.get_point(IFC_model, vertex)
         if not isinstance(vertex[0], Iterable):
                 if tuple(vertex) in self.vertices:
                     return self.vertices[tuple(vertex)]
@@ -60,7 +363,7 @@ class GeometryIO:
     # https://www.cityjson.org/specs/1.0.3/#geometry-objects
     def create_IFC_geometry(self, IFC_model, geometry):
         IFC_Geometry = None
-        geometry_type = "SurfaceModel"
+        geometry_type = self.surface_representation_type
         if geometry.type in ["MultiPoint"]:
             IFC_geometry = self.create_IFC_cartesian_point_list3D(IFC_model, geometry)
             geometry_type = "PointCloud"
@@ -84,7 +387,10 @@ class GeometryIO:
     def create_IFC_cartesian_point_list3D(self, IFC_model, geometry):
         # https://www.cityjson.org/dev/geom-arrays/
         # https://standards.buildingsmart.org/IFC/DEV/IFC4_2/FINAL/HTML/schema/ifcgeometricmodelresource/lexical/ifccartesianpointlist3d.htm
-        IFC_geometry = IFC_model.create_entity("IfcCartesianPointList3D", geometry.boundaries)
+        coordinates = geometry.boundaries
+        if coordinates and isinstance(coordinates[0], int):
+            coordinates = self.vertex_pool.get_coordinates(coordinates)
+        IFC_geometry = IFC_model.create_entity("IfcCartesianPointList3D", coordinates)
         return IFC_geometry
 
     def create_IFC_composite_curve(self, IFC_model, geometry):
@@ -101,8 +407,14 @@ class GeometryIO:
         return IFC_geometry
 
     def create_IFC_composite_closed_shell(self, IFC_model, geometry):
+        boundaries = geometry.boundaries
+        if self.tessellated:
+            return [
+                self.create_IFC_polygonal_face_set(IFC_model, geometry, solid[0], closed=True)
+                for solid in boundaries
+            ]
         shells = []
-        for shell in geometry.boundaries:
+        for shell in boundaries:
             # exterior shell
             outershell = shell[0]
             faces = []
@@ -114,13 +426,16 @@ class GeometryIO:
         return IFC_geometry
 
     def create_IFC_closed_shell(self, IFC_model, geometry):
+        boundaries = geometry.boundaries
         # exterior shell
-        outershell = geometry.boundaries[0]
+        outershell = boundaries[0]
+        if self.tessellated and len(boundaries) == 1:
+            return self.create_IFC_polygonal_face_set(IFC_model, geometry, outershell, closed=True)
         faces = []
         for face in outershell:
             faces.append(self.create_IFC_face(IFC_model, face))
 
-        if len(geometry.boundaries) == 1:
+        if len(boundaries) == 1:
             shell = IFC_model.create_entity("IfcClosedShell", faces)
             IFC_geometry = IFC_model.create_entity("IfcShellBasedSurfaceModel", [shell])
             return IFC_geometry
@@ -133,17 +448,58 @@ class GeometryIO:
         #         for triangle in face:
         #             print(triangle)
 
-    def create_IFC_surface(self, IFC_model, geometry, surface_id=None):
+    def get_surface_types(self, geometry):
+        """The index and CityJSON type of every semantic surface of the geometry."""
+        if isinstance(geometry, CompactGeometry):
+            return list(enumerate(surface["type"] for surface in geometry.semantic_surfaces or []))
+        return [(surface_id, surface["type"]) for surface_id, surface in geometry.surfaces.items()]
+
+    def get_surface_faces(self, geometry, surface_id=None):
+        """The faces of the semantic surface ``surface_id``, or all faces, None when the surface has no geometry."""
+        if isinstance(geometry, CompactGeometry):
+            if surface_id is None:
+                return geometry.get_faces()
+            if geometry is not self.surface_geometry:
+                self.surface_geometry = geometry
+                self.surface_faces = geometry.get_surface_faces()
+            return self.surface_faces.get(surface_id)
+        if surface_id is None:
+            return geometry.boundaries
+        face_ids = geometry.surfaces[surface_id]["surface_idx"]
+        if face_ids is None:
+            return None
         faces = []
+        for fid in face_ids:
+            face = geometry.boundaries
+            for i in fid:
+                face = face[i]
+            faces.append(face)
+        return faces
 
-        if surface_id is not None:
-            face_ids = geometry.surfaces[surface_id]["surface_idx"]
-            if face_ids is None:
-                return  # there is no geometry
-            for fid in face_ids:
-                faces.append(geometry.boundaries[fid[0]][fid[1]])
-        else:
-            faces = geometry.boundaries
+    def get_faces(self, geometry):
+        """The faces of a surface geometry or of the exterior shells of a solid geometry."""
+        if isinstance(geometry, CompactGeometry):
+            if geometry.shells is None:
+                return geometry.get_faces()
+            shells = geometry.shells.tolist()
+            # The first shell of a Solid, or of every solid of a MultiSolid, is the exterior
+            exteriors = [0] if geometry.solids is None else geometry.solids[:-1].tolist()
+            return geometry.get_faces([f for shell in exteriors for f in range(shells[shell], shells[shell + 1])])
+        if geometry.type in ["CompositeSurface", "MultiSurface"]:
+            return geometry.boundaries
+        if geometry.type == "Solid":
+            return geometry.boundaries[0]
+        if geometry.type in ["CompositeSolid", "MultiSolid"]:
+            return [face for solid in geometry.boundaries for face in solid[0]]
+        return []
+
+    def create_IFC_surface(self, IFC_model, geometry, surface_id=None):
+        faces = self.get_surface_faces(geometry, surface_id)
+        if faces is None:
+            return  # there is no geometry
+
+        if self.tessellated:
+            return self.create_IFC_polygonal_face_set(IFC_model, geometry, faces, closed=False)
 
         IFC_faces = []
         for face in faces:
@@ -155,11 +511,10 @@ class GeometryIO:
 
     def create_IFC_face(self, IFC_model, face):
         # exterior face
-        vertices = []
-        for vertex in face[0]:
-            vertices.append(self.get_vertex(IFC_model, vertex))
-        polyloop = IFC_model.create_entity("IfcPolyLoop", Polygon=vertices)
-        outerbound = IFC_model.create_entity("IfcFaceOuterBound", Bound=polyloop, Orientation=True)
+        # Rings that are shared between faces are written once, see EntityCache.get_polyloop
+        vertices = [self.get_vertex(IFC_model, vertex) for vertex in face[0]]
+        polyloop, orientation = self.entities.get_polyloop(IFC_model, vertices)
+        outerbound = IFC_model.create_entity("IfcFaceOuterBound", Bound=polyloop, Orientation=orientation)
 
         # return if only exterior face
         if len(face) == 1:
@@ -167,9 +522,251 @@ class GeometryIO:
 
         innerbounds = []
         for interior_face in face[1:]:
-            vertices = []
-            for vertex in interior_face:
-                vertices.append(self.get_vertex(IFC_model, vertex))
-            polyloop = IFC_model.create_entity("IfcPolyLoop", Polygon=vertices)
-            innerbounds.append(IFC_model.create_entity("IfcFaceBound", Bound=polyloop, Orientation=False))
+            vertices = [self.get_vertex(IFC_model, vertex) for vertex in interior_face]
+            polyloop, orientation = self.entities.get_polyloop(IFC_model, vertices)
+            innerbounds.append(IFC_model.create_entity("IfcFaceBound", Bound=polyloop, Orientation=not orientation))
         return IFC_model.create_entity("IfcFace", Bounds=[outerbound] + innerbounds)
+
+    def get_point_list(self, IFC_model, geometry):
+        """Return the IfcCartesianPointList3D with all vertices of ``geometry`` and the 1-based index of each vertex in it.
+
+        The point list is shared by all the face sets of the geometry, eg. one per semantic surface.
+        """
+        if geometry is self.point_list_geometry:
+            return self.point_list
+        positions = {}
+        if isinstance(geometry, CompactGeometry):
+            positions = {vertex: position for position, vertex in enumerate(geometry.get_vertex_indices(), 1)}
+        else:
+            for ring in self.iter_rings(geometry.boundaries, RING_DEPTH[geometry.type]):
+                for vertex in ring:
+                    key = vertex if isinstance(vertex, int) else tuple(vertex)
+                    if key not in positions:
+                        positions[key] = len(positions) + 1
+        vertices = list(positions)
+        if vertices and isinstance(vertices[0], int):
+            coordinates = self.vertex_pool.get_coordinates(vertices)
+        else:
+            coordinates = [self.transform_vertex(vertex) for vertex in vertices]
+        IFC_point_list = IFC_model.create_entity("IfcCartesianPointList3D", CoordList=coordinates)
+        self.point_list_geometry = geometry
+        self.point_list = (IFC_point_list, positions)
+        return self.point_list
+
+    def iter_rings(self, boundary, depth):
+        if depth == 0:
+            yield boundary
+            return
+        for item in boundary:
+            yield from self.iter_rings(item, depth - 1)
+
+    def create_IFC_polygonal_face_set(self, IFC_model, geometry, faces, closed):
+        # https://standards.buildingsmart.org/IFC/RELEASE/IFC4/ADD2_TC1/HTML/schema/ifcgeometricmodelresource/lexical/ifcpolygonalfaceset.htm
+        IFC_point_list, positions = self.get_point_list(IFC_model, geometry)
+        IFC_faces = [self.create_IFC_indexed_polygonal_face(IFC_model, face, positions) for face in faces]
+        return IFC_model.create_entity(
+            "IfcPolygonalFaceSet", Coordinates=IFC_point_list, Closed=closed, Faces=IFC_faces
+        )
+
+    def create_IFC_indexed_polygonal_face(self, IFC_model, face, positions):
+        rings = [
+            [positions[vertex if isinstance(vertex, int) else tuple(vertex)] for vertex in ring]
+            for ring in face
+        ]
+        if len(rings) == 1:
+            return IFC_model.create_entity("IfcIndexedPolygonalFace", CoordIndex=rings[0])
+        return IFC_model.create_entity(
+            "IfcIndexedPolygonalFaceWithVoids", CoordIndex=rings[0], InnerCoordIndices=rings[1:]
+        )
+
+
+class StepGeometryIO(GeometryIO):
+    """
+    Writes surfaces and solids with vertex indices as STEP text instead of creating their points, loops,
+    faces and shells in the IFC model, which is much faster for the many entities of a building.
+
+    The entities of a geometry item get the ids that ifcopenshell would give them: the ids after the
+    last entity of the model. The item itself is created in the model as an empty placeholder with the
+    id after them, so that the representation can refer to it and the next entity of the model gets the
+    next id. ``stitch`` puts the text of the geometry in place of the placeholders in the STEP text of
+    the model, which is then the same as when the entities are created in the model. Other geometry is
+    created in the model as usual.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The STEP text of every geometry item by the id of its placeholder
+        self.blocks = {}
+        self.point_ids = {}
+        self.lines = None
+        self.next_id = None
+
+    def set_vertex_pool(self, vertex_pool):
+        if vertex_pool is not self.vertex_pool:
+            self.point_ids = {}
+        super().set_vertex_pool(vertex_pool)
+
+    def get_reference(self, entity):
+        return entity.id()
+
+    def stitch(self, text):
+        if not self.blocks:
+            return text
+        return PLACEHOLDER.sub(lambda match: self.blocks.get(int(match.group(1)), match.group(0)), text)
+
+    def is_indexed(self, geometry):
+        """Whether the boundaries of the geometry refer to the vertex pool."""
+        if isinstance(geometry, CompactGeometry):
+            return len(geometry.vertices) > 0 and self.vertex_pool is not None
+        items = geometry.boundaries
+        while isinstance(items, list):
+            if not items:
+                return False
+            items = items[0]
+        return isinstance(items, int) and self.vertex_pool is not None
+
+    @contextmanager
+    def block(self, IFC_model):
+        """Write the entities of a geometry item, which ends with ``finish``."""
+        self.next_id = IFC_model.get_max_id() + 1
+        self.lines = []
+        first_id = self.next_id
+        try:
+            yield
+        except BaseException:
+            # The entities of the item are not written, the ones that are cached must be created again
+            self.point_ids = {index: point_id for index, point_id in self.point_ids.items() if point_id < first_id}
+            self.entities.entities = {
+                key: entity for key, entity in self.entities.entities.items()
+                if not (isinstance(entity, int) and entity >= first_id)
+            }
+            if self.point_list is not None and isinstance(self.point_list[0], int) and self.point_list[0] >= first_id:
+                self.point_list_geometry = None
+                self.point_list = None
+            raise
+        finally:
+            self.lines = None
+
+    def add(self, text):
+        entity_id = self.next_id
+        self.next_id += 1
+        self.lines.append(f"#{entity_id}={text};")
+        return entity_id
+
+    def finish(self, IFC_model, IFC_class, text):
+        """Create the placeholder of the geometry item ``text`` and keep the text of the item."""
+        entity_id = self.add(text)
+        placeholder = IFC_model.create_entity(IFC_class, id=entity_id)
+        self.blocks[entity_id] = "\n".join(self.lines)
+        self.written_entities += len(self.lines) - 1
+        return placeholder
+
+    def get_point_id(self, index):
+        point_id = self.point_ids.get(index)
+        if point_id is None:
+            x, y, z = self.vertex_pool.coordinates[index].tolist()
+            if self.existing_points:
+                point_id = self.existing_points.get((x, y, z))
+            if point_id is None:
+                point_id = self.add(f"IFCCARTESIANPOINT(({format_real(x)},{format_real(y)},{format_real(z)}))")
+            self.point_ids[index] = point_id
+        return point_id
+
+    def get_polyloop_id(self, point_ids):
+        """Like EntityCache.get_polyloop, with entity ids instead of entities."""
+        key = canonical_ring(point_ids)
+        polyloop = self.entities.get("IfcPolyLoop", key)
+        if polyloop is not None:
+            return polyloop, True
+        polyloop = self.entities.get("IfcPolyLoop", canonical_ring(reversed(point_ids)))
+        if polyloop is not None:
+            return polyloop, False
+        return self.entities.add("IfcPolyLoop", key, self.add(f"IFCPOLYLOOP({format_references(point_ids)})")), True
+
+    def write_face(self, face):
+        bounds = []
+        for ring_index, ring in enumerate(face):
+            polyloop, orientation = self.get_polyloop_id([self.get_point_id(vertex) for vertex in ring])
+            if ring_index == 0:
+                bounds.append(self.add(f"IFCFACEOUTERBOUND(#{polyloop},{'.T.' if orientation else '.F.'})"))
+            else:
+                bounds.append(self.add(f"IFCFACEBOUND(#{polyloop},{'.F.' if orientation else '.T.'})"))
+        return self.add(f"IFCFACE({format_references(bounds)})")
+
+    def write_shells(self, IFC_model, shells, IFC_shell_class):
+        """An IfcShellBasedSurfaceModel of a shell of ``IFC_shell_class`` for every list of faces of ``shells``."""
+        with self.block(IFC_model):
+            shell_ids = [
+                self.add(f"{IFC_shell_class}({format_references([self.write_face(face) for face in faces])})")
+                for faces in shells
+            ]
+            return self.finish(
+                IFC_model, "IfcShellBasedSurfaceModel", f"IFCSHELLBASEDSURFACEMODEL({format_references(shell_ids)})"
+            )
+
+    def create_IFC_surface(self, IFC_model, geometry, surface_id=None):
+        if not self.is_indexed(geometry):
+            return super().create_IFC_surface(IFC_model, geometry, surface_id)
+        faces = self.get_surface_faces(geometry, surface_id)
+        if faces is None:
+            return
+        if self.tessellated:
+            return self.write_polygonal_face_set(IFC_model, geometry, faces, closed=False)
+        return self.write_shells(IFC_model, [faces], "IFCOPENSHELL")
+
+    def create_IFC_closed_shell(self, IFC_model, geometry):
+        # Interior shells are not supported, see GeometryIO
+        if not self.is_indexed(geometry):
+            return super().create_IFC_closed_shell(IFC_model, geometry)
+        boundaries = geometry.boundaries
+        if len(boundaries) != 1:
+            return super().create_IFC_closed_shell(IFC_model, geometry)
+        if self.tessellated:
+            return self.write_polygonal_face_set(IFC_model, geometry, boundaries[0], closed=True)
+        return self.write_shells(IFC_model, [boundaries[0]], "IFCCLOSEDSHELL")
+
+    def create_IFC_composite_closed_shell(self, IFC_model, geometry):
+        if not self.is_indexed(geometry):
+            return super().create_IFC_composite_closed_shell(IFC_model, geometry)
+        boundaries = geometry.boundaries
+        if self.tessellated:
+            return [
+                self.write_polygonal_face_set(IFC_model, geometry, solid[0], closed=True)
+                for solid in boundaries
+            ]
+        return self.write_shells(IFC_model, [shell[0] for shell in boundaries], "IFCCLOSEDSHELL")
+
+    def write_point_list(self, geometry):
+        """Like get_point_list, with the id of the IfcCartesianPointList3D."""
+        if geometry is self.point_list_geometry:
+            return self.point_list
+        positions = {}
+        if isinstance(geometry, CompactGeometry):
+            positions = {vertex: position for position, vertex in enumerate(geometry.get_vertex_indices(), 1)}
+        else:
+            for ring in self.iter_rings(geometry.boundaries, RING_DEPTH[geometry.type]):
+                for vertex in ring:
+                    if vertex not in positions:
+                        positions[vertex] = len(positions) + 1
+        coordinates = self.vertex_pool.coordinates[list(positions)].tolist() if positions else []
+        point_list = self.add("IFCCARTESIANPOINTLIST3D(" + format_list(
+            f"({format_real(x)},{format_real(y)},{format_real(z)})" for x, y, z in coordinates
+        ) + ")")
+        self.point_list_geometry = geometry
+        self.point_list = (point_list, positions)
+        return self.point_list
+
+    def write_polygonal_face_set(self, IFC_model, geometry, faces, closed):
+        with self.block(IFC_model):
+            point_list, positions = self.write_point_list(geometry)
+            face_ids = []
+            for face in faces:
+                rings = [format_list(str(positions[vertex]) for vertex in ring) for ring in face]
+                if len(rings) == 1:
+                    face_ids.append(self.add(f"IFCINDEXEDPOLYGONALFACE({rings[0]})"))
+                else:
+                    face_ids.append(self.add(f"IFCINDEXEDPOLYGONALFACEWITHVOIDS({rings[0]},{format_list(rings[1:])})"))
+            return self.finish(
+                IFC_model, "IfcPolygonalFaceSet",
+                f"IFCPOLYGONALFACESET(#{point_list},{'.T.' if closed else '.F.'},{format_references(face_ids)},$)",
+            )
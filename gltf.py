@@ -0,0 +1,299 @@
+"""
+Writes the geometry of a converted model as a binary glTF (GLB) file, for viewers that need triangle meshes.
+
+The meshes are built from the same faces and vertex pool as the IFC model while it is converted, so
+the CityJSON file is not read again. Every IFC object with geometry, eg. a building part, is a node
+named by the GlobalId of the IFC object, with a mesh primitive per CityJSON semantic surface type of its
+surfaces, eg. all its RoofSurfaces in one primitive, so that eg. WallSurfaces and InteriorWallSurfaces,
+which are both IfcWalls, stay apart. Geometry without semantic surfaces has a primitive per IFC class.
+The primitives of a node share its vertices. The surface type, the IFC class and the GlobalIds of the
+surfaces of a primitive are in its extras.
+The coordinates are those of the IFC model, relative to the translation of the file, with the Y axis up
+as glTF requires. The translation and the CRS are in the extras of the root node.
+"""
+import json
+import struct
+
+import numpy as np
+
+try:
+    import mapbox_earcut
+except ImportError:
+    mapbox_earcut = None
+
+GLB_MAGIC = 0x46546C67
+JSON_CHUNK = 0x4E4F534A
+BIN_CHUNK = 0x004E4942
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+FLOAT = 5126
+UNSIGNED_INT = 5125
+
+# Base colors of the surfaces by CityJSON semantic surface type, other types are grey
+COLORS = {
+    "RoofSurface": [0.75, 0.25, 0.2, 1.0],
+    "WallSurface": [0.95, 0.95, 0.9, 1.0],
+    "InteriorWallSurface": [0.85, 0.85, 0.8, 1.0],
+    "GroundSurface": [0.5, 0.5, 0.5, 1.0],
+    "Window": [0.5, 0.7, 0.9, 1.0],
+    "Door": [0.55, 0.4, 0.25, 1.0],
+}
+DEFAULT_COLOR = [0.7, 0.7, 0.7, 1.0]
+
+
+def get_projection_axes(ring):
+    """The two axes of the plane on which a ring of points is projected, chosen so that it keeps its orientation."""
+    # Newell's method for the normal of a polygon that is not exactly planar
+    normal = [0.0, 0.0, 0.0]
+    for (x1, y1, z1), (x2, y2, z2) in zip(ring, ring[1:] + ring[:1]):
+        normal[0] += (y1 - y2) * (z1 + z2)
+        normal[1] += (z1 - z2) * (x1 + x2)
+        normal[2] += (x1 - x2) * (y1 + y2)
+    axis = max(range(3), key=lambda i: abs(normal[i]))
+    u, v = [(1, 2), (2, 0), (0, 1)][axis]
+    # Counter-clockwise seen from the side the normal points to
+    return (u, v) if normal[axis] >= 0 else (v, u)
+
+
+def signed_area(points):
+    area = 0.0
+    for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+        area += x1 * y2 - x2 * y1
+    return area / 2
+
+
+def cross(a, b, c):
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+
+def in_triangle(p, a, b, c):
+    """Whether ``p`` is in the triangle or on its edges, but not one of its corners."""
+    if p == a or p == b or p == c:
+        return False
+    return cross(a, b, p) >= 0 and cross(b, c, p) >= 0 and cross(c, a, p) >= 0
+
+
+def segments_cross(a, b, c, d):
+    """Whether the segments ab and cd cross in a point that is not an end point of both."""
+    d1, d2, d3, d4 = cross(c, d, a), cross(c, d, b), cross(a, b, c), cross(a, b, d)
+    return ((d1 > 0 > d2) or (d1 < 0 < d2)) and ((d3 > 0 > d4) or (d3 < 0 < d4))
+
+
+def bridge_hole(polygon, hole, points):
+    """
+    Connect a hole to the polygon by a pair of edges from the rightmost point of the hole to a point of
+    the polygon that it can see, so that the polygon with the hole becomes a single ring.
+    """
+    start = max(range(len(hole)), key=lambda i: points[hole[i]][0])
+    m = points[hole[start]]
+    edges = [(polygon[i], polygon[(i + 1) % len(polygon)]) for i in range(len(polygon))]
+    edges += [(hole[i], hole[(i + 1) % len(hole)]) for i in range(len(hole))]
+    candidates = sorted(
+        range(len(polygon)),
+        key=lambda i: (points[polygon[i]][0] - m[0]) ** 2 + (points[polygon[i]][1] - m[1]) ** 2,
+    )
+    target = candidates[0]
+    for i in candidates:
+        p = points[polygon[i]]
+        if not any(segments_cross(m, p, points[a], points[b]) for a, b in edges):
+            target = i
+            break
+    hole_ring = hole[start:] + hole[:start + 1]
+    return polygon[:target + 1] + hole_ring + polygon[target:]
+
+
+def clip_ears(polygon, points):
+    """Triangulate a counter-clockwise ring of point indices by ear clipping."""
+    triangles = []
+    remaining = list(polygon)
+    failed = 0
+    i = 0
+    while len(remaining) > 3:
+        n = len(remaining)
+        a, b, c = remaining[(i - 1) % n], remaining[i % n], remaining[(i + 1) % n]
+        pa, pb, pc = points[a], points[b], points[c]
+        is_ear = cross(pa, pb, pc) > 0 and not any(
+            in_triangle(points[other], pa, pb, pc) for other in remaining if other not in (a, b, c)
+        )
+        # A ring without ears, eg. with overlapping edges, is cut anyway so that it ends
+        if is_ear or failed >= n:
+            triangles.append((a, b, c))
+            del remaining[i % n]
+            failed = 0
+        else:
+            i += 1
+            failed += 1
+    if len(remaining) == 3:
+        triangles.append(tuple(remaining))
+    return triangles
+
+
+def triangulate_face(face, coordinates):
+    """
+    Triangulate a CityJSON face, a list of rings of indices of points of ``coordinates`` of which the first is
+    the exterior, into triangles of point indices that follow the orientation of the exterior ring.
+    """
+    # Without the last vertex of a ring that repeats the first
+    rings = [list(ring[:-1] if len(ring) > 1 and ring[0] == ring[-1] else ring) for ring in face]
+    rings = [ring for ring in rings if len(ring) >= 3]
+    if not rings or len(rings[0]) < 3:
+        return []
+    if len(rings) == 1 and len(rings[0]) == 3:
+        return [tuple(rings[0])]
+    vertices = [vertex for ring in rings for vertex in ring]
+    u, v = get_projection_axes([coordinates[vertex] for vertex in rings[0]])
+    points = [(coordinates[vertex][u], coordinates[vertex][v]) for vertex in vertices]
+
+    if mapbox_earcut is not None:
+        ends = np.cumsum([len(ring) for ring in rings], dtype=np.uint32)
+        indices = mapbox_earcut.triangulate_float64(np.asarray(points, dtype=np.float64), ends).tolist()
+        triangles = [indices[i:i + 3] for i in range(0, len(indices), 3)]
+    else:
+        triangles = triangulate_points(rings, points)
+    # The triangles are turned like the exterior, which is counter-clockwise in the projection
+    return [
+        (vertices[a], vertices[b], vertices[c]) if cross(points[a], points[b], points[c]) >= 0
+        else (vertices[a], vertices[c], vertices[b])
+        for a, b, c in triangles
+    ]
+
+
+def triangulate_points(rings, points):
+    """Triangulate the rings of a face by their positions in ``points``, without mapbox_earcut."""
+    # A vertex can be in a ring more than once, so the rings refer to their positions in ``points``
+    position_rings = []
+    start = 0
+    for ring in rings:
+        position_rings.append(list(range(start, start + len(ring))))
+        start += len(ring)
+    polygon = position_rings[0]
+    if len(rings) == 1 and all(
+        cross(points[polygon[i - 2]], points[polygon[i - 1]], points[polygon[i]]) >= 0 for i in range(len(polygon))
+    ):
+        # A convex face is a fan
+        return [(polygon[0], polygon[i], polygon[i + 1]) for i in range(1, len(polygon) - 1)]
+    for hole in sorted(position_rings[1:], key=lambda ring: -max(points[i][0] for i in ring)):
+        # Holes run opposite to the exterior
+        if signed_area([points[i] for i in hole]) > 0:
+            hole = hole[::-1]
+        polygon = bridge_hole(polygon, hole, points)
+    return clip_ears(polygon, points)
+
+
+class GltfBuilder:
+    """The nodes of a GLB file, which is written by ``to_bytes``."""
+
+    def __init__(self, name=None, extras=None):
+        self.name = name
+        self.extras = extras or {}
+        # (name, extras, positions, [(material, indices, extras)])
+        self.nodes = []
+        self.triangles = 0
+
+    def add_node(self, name, extras, groups, coordinates):
+        """
+        Add a node with a primitive for every (surface type, IFC class, faces, GlobalIds) of ``groups``, the
+        surface type is None for geometry without semantic surfaces. The faces refer to the vertices of the
+        array ``coordinates``, eg. of a VertexPool.
+        """
+        # Only the vertices of the node are kept, numbered in the order in which they are found
+        vertices = {}
+        local_groups = []
+        for surface_type, IFC_class, faces, global_ids in groups:
+            faces = [[[vertices.setdefault(vertex, len(vertices)) for vertex in ring] for ring in face] for face in faces]
+            local_groups.append((surface_type, IFC_class, faces, global_ids))
+        if not vertices:
+            return
+        points = coordinates[list(vertices)].tolist()
+        primitives = []
+        for surface_type, IFC_class, faces, global_ids in local_groups:
+            triangles = [triangle for face in faces for triangle in triangulate_face(face, points)]
+            if not triangles:
+                continue
+            self.triangles += len(triangles)
+            indices = np.array(triangles, dtype=np.uint32).ravel()
+            extras = {"ifcClass": IFC_class, "globalIds": global_ids}
+            if surface_type is not None:
+                extras = {"surfaceType": surface_type, **extras}
+            primitives.append((surface_type or IFC_class, indices, extras))
+        if primitives:
+            # Y is up in glTF, the Z axis of the model goes to Y and its Y axis to -Z
+            positions = np.array(points, dtype=np.float32)[:, [0, 2, 1]]
+            positions[:, 2] *= -1
+            self.nodes.append((name, extras, positions, primitives))
+
+    def extend(self, nodes):
+        """Add the nodes of another builder, eg. of another chunk of the same file."""
+        for node in nodes:
+            self.nodes.append(node)
+            self.triangles += sum(len(primitive[1]) // 3 for primitive in node[3])
+
+    def to_bytes(self):
+        materials = {}
+        meshes = []
+        accessors = []
+        position_data = []
+        index_data = []
+        position_offset = 0
+        index_offset = 0
+        for _, _, positions, primitives in self.nodes:
+            position_accessor = len(accessors)
+            accessors.append({
+                "bufferView": 0, "byteOffset": position_offset, "componentType": FLOAT,
+                "count": len(positions), "type": "VEC3",
+                "min": positions.min(axis=0).tolist(), "max": positions.max(axis=0).tolist(),
+            })
+            position_data.append(positions.tobytes())
+            position_offset += positions.nbytes
+            mesh_primitives = []
+            for material_name, indices, extras in primitives:
+                material = materials.setdefault(material_name, len(materials))
+                accessors.append({
+                    "bufferView": 1, "byteOffset": index_offset, "componentType": UNSIGNED_INT,
+                    "count": len(indices), "type": "SCALAR",
+                })
+                mesh_primitives.append({
+                    "attributes": {"POSITION": position_accessor}, "indices": len(accessors) - 1,
+                    "material": material, "extras": extras,
+                })
+                index_data.append(indices.tobytes())
+                index_offset += indices.nbytes
+            meshes.append({"primitives": mesh_primitives})
+
+        nodes = [{"name": self.name or "", "children": list(range(1, len(self.nodes) + 1)), "extras": self.extras}]
+        for mesh, (name, extras, _, _) in enumerate(self.nodes):
+            nodes.append({"name": name, "mesh": mesh, "extras": extras})
+        document = {
+            "asset": {"version": "2.0", "generator": "ifccityjson"},
+            "scene": 0,
+            "scenes": [{"nodes": [0]}],
+            "nodes": nodes,
+            "meshes": meshes,
+            "materials": [
+                {
+                    "name": material_name,
+                    "pbrMetallicRoughness": {
+                        "baseColorFactor": COLORS.get(material_name, DEFAULT_COLOR), "metallicFactor": 0.0,
+                        "roughnessFactor": 1.0,
+                    },
+                    # The orientation of CityJSON surfaces is not always consistent
+                    "doubleSided": True,
+                }
+                for material_name in materials
+            ],
+            "accessors": accessors,
+        }
+        binary = b"".join(position_data) + b"".join(index_data)
+        if binary:
+            document["buffers"] = [{"byteLength": len(binary)}]
+            document["bufferViews"] = [
+                {"buffer": 0, "byteOffset": 0, "byteLength": position_offset, "target": ARRAY_BUFFER},
+                {"buffer": 0, "byteOffset": position_offset, "byteLength": index_offset, "target": ELEMENT_ARRAY_BUFFER},
+            ]
+        text = json.dumps(document, separators=(",", ":")).encode("utf-8")
+        text += b" " * (-len(text) % 4)
+        binary += b"\0" * (-len(binary) % 4)
+        chunks = struct.pack("<II", len(text), JSON_CHUNK) + text
+        if binary:
+            chunks += struct.pack("<II", len(binary), BIN_CHUNK) + binary
+        return struct.pack("<III", GLB_MAGIC, 2, 12 + len(chunks)) + chunks
@@ -0,0 +1,70 @@
+from collections import Counter
+
+
+def canonical_ring(ids):
+    """The ring of entity ids rotated to start at its smallest id, so that every rotation of a ring has the same key."""
+    ids = list(ids)
+    start = ids.index(min(ids))
+    return tuple(ids[start:] + ids[:start])
+
+
+class EntityCache:
+    """
+    Creates structurally identical IFC entities only once per IFC model. Entities are looked up by a key
+    that describes their content, eg. the ids of the entities they refer to, and the number of created
+    and reused entities is counted per IFC class.
+    """
+
+    def __init__(self):
+        self.entities = {}
+        self.created = Counter()
+        self.reused = Counter()
+
+    def clear(self):
+        """Forget the entities, eg. when a new IFC model is started. The statistics are kept."""
+        self.entities = {}
+
+    def get(self, IFC_class, key):
+        entity = self.entities.get((IFC_class, key))
+        if entity is not None:
+            self.reused[IFC_class] += 1
+        return entity
+
+    def add(self, IFC_class, key, entity):
+        self.entities[(IFC_class, key)] = entity
+        self.created[IFC_class] += 1
+        return entity
+
+    def add_existing(self, IFC_class, key, entity):
+        """Add an entity that is already in the IFC model, eg. of an earlier conversion, without counting it."""
+        self.entities[(IFC_class, key)] = entity
+
+    def create(self, IFC_model, IFC_class, key, *args, **kwargs):
+        """Return the entity with ``key``, or create it with ``args`` and ``kwargs`` when there is none yet."""
+        entity = self.get(IFC_class, key)
+        if entity is None:
+            entity = self.add(IFC_class, key, IFC_model.create_entity(IFC_class, *args, **kwargs))
+        return entity
+
+    def get_polyloop(self, IFC_model, points):
+        """
+        Return an IfcPolyLoop through ``points`` and whether it has the same orientation as ``points``.
+        A ring that is shared by two faces, eg. the wall between two buildings, is usually stored with
+        the opposite orientation in the other face. Its IfcPolyLoop is reused with a reversed bound.
+        """
+        ids = [point.id() for point in points]
+        key = canonical_ring(ids)
+        polyloop = self.get("IfcPolyLoop", key)
+        if polyloop is not None:
+            return polyloop, True
+        polyloop = self.get("IfcPolyLoop", canonical_ring(reversed(ids)))
+        if polyloop is not None:
+            return polyloop, False
+        return self.add("IfcPolyLoop", key, IFC_model.create_entity("IfcPolyLoop", Polygon=points)), True
+
+    def get_stats(self):
+        """Return the number of created and reused entities per IFC class."""
+        return {
+            IFC_class: {"created": self.created[IFC_class], "reused": self.reused[IFC_class]}
+            for IFC_class in sorted(set(self.created) | set(self.reused))
+        }
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    content_hash TEXT,
+    converter_version TEXT,
+    lods TEXT,
+    settings TEXT,
+    output_path TEXT,
+    output_hash TEXT,
+    status TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS features (
+    path TEXT,
+    feature TEXT,
+    hash TEXT,
+    object_ids TEXT,
+    PRIMARY KEY (path, feature)
+)
+"""
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Records the conversion of every tile in a SQLite file: the size, modification time and content hash of
+    the input, the converter version, LoDs and settings it was converted with and the hash of the output.
+
+    A tile is up to date when it was converted with the same settings and its output still exists. When
+    its size and modification time are unchanged it is not opened at all, otherwise its content hash is
+    compared, so a touched or copied tile is not converted again. A tile is recorded as started before it
+    is converted and as converted after its output is in place, so an interrupted run converts the tiles
+    that were not finished when it is started again.
+
+    For every building of a converted tile the hash of its attributes and geometry and the ids of its
+    CityObjects are recorded as well, so that the next version of the tile can be patched with only the
+    buildings that changed.
+
+    The file can be used by several worker processes at the same time. When it is ``shared`` by several
+    nodes on a network file system, a rollback journal is used instead of a write-ahead log, which needs
+    shared memory. The file system then needs working file locks, eg. NFSv4. A node then passes the time
+    at which it claimed the tile to ``start`` and ``finish``, which do not replace a record of the tile
+    that another node converted after that time.
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute(f"PRAGMA journal_mode={'DELETE' if shared else 'WAL'}")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, path):
+        cursor = self.connection.execute("SELECT * FROM tiles WHERE path = ?", (os.path.abspath(path),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def matches_settings(self, record, output_path, converter_version, lods, settings):
+        return (
+            record is not None
+            and record["status"] == "converted"
+            and record["converter_version"] == converter_version
+            and record["lods"] == json.dumps(lods)
+            and record["settings"] == json.dumps(settings, sort_keys=True)
+            and record["output_path"] == os.path.abspath(output_path)
+            and os.path.isfile(output_path)
+        )
+
+    def can_patch(self, path, output_path, converter_version, lods, settings):
+        """Whether the output of the tile can be patched, it was fully converted with the same settings."""
+        return self.matches_settings(self.get(path), output_path, converter_version, lods, settings)
+
+    def get_features(self, path):
+        """Return {feature: (hash, object_ids)} of the buildings of the tile when it was converted."""
+        rows = self.connection.execute(
+            "SELECT feature, hash, object_ids FROM features WHERE path = ?", (os.path.abspath(path),)
+        )
+        return {feature: (feature_hash, json.loads(object_ids)) for feature, feature_hash, object_ids in rows}
+
+    def set_features(self, path, features):
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.write_features(path, features)
+
+    def write_features(self, path, features):
+        path = os.path.abspath(path)
+        self.connection.execute("DELETE FROM features WHERE path = ?", (path,))
+        self.connection.executemany(
+            "INSERT INTO features (path, feature, hash, object_ids) VALUES (?, ?, ?, ?)",
+            [
+                (path, feature, feature_hash, json.dumps(object_ids))
+                for feature, (feature_hash, object_ids) in features.items()
+            ],
+        )
+
+    def is_unchanged(self, path, output_path, converter_version, lods, settings):
+        """Whether the tile is up to date, judged by its size and modification time only."""
+        record = self.get(path)
+        if not self.matches_settings(record, output_path, converter_version, lods, settings):
+            return False
+        stat = os.stat(path)
+        return record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns
+
+    def check(self, path, output_path, converter_version, lods, settings):
+        """
+        Return whether the tile is up to date and the content hash of the tile. The hash is None when the
+        tile was found up to date by its size and modification time.
+        """
+        record = self.get(path)
+        if not self.matches_settings(record, output_path, converter_version, lods, settings):
+            return False, hash_file(path)
+        stat = os.stat(path)
+        if record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+            return True, None
+        content_hash = hash_file(path)
+        if content_hash != record["content_hash"]:
+            return False, content_hash
+        self.connection.execute(
+            "UPDATE tiles SET size = ?, mtime_ns = ?, updated_at = ? WHERE path = ?",
+            (stat.st_size, stat.st_mtime_ns, now(), os.path.abspath(path)),
+        )
+        return True, content_hash
+
+    def start(self, path, content_hash, converter_version, lods, settings, since=None):
+        """
+        Record that the tile is being converted. With ``since``, the time at which the tile was claimed, a
+        record of the tile that was converted after that time is kept and False is returned.
+        """
+        stat = os.stat(path)
+        values = (
+            stat.st_size, stat.st_mtime_ns, content_hash, converter_version, json.dumps(lods),
+            json.dumps(settings, sort_keys=True), now(), os.path.abspath(path),
+        )
+        if since is None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tiles (size, mtime_ns, content_hash, converter_version, lods, settings, "
+                "output_path, output_hash, status, updated_at, path) "
+                "VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, 'started', ?, ?)",
+                values,
+            )
+            return True
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("INSERT OR IGNORE INTO tiles (path) VALUES (?)", (os.path.abspath(path),))
+            cursor = self.connection.execute(
+                "UPDATE tiles SET size = ?, mtime_ns = ?, content_hash = ?, converter_version = ?, lods = ?, "
+                "settings = ?, output_path = NULL, output_hash = NULL, status = 'started', updated_at = ? "
+                f"WHERE path = ? AND {NOT_CONVERTED_SINCE}",
+                values + (format_time(since),),
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, path, status, output_path=None, features=None, since=None):
+        """
+        Record the outcome of the conversion of the tile. With ``since``, the time at which the tile was
+        claimed, a record of the tile that was converted after that time is kept and False is returned.
+        """
+        output_hash = hash_file(output_path) if output_path is not None else None
+        values = (
+            status, os.path.abspath(output_path) if output_path is not None else None, output_hash, now(),
+            os.path.abspath(path),
+        )
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            if since is None:
+                cursor = self.connection.execute(
+                    "UPDATE tiles SET status = ?, output_path = ?, output_hash = ?, updated_at = ? WHERE path = ?",
+                    values,
+                )
+            else:
+                cursor = self.connection.execute(
+                    "UPDATE tiles SET status = ?, output_path = ?, output_hash = ?, updated_at = ? "
+                    f"WHERE path = ? AND {NOT_CONVERTED_SINCE}",
+                    values + (format_time(since),),
+                )
+            if cursor.rowcount == 0:
+                return False
+            if features is not None:
+                self.write_features(path, features)
+        return True
+
+
+# The record of a tile that another node converted after the given time is not replaced
+NOT_CONVERTED_SINCE = "NOT (status IS 'converted' AND updated_at > ?)"
+
+
+def format_time(timestamp):
+    # With microseconds, so that the times compare as text
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="microseconds")
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
@@ -0,0 +1,85 @@
+import json
+import os
+import resource
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+def get_max_rss():
+    """The peak resident set size of the current process in bytes, since it started or since reset_peak_rss."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process to its current size, so that the peak of a
+    task can be measured in a worker that ran other tasks before. Returns whether it could be reset, which
+    is only possible on Linux.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Metrics:
+    """Timings in seconds and counters of the conversion of a tile or of one LoD of a tile."""
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counts = Counter()
+
+    @contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def iterate(self, name, iterable):
+        """Yield the items of ``iterable`` and add the time spent in producing them to ``name``."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.timings[name] += time.perf_counter() - start
+                return
+            self.timings[name] += time.perf_counter() - start
+            yield item
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def add(self, record):
+        """Add the timings and counts of ``record``, the ``to_dict`` of other metrics, eg. of another process."""
+        for name, seconds in record["timings"].items():
+            self.timings[name] += seconds
+        self.counts.update(record["counts"])
+
+    def to_dict(self):
+        return {
+            "timings": {name: round(seconds, 6) for name, seconds in self.timings.items()},
+            "counts": dict(self.counts),
+        }
+
+
+def write_record(path, record):
+    """
+    Append a record as one line to a JSONL file. The line is written with a single write on a file that is
+    opened for appending, so that the records of parallel workers do not get mixed up.
+    """
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
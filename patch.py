@@ -0,0 +1,76 @@
+import os
+import zipfile
+
+import ifcopenshell
+
+from reader import get_feature_key, hash_feature
+
+# When more of the buildings changed, converting the whole tile is faster than patching its output
+MAX_CHANGED_FRACTION = 0.5
+
+
+class PatchError(Exception):
+    """The output of a tile cannot be patched, the tile has to be converted as a whole."""
+
+
+def diff_features(city_model, previous):
+    """
+    Compare the buildings of a tile with ``previous``, the {feature: (hash, object_ids)} of the tile when it
+    was converted. Returns the hashes of all buildings of the tile, the (cityobjects, vertex_pool) of the
+    buildings that are new or changed and the ids of the CityObjects that were changed or removed.
+    """
+    features = {}
+    changed = []
+    for cityobjects, vertex_pool in city_model.features():
+        key = get_feature_key(cityobjects)
+        feature_hash = hash_feature(cityobjects, vertex_pool)
+        features[key] = (feature_hash, list(cityobjects))
+        if key not in previous or previous[key][0] != feature_hash:
+            changed.append((cityobjects, vertex_pool))
+    removed_ids = [
+        object_id
+        for key, (feature_hash, object_ids) in previous.items()
+        if key not in features or features[key][0] != feature_hash
+        for object_id in object_ids
+    ]
+    return features, changed, removed_ids
+
+
+def check_translation(IFC_model, city_model):
+    """The geometry is stored relative to the translation of the file, the translation must not have changed."""
+    translate = city_model.transform["translate"]
+    for map_conversion in IFC_model.by_type("IfcMapConversion"):
+        if (map_conversion.Eastings, map_conversion.Northings) != (translate[0], translate[1]):
+            raise PatchError("the translation of the file changed")
+
+
+def patch_tile(converter, city_model, previous, source):
+    """
+    Patch the IFC files of a tile in the zip file ``source`` with the buildings that changed since
+    ``previous``, instead of converting the whole tile. The configuration of ``converter`` is the one of
+    the earlier conversion, the patched IFC files are written to its archive.
+
+    Returns the number of changed and removed buildings. Raises PatchError when the tile has to be
+    converted as a whole.
+    """
+    if not previous:
+        raise PatchError("there are no buildings recorded of the earlier conversion")
+    features, changed, removed_ids = diff_features(city_model, previous)
+    removed = sum(1 for key in previous if key not in features)
+    if len(changed) + removed > MAX_CHANGED_FRACTION * len(previous):
+        raise PatchError(f"{len(changed)} of {len(features)} buildings changed and {removed} were removed")
+
+    base = os.path.basename(converter.properties["file_destination"])
+    IFC_models = {}
+    with zipfile.ZipFile(source) as archive:
+        names = set(archive.namelist())
+        for lod in converter.properties["lods"]:
+            name = f"{base}-{lod}{converter.properties['file_extension']}"
+            if name not in names:
+                raise PatchError(f"{name} is missing from {source}")
+            IFC_models[lod] = ifcopenshell.file.from_string(archive.read(name).decode())
+            check_translation(IFC_models[lod], city_model)
+
+    converter.patch_lods(city_model, IFC_models, changed, removed_ids)
+    converter.feature_hashes = features
+    return len(changed), removed
@@ -0,0 +1,171 @@
+"""
+Overlaps the reading and the writing of a tile with its conversion in a worker.
+
+A tile is converted in three stages: the input is read and decompressed, the buildings are converted,
+and the IFC models are serialized, compressed and written to the zip file. The conversion runs in the
+worker process, which is one of the processes of the scheduler. The first and the last stage run in a
+thread next to it: decompression and compression release the GIL, so the disk and the CPU are busy at
+the same time. The stages are joined by bounded queues. A stage that is ahead waits for the next one,
+so the memory of a worker is capped by the depth of the queues.
+"""
+import io
+import queue
+import threading
+
+# Size of the decompressed pieces that are read ahead of the parser
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+# Number of pieces that are read ahead
+READ_QUEUE_DEPTH = 4
+# Number of serialized IFC models that wait to be compressed, each can be as large as the model
+WRITE_QUEUE_DEPTH = 1
+# Size of the pieces in which a serialized IFC model is written to an archive
+WRITE_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Put after the last item of a queue
+END = object()
+
+
+def put(items, item, stopped):
+    """Put ``item`` on the bounded queue, unless the other end stopped taking items."""
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Reads a binary file, eg. a decompressing reader, in a thread ahead of the reader of this file.
+    At most ``depth`` pieces of ``chunk_size`` bytes are read ahead.
+    """
+
+    def __init__(self, file, chunk_size=READ_CHUNK_SIZE, depth=READ_QUEUE_DEPTH):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.buffer = memoryview(b"")
+        self.at_end = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.file.read(self.chunk_size)
+                if not chunk:
+                    break
+                if not put(self.chunks, chunk, self.stopped):
+                    return
+            put(self.chunks, END, self.stopped)
+        except BaseException as e:
+            put(self.chunks, e, self.stopped)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            if self.at_end:
+                return 0
+            chunk = self.chunks.get()
+            if chunk is END:
+                self.at_end = True
+                return 0
+            if isinstance(chunk, BaseException):
+                self.at_end = True
+                raise chunk
+            self.buffer = memoryview(chunk)
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.file.close()
+        super().close()
+
+
+def open_read_ahead(file, encoding="utf-8"):
+    """A text file that reads the binary ``file`` ahead in a thread."""
+    return io.TextIOWrapper(io.BufferedReader(ReadAheadReader(file), READ_CHUNK_SIZE), encoding=encoding)
+
+
+def write_member(archive, name, data, metrics):
+    """Compress ``data``, STEP text, bytes or a list of pieces of text, into the zip file ``archive`` as ``name``."""
+    pieces = [data] if isinstance(data, (str, bytes)) else data
+    with metrics.time("zip"):
+        with archive.open(name, "w", force_zip64=True) as member:
+            for data in pieces:
+                for start in range(0, len(data), WRITE_CHUNK_SIZE):
+                    piece = data[start:start + WRITE_CHUNK_SIZE]
+                    member.write(piece.encode() if isinstance(piece, str) else piece)
+    info = archive.getinfo(name)
+    metrics.count("output_bytes", info.file_size)
+    metrics.count("compressed_bytes", info.compress_size)
+
+
+class ArchiveWriter:
+    """
+    Compresses and writes the members of a zip file in a thread, while the next model is converted or
+    serialized. Only this thread writes to the zip file. An error of the thread is raised by ``close``,
+    or by the next ``write``.
+    """
+
+    def __init__(self, archive, depth=WRITE_QUEUE_DEPTH):
+        self.archive = archive
+        self.members = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The members that are left are not written, the zip file is thrown away
+            self.stopped.set()
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                member = self.members.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if member is END:
+                return
+            try:
+                write_member(self.archive, *member)
+            except BaseException as e:
+                self.error = e
+                self.stopped.set()
+                return
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, name, data, metrics):
+        """Queue ``data`` to be written as ``name``, waits while the queue is full."""
+        self.check()
+        if not put(self.members, (name, data, metrics), self.stopped):
+            self.check()
+            raise RuntimeError("The archive writer stopped")
+
+    def close(self):
+        """Write the members that are left and wait until they are written."""
+        if self.thread.is_alive():
+            put(self.members, END, self.stopped)
+            self.thread.join()
+        self.check()
@@ -0,0 +1,124 @@
+import json
+
+import ifcopenshell.guid
+
+from interning import EntityCache
+
+# IFC value type and conversion of the properties of the Pset_BuildingCommon template that are filled in
+BUILDING_COMMON_TYPES = {
+    "BuildingID": ("IfcIdentifier", str),
+    "NumberOfStories": ("IfcInteger", int),
+    "YearOfConstruction": ("IfcLabel", str),
+}
+
+# IFC value type and conversion of attribute values without a template, as ifcopenshell.api infers them.
+# bool is a subclass of int, so it is looked up by the exact type.
+PYTHON_TO_IFC_TYPES = {
+    str: ("IfcLabel", str),
+    float: ("IfcReal", float),
+    bool: ("IfcBoolean", bool),
+    int: ("IfcInteger", int),
+}
+
+# Lists and objects have no single IFC value type, they are written as JSON text
+JSON_VALUE_TYPE = ("IfcText", lambda value: json.dumps(value, ensure_ascii=False))
+
+BAG_ID_PREFIX = "NL.IMBAG.Pand."
+
+
+def has_value(value):
+    # Like ifcopenshell.api, attributes without a value are left out of the property set
+    return value is not None and value != [] and value != {}
+
+
+class PropertySetWriter:
+    """
+    Creates the property sets of the IFC objects directly, instead of through the pset.add_pset and
+    pset.edit_pset calls of ifcopenshell.api, which check and infer the type of every value again.
+
+    The IFC value type of an attribute is worked out once per attribute name and Python type and kept in
+    value_types, which can be shared by the writers of all the LoDs of a tile. Properties with the same
+    name and value, eg. the status or the roof type of a building, are shared by the property sets.
+    """
+
+    def __init__(self, value_types=None, entities=None):
+        self.value_types = {} if value_types is None else value_types
+        self.entities = EntityCache() if entities is None else entities
+
+    def get_value_type(self, name, value):
+        key = (name, type(value))
+        value_type = self.value_types.get(key)
+        if value_type is None:
+            value_type = PYTHON_TO_IFC_TYPES.get(type(value), JSON_VALUE_TYPE)
+            self.value_types[key] = value_type
+        return value_type
+
+    def add_existing_properties(self, IFC_model):
+        """Reuse the properties of a model that was written by an earlier conversion, eg. when buildings are patched into it."""
+        for IFC_property in IFC_model.by_type("IfcPropertySingleValue"):
+            nominal_value = IFC_property.NominalValue
+            if nominal_value is not None:
+                key = (IFC_property.Name, nominal_value.is_a(), nominal_value.wrappedValue)
+                self.entities.add_existing("IfcPropertySingleValue", key, IFC_property)
+
+    def create_property(self, IFC_model, name, value, value_type):
+        IFC_type, convert = value_type
+        value = convert(value)
+        key = (name, IFC_type, value)
+        IFC_property = self.entities.get("IfcPropertySingleValue", key)
+        if IFC_property is None:
+            nominal_value = IFC_model.create_entity(IFC_type, value)
+            IFC_property = self.entities.add(
+                "IfcPropertySingleValue",
+                key,
+                IFC_model.create_entity("IfcPropertySingleValue", Name=name, NominalValue=nominal_value),
+            )
+        return IFC_property
+
+    def create_property_set(self, IFC_model, IFC_entity, name, properties, owner_history=None):
+        """Create the IfcPropertySet with the IfcPropertySingleValues of a list of (name, value, value_type)."""
+        IFC_properties = [
+            self.create_property(IFC_model, property_name, value, value_type)
+            for property_name, value, value_type in properties
+        ]
+        pset = IFC_model.create_entity(
+            "IfcPropertySet",
+            GlobalId=ifcopenshell.guid.new(),
+            OwnerHistory=owner_history,
+            Name=name,
+            HasProperties=IFC_properties,
+        )
+        IFC_model.create_entity(
+            "IfcRelDefinesByProperties",
+            GlobalId=ifcopenshell.guid.new(),
+            OwnerHistory=owner_history,
+            RelatedObjects=[IFC_entity],
+            RelatingPropertyDefinition=pset,
+        )
+        return pset
+
+    def create_attributes_property_set(self, IFC_model, IFC_entity, attributes, owner_history=None):
+        """Write the CityJSON attributes in the 3DBAG_attributes property set."""
+        properties = [
+            (name, value, self.get_value_type(name, value))
+            for name, value in attributes.items()
+            if has_value(value)
+        ]
+        return self.create_property_set(IFC_model, IFC_entity, "3DBAG_attributes", properties, owner_history)
+
+    def create_building_common_property_set(self, IFC_model, IFC_entity, attributes, owner_history=None):
+        """Write the 3DBAG attributes that have a counterpart in Pset_BuildingCommon."""
+        values = {}
+        if "identificatie" in attributes:
+            value = attributes["identificatie"]
+            if isinstance(value, str) and value.startswith(BAG_ID_PREFIX):
+                value = value[len(BAG_ID_PREFIX):]
+            values["BuildingID"] = value
+        if "b3_bouwlagen" in attributes:
+            values["NumberOfStories"] = attributes["b3_bouwlagen"]
+        if "oorspronkelijkbouwjaar" in attributes:
+            values["YearOfConstruction"] = attributes["oorspronkelijkbouwjaar"]
+        properties = [(name, value, BUILDING_COMMON_TYPES[name]) for name, value in values.items() if has_value(value)]
+        if not properties:
+            return None
+        return self.create_property_set(IFC_model, IFC_entity, "Pset_BuildingCommon", properties, owner_history)
@@ -0,0 +1,712 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+from functools import cached_property
+
+import numpy as np
+from cjio import models
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from geometry import RING_DEPTH, CompactGeometry, VertexPool
+from pipeline import open_read_ahead
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+WHITESPACE = re.compile(r"\s*")
+# Number of characters at the end of the buffer in which a decoding error can be a value that continues in the
+# next chunk, eg. a literal such as "-Infinity" or a surrogate pair of \u escapes that is cut off
+TRUNCATION_MARGIN = 16
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+# Characters of a value that is skipped that are scanned at once, doubled up to the chunk size for long values
+SKIP_BLOCK_SIZE = 64 * 1024
+# The change of the depth of the JSON value by every byte
+BRACKET_DEPTH = np.zeros(256, dtype=np.int64)
+BRACKET_DEPTH[[ord("["), ord("{")]] = 1
+BRACKET_DEPTH[[ord("]"), ord("}")]] = -1
+# The closing bracket of the last vertex, followed by the closing bracket of the vertex list
+VERTICES_END = re.compile(r"\]\s*(?=\])")
+BRACKETS_TO_SPACES = str.maketrans("[]", "  ")
+
+COMPRESSION_EXTENSIONS = [".gz", ".zst"]
+# Used to estimate the size of a compressed file when its header does not record it
+COMPRESSION_RATIO = 6
+
+# Parsers of whole JSON documents, auto uses orjson when it is installed and duplicate keys are ignored
+JSON_BACKENDS = ["auto", "json", "orjson"]
+
+# Depth of the vertex indices in the boundaries of each CityJSON geometry type
+BOUNDARY_DEPTH = {
+    "MultiPoint": 1, "MultiLineString": 2, "MultiSurface": 3, "CompositeSurface": 3, "Solid": 4,
+    "MultiSolid": 5, "CompositeSolid": 5,
+}
+
+
+def raise_on_duplicates(ordered_pairs):
+    d = {}
+    for k, v in ordered_pairs:
+        if k in d:
+            raise ValueError("Invalid CityJSON file, duplicate key for City Object IDs: %r" % (k))
+        d[k] = v
+    return d
+
+
+def estimate_size(path):
+    """
+    A cheap estimate of the uncompressed size of a CityJSON file in bytes. For gzip it is read from the
+    trailer of the file, for zstd from the frame header when the size was recorded.
+    """
+    path = str(path)
+    size = os.path.getsize(path)
+    if path.endswith(".gz") and size >= 18:
+        with open(path, "rb") as file:
+            file.seek(-4, os.SEEK_END)
+            # The trailer has the size modulo 2**32
+            uncompressed = struct.unpack("<I", file.read(4))[0]
+        while uncompressed < size:
+            uncompressed += 2 ** 32
+        return uncompressed
+    if path.endswith(".zst"):
+        if zstandard is not None:
+            with open(path, "rb") as file:
+                header = file.read(18)
+            try:
+                uncompressed = zstandard.frame_content_size(header)
+            except zstandard.ZstdError:
+                uncompressed = -1
+            if uncompressed >= 0:
+                return uncompressed
+        return size * COMPRESSION_RATIO
+    return size
+
+
+def get_json_loads(backend, ignore_duplicate_keys=False):
+    """
+    The function that parses a whole JSON document with ``backend``. orjson keeps the last of duplicate
+    keys without telling, so it is only used when duplicate keys are ignored.
+    """
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f"Unknown JSON backend {backend}, use one of {', '.join(JSON_BACKENDS)}")
+    if backend == "auto":
+        backend = "orjson" if orjson is not None and ignore_duplicate_keys else "json"
+    if backend == "orjson":
+        if orjson is None:
+            raise ValueError("The orjson JSON backend requires the orjson package")
+        if not ignore_duplicate_keys:
+            raise ValueError("The orjson JSON backend cannot detect duplicate keys, ignore duplicate keys to use it")
+        return orjson.loads
+    if ignore_duplicate_keys:
+        return json.JSONDecoder().decode
+    return json.JSONDecoder(object_pairs_hook=raise_on_duplicates).decode
+
+
+class LazyGeometry(models.Geometry):
+    """
+    A cjio Geometry that keeps the JSON of the geometry and only builds its boundaries and semantic
+    surfaces when they are used. The vertex indices are kept in the boundaries, which are the lists of
+    the JSON.
+
+    A surface or solid geometry is converted from its CompactGeometry, see ``resolve``. It is built the
+    first time that its LoD is converted, after which the JSON is released, so that the LoDs that are
+    not converted are not flattened.
+    """
+
+    def __init__(self, geom):
+        self.type = geom["type"]
+        self.lod = geom.get("lod")
+        self.semantics = {}
+        self.texture = {}
+        self.json = geom
+        self.compact = None
+
+    def resolve(self):
+        """The geometry to convert: the CompactGeometry of a surface or solid geometry, this geometry otherwise."""
+        if self.type not in RING_DEPTH:
+            return self
+        if self.compact is None:
+            geom = self.json
+            # Another thread may have built it in the meantime, it is set before the JSON is released
+            if geom is not None:
+                self.compact = CompactGeometry(self.type, self.lod, geom["boundaries"], geom.get("semantics"))
+                self.json = None
+                self.__dict__.pop("json_boundaries", None)
+                self.__dict__.pop("json_surfaces", None)
+        return self.compact
+
+    @property
+    def boundaries(self):
+        if self.json is None:
+            return self.compact.boundaries
+        return self.json_boundaries
+
+    @property
+    def surfaces(self):
+        if self.json is None:
+            return self.compact.surfaces
+        return self.json_surfaces
+
+    @cached_property
+    def json_boundaries(self):
+        boundaries = self.json["boundaries"]
+        depth = BOUNDARY_DEPTH.get(self.type)
+        if depth is None or not boundaries:
+            return self._dereference_boundaries(self.type, boundaries, None)
+        # The same check as cjio, the boundaries are not copied
+        first = boundaries
+        for _ in range(depth - 1):
+            first = first[0]
+        if not isinstance(first[0], int):
+            raise TypeError(f"Boundary definition does not correspond to {self.type}")
+        return boundaries
+
+    @cached_property
+    def json_surfaces(self):
+        return self._dereference_surfaces(self.json.get("semantics"))
+
+
+def resolve_geometry(geometry):
+    """The geometry to convert, see LazyGeometry.resolve, other cjio geometries are converted as they are."""
+    return geometry.resolve() if isinstance(geometry, LazyGeometry) else geometry
+
+
+def build_cityobject(co_id, co):
+    """
+    Builds a cjio CityObject from its JSON. The vertex indices are kept in the geometry boundaries,
+    the coordinates are looked up in a VertexPool. The geometry is only decoded when it is used, see
+    LazyGeometry.
+    """
+    geometry = [LazyGeometry(geom) for geom in co.get("geometry", [])]
+    return models.CityObject(
+        id=co_id,
+        type=co["type"],
+        attributes=co.get("attributes"),
+        children=co.get("children"),
+        parents=co.get("parents"),
+        geometry=geometry,
+    )
+
+
+def get_feature_key(cityobjects):
+    """The key of a building with its parts: the identificatie of the root object, or its id when it has none."""
+    root_id = next((co_id for co_id, co in cityobjects.items() if not co.parents), next(iter(cityobjects)))
+    return cityobjects[root_id].attributes.get("identificatie", root_id)
+
+
+def hash_boundary(digest, boundary, coordinates):
+    if boundary and isinstance(boundary[0], int):
+        digest.update(b"r%d" % len(boundary))
+        digest.update(coordinates[boundary].tobytes())
+        return
+    digest.update(b"[%d" % len(boundary))
+    for item in boundary:
+        hash_boundary(digest, item, coordinates)
+
+
+def hash_feature(cityobjects, vertex_pool):
+    """
+    A hash of the attributes and geometry of a building with its parts. The geometry is hashed by its
+    coordinates, not by its vertex indices, which change when other buildings in the file change.
+    """
+    digest = hashlib.sha256()
+    for co_id in sorted(cityobjects):
+        co = cityobjects[co_id]
+        digest.update(json.dumps(
+            [co_id, co.type, co.attributes, co.children, co.parents], sort_keys=True, default=str
+        ).encode("utf-8"))
+        for geometry in co.geometry:
+            digest.update(json.dumps(
+                [geometry.type, geometry.lod, geometry.surfaces], sort_keys=True, default=str
+            ).encode("utf-8"))
+            hash_boundary(digest, geometry.boundaries, vertex_pool.coordinates)
+    return digest.hexdigest()
+
+
+def get_boundary_indices(boundary, indices):
+    if boundary and isinstance(boundary[0], int):
+        indices.extend(boundary)
+        return
+    for item in boundary:
+        get_boundary_indices(item, indices)
+
+
+def get_feature_bbox(cityobjects, vertex_pool, translate=None):
+    """
+    The 2D bounding box (minx, miny, maxx, maxy) of the geometry of a building with its parts, in the
+    coordinates of the file when ``translate`` is given. None when the building has no geometry.
+    """
+    indices = []
+    for co in cityobjects.values():
+        for geometry in co.geometry:
+            if isinstance(geometry, LazyGeometry) and geometry.compact is not None:
+                indices.extend(geometry.compact.vertices.tolist())
+            else:
+                get_boundary_indices(geometry.boundaries, indices)
+    if not indices:
+        return None
+    coordinates = vertex_pool.coordinates[indices, :2]
+    minx, miny = coordinates.min(axis=0).tolist()
+    maxx, maxy = coordinates.max(axis=0).tolist()
+    if translate:
+        minx, maxx = minx + translate[0], maxx + translate[0]
+        miny, maxy = miny + translate[1], maxy + translate[1]
+    return minx, miny, maxx, maxy
+
+
+def select_cityobjects(cityobjects, object_ids):
+    """The CityObjects of ``object_ids`` with all of their parents and children, in the order of ``cityobjects``."""
+    selected = set()
+    stack = [co_id for co_id in cityobjects if co_id in object_ids]
+    while stack:
+        co_id = stack.pop()
+        if co_id in selected or co_id not in cityobjects:
+            continue
+        selected.add(co_id)
+        stack.extend(cityobjects[co_id].parents or [])
+        stack.extend(cityobjects[co_id].children or [])
+    return {co_id: co for co_id, co in cityobjects.items() if co_id in selected}
+
+
+def count_backslashes(data, index, before=0):
+    """The number of backslashes in front of ``index`` of the bytes ``data``, with ``before`` in front of the start."""
+    start = index
+    while start > 0 and data[start - 1] == ord("\\"):
+        start -= 1
+    return index - start + (before if start == 0 else 0)
+
+
+class JSONReader:
+    """
+    Reads a JSON document from a text stream one value at a time, so that the members of a large
+    object can be decoded and released one by one instead of holding the whole document in memory.
+    """
+
+    def __init__(self, file, decoder, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        chunk = self.file.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character."""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of the JSON document")
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Invalid JSON document, expected '{char}' but found '{found}'")
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as error:
+                # The value may not fit in the buffer yet, an error in the middle of it is a malformed document
+                if not self.is_truncated(error) or not self.fill(max(self.chunk_size, len(self.buffer) - self.pos)):
+                    raise
+                continue
+            # A number at the end of the buffer can continue in the next chunk, also after a cut off "." or "e"
+            if (
+                isinstance(value, (int, float)) and NUMBER_TAIL.fullmatch(self.buffer, end)
+                and not self.eof and self.fill()
+            ):
+                continue
+            self.pos = end
+            return value
+
+    def is_truncated(self, error):
+        """Whether a decoding error can be caused by the end of the buffer, a string is reported at its start."""
+        return error.msg.startswith("Unterminated string") or error.pos >= len(self.buffer) - TRUNCATION_MARGIN
+
+    def skip(self):
+        """
+        Skip a JSON value without decoding it, so that no Python objects are built for its members. The
+        brackets outside of strings are counted in blocks with NumPy until the value is closed. The
+        brackets are not checked, the value is decoded when it is read.
+        """
+        if self.peek() not in "[{":
+            self.decode()
+            return
+        depth = 0
+        in_string = 0
+        # The number of backslashes at the end of the blocks before, the first quote of a block can be escaped
+        backslashes = 0
+        size = SKIP_BLOCK_SIZE
+        while True:
+            if self.pos == len(self.buffer) and not self.fill():
+                raise ValueError("Unexpected end of the JSON document")
+            block = self.buffer[self.pos:self.pos + size]
+            # The characters that are counted are ASCII, the other characters of UTF-8 have their high bit set
+            encoded = block.encode("utf-8", "surrogatepass")
+            data = np.frombuffer(encoded, dtype=np.uint8)
+            quotes = np.flatnonzero(data == ord('"'))
+            escaped = [
+                index for index in quotes[data[np.maximum(quotes - 1, 0)] == ord("\\")].tolist()
+                if count_backslashes(encoded, index, backslashes) % 2
+            ]
+            if backslashes % 2 and len(quotes) and quotes[0] == 0:
+                escaped.append(0)
+            if escaped:
+                quotes = np.setdiff1d(quotes, escaped)
+            brackets = np.flatnonzero(
+                (data == ord("[")) | (data == ord("]")) | (data == ord("{")) | (data == ord("}"))
+            )
+            # A bracket after an odd number of quotes is in a string
+            brackets = brackets[(np.searchsorted(quotes, brackets) + in_string) % 2 == 0]
+            running = depth + np.cumsum(BRACKET_DEPTH[data[brackets]])
+            closed = np.flatnonzero(running == 0)
+            if len(closed):
+                self.pos += len(encoded[:brackets[closed[0]] + 1].decode("utf-8", "surrogatepass"))
+                return
+            if len(running):
+                depth = int(running[-1])
+            in_string = (in_string + len(quotes)) % 2
+            trailing = len(encoded) - len(encoded.rstrip(b"\\"))
+            backslashes = trailing + (backslashes if trailing == len(encoded) else 0)
+            self.pos += len(block)
+            size = min(size * 2, self.chunk_size)
+
+    def members(self):
+        """Yield the keys of a JSON object. The caller has to consume the value of each member."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            self.expect(":")
+            yield key
+            separator = self.peek()
+            self.pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"Invalid JSON document, expected ',' or '}}' but found '{separator}'")
+
+    def read_vertices(self, parse=True):
+        """
+        Reads the CityJSON vertex list into an (n, 3) array. The numbers are parsed by NumPy in
+        large chunks, which is much faster and smaller than a list of lists.
+        """
+        self.expect("[")
+        parts = []
+        while True:
+            char = self.peek()
+            if char == ",":
+                self.pos += 1
+                continue
+            if char == "]":
+                self.pos += 1
+                break
+            end = VERTICES_END.search(self.buffer, self.pos)
+            if end is not None:
+                cut = end.end()
+            else:
+                cut = self.buffer.rfind("]", self.pos) + 1
+            if cut > self.pos:
+                if parse:
+                    text = self.buffer[self.pos:cut].translate(BRACKETS_TO_SPACES)
+                    parts.append(np.fromstring(text, dtype=np.float64, sep=","))
+                self.pos = cut
+            elif not self.fill():
+                raise ValueError("Unexpected end of the CityJSON vertices")
+        if not parts:
+            return np.empty((0, 3), dtype=np.float64)
+        return np.concatenate(parts).reshape(-1, 3)
+
+
+class CityJSONStream:
+    """
+    Streams the CityObjects of a CityJSON (.city.json) or CityJSONSeq (.city.jsonl) file.
+    Files compressed with gzip (.gz) or zstd (.zst) are decompressed while reading.
+
+    features() yields one building with its parts at a time, as a dict of cjio CityObjects and the
+    VertexPool with their coordinates. Only the members of the file other than the CityObjects are
+    kept in memory, for a CityJSON file this includes the vertices of the whole file as a NumPy array.
+    For CityJSON the file is read twice: once for the header and the vertices, in which the CityObjects are
+    skipped without decoding them, and once for the CityObjects.
+
+    The lines of a CityJSONSeq file are whole documents, they are parsed with ``json_backend``. The
+    CityObjects of a CityJSON file are read one by one from the stream, which only the json module can do.
+    """
+
+    def __init__(self, path, ignore_duplicate_keys=False, json_backend="auto"):
+        self.path = str(path)
+        self.ignore_duplicate_keys = ignore_duplicate_keys
+        self.json_backend = json_backend
+        self.loads = get_json_loads(json_backend, ignore_duplicate_keys)
+        if ignore_duplicate_keys:
+            self.decoder = json.JSONDecoder()
+        else:
+            self.decoder = json.JSONDecoder(object_pairs_hook=raise_on_duplicates)
+        self.compression = None
+        name = self.path
+        for extension in COMPRESSION_EXTENSIONS:
+            if name.endswith(extension):
+                self.compression = extension
+                name = name[:-len(extension)]
+        self.is_sequence = name.endswith(".jsonl")
+        self.j = {}
+        self.vertex_pool = None
+        if self.is_sequence:
+            with self.open(read_ahead=False) as file:
+                self.j = self.loads(file.readline())
+        else:
+            self.read_header()
+        if self.j.get("type") != "CityJSON":
+            raise ValueError("Not a CityJSON file")
+        self.transform = self.j.get("transform")
+
+    def open(self, read_ahead=True):
+        """
+        Open the file as text. A compressed file is decompressed in a thread ahead of the parser with
+        ``read_ahead``, which is not worth it when only the start of the file is read.
+        """
+        if self.compression == ".gz":
+            raw = gzip.open(self.path, "rb")
+        elif self.compression == ".zst":
+            if zstandard is None:
+                raise IOError("Reading .zst files requires the zstandard package")
+            raw = zstandard.ZstdDecompressor().stream_reader(open(self.path, "rb"), read_across_frames=True)
+        else:
+            return open(self.path, "r", encoding="utf-8")
+        if read_ahead:
+            return open_read_ahead(raw)
+        return io.TextIOWrapper(raw, encoding="utf-8")
+
+    def read_header(self):
+        with self.open() as file:
+            reader = JSONReader(file, self.decoder)
+            vertices = None
+            for key in reader.members():
+                if key == "CityObjects":
+                    # They are decoded by ``features``, here they are skipped as a whole
+                    reader.skip()
+                elif key == "vertices":
+                    vertices = reader.read_vertices()
+                else:
+                    self.j[key] = reader.decode()
+        if vertices is not None:
+            self.vertex_pool = self.create_vertex_pool(vertices)
+
+    def create_vertex_pool(self, vertices):
+        transform = self.j.get("transform")
+        if transform is None:
+            return VertexPool(vertices)
+        return VertexPool(vertices, transform["scale"], transform["translate"][2])
+
+    def has_metadata(self):
+        return "metadata" in self.j
+
+    def get_epsg(self):
+        if "metadata" not in self.j or "referenceSystem" not in self.j["metadata"]:
+            return None
+        s = self.j["metadata"]["referenceSystem"]
+        if "opengis.net/def/crs" not in s or s.rfind("/") < 0:
+            raise ValueError(f"Invalid CRS string '{s}'. CRS needs to be formatted according to the OGC Name Type Specification: 'http://www.opengis.net/def/crs/{{authority}}/{{version}}/{{code}}'")
+        return int(s[s.rfind("/") + 1:])
+
+    def update_metadata(self):
+        # The metadata of a stream is used as it is in the file
+        pass
+
+    def features(self, select=None):
+        """
+        Yield (cityobjects, vertex_pool) for every building with its parts. With ``select`` only the buildings
+        of which select(index) is true are yielded, the others are dropped before their CityObjects are built.
+        """
+        if self.is_sequence:
+            yield from self.read_sequence_features(select)
+            return
+        with self.open() as file:
+            reader = JSONReader(file, self.decoder)
+            for key in reader.members():
+                if key == "CityObjects":
+                    for cityobjects in self.group_features(self.read_cityobjects(reader), select):
+                        yield cityobjects, self.vertex_pool
+                elif key == "vertices":
+                    reader.read_vertices(parse=False)
+                else:
+                    reader.skip()
+
+    def read_cityobjects(self, reader):
+        for co_id in reader.members():
+            yield co_id, reader.decode()
+
+    def read_sequence_features(self, select=None):
+        with self.open() as file:
+            file.readline()
+            index = 0
+            for line in file:
+                if not line.strip():
+                    continue
+                index += 1
+                if select is not None and not select(index - 1):
+                    continue
+                feature = self.loads(line)
+                cityobjects = {
+                    co_id: build_cityobject(co_id, co) for co_id, co in feature["CityObjects"].items()
+                }
+                yield cityobjects, self.create_vertex_pool(feature.get("vertices", []))
+
+    def group_features(self, cityobjects, select=None):
+        """
+        Groups the CityObjects in families of a root object with all of its descendants, which are
+        yielded as soon as they are complete. In 3DBAG the BuildingParts directly follow their Building.
+        With ``select`` only the families of which select(index) is true are built and yielded.
+        """
+        pending = {}
+        seen = set()
+        index = 0
+        for co_id, co in cityobjects:
+            if not self.ignore_duplicate_keys:
+                if co_id in seen:
+                    raise ValueError("Invalid CityJSON file, duplicate key for City Object IDs: %r" % (co_id))
+                seen.add(co_id)
+            pending[co_id] = co
+            root = self.find_root(co_id, pending)
+            if root is None:
+                continue
+            family = self.find_family(root, pending)
+            if family is not None:
+                index += 1
+                if select is None or select(index - 1):
+                    yield {i: build_cityobject(i, pending.pop(i)) for i in family}
+                else:
+                    for i in family:
+                        del pending[i]
+
+        # What is left are families with parents or children that are not in the file
+        while pending:
+            co_id = next(iter(pending))
+            root = self.find_root(co_id, pending, partial=True)
+            family = self.find_family(root, pending, partial=True)
+            index += 1
+            if select is None or select(index - 1):
+                yield {i: build_cityobject(i, pending.pop(i)) for i in family}
+            else:
+                for i in family:
+                    del pending[i]
+
+    def find_root(self, co_id, pending, partial=False):
+        visited = {co_id}
+        while pending[co_id].get("parents"):
+            parent = pending[co_id]["parents"][0]
+            if parent not in pending:
+                return co_id if partial else None
+            if parent in visited:
+                return co_id
+            visited.add(parent)
+            co_id = parent
+        return co_id
+
+    def find_family(self, root, pending, partial=False):
+        family = [root]
+        stack = [root]
+        while stack:
+            for child in pending[stack.pop()].get("children", []):
+                if child in family:
+                    continue
+                if child not in pending:
+                    if partial:
+                        continue
+                    return None
+                family.append(child)
+                stack.append(child)
+        return family
+
+
+def select_features(features, select):
+    """The features of which select(index) is true, see CityJSONStream.features."""
+    return (feature for index, feature in enumerate(features) if select is None or select(index))
+
+
+class CityJSONSubset(CityJSONStream):
+    """
+    Streams the CityObjects of several CityJSON files as if they were a single file, eg. the tiles that
+    overlap an area. The header, the CRS and the translation are those of the first file, the
+    coordinates of the other files are moved to its translation. The files need to share their CRS.
+    """
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+        if not self.streams:
+            raise ValueError("No CityJSON files to read")
+        first = self.streams[0]
+        self.path = first.path
+        self.ignore_duplicate_keys = first.ignore_duplicate_keys
+        self.json_backend = first.json_backend
+        self.j = first.j
+        self.transform = first.transform
+        self.vertex_pool = first.vertex_pool
+        for stream in self.streams[1:]:
+            if stream.get_epsg() != first.get_epsg():
+                raise ValueError(f"The CRS of {stream.path} differs from the CRS of {first.path}")
+        self.moved_pools = set()
+
+    def get_offset(self, stream):
+        if not self.transform or not stream.transform:
+            return None
+        offset = [
+            stream.transform["translate"][axis] - self.transform["translate"][axis] for axis in range(2)
+        ]
+        return offset if any(offset) else None
+
+    def features(self, select=None):
+        yield from select_features(self.read_stream_features(), select)
+
+    def read_stream_features(self):
+        for stream in self.streams:
+            offset = self.get_offset(stream)
+            for cityobjects, vertex_pool in stream.features():
+                # The pool of a CityJSON file is shared by all its buildings, it is moved once
+                if offset is not None and id(vertex_pool) not in self.moved_pools:
+                    vertex_pool.coordinates[:, :2] += offset
+                    if vertex_pool is stream.vertex_pool:
+                        self.moved_pools.add(id(vertex_pool))
+                yield cityobjects, vertex_pool
+
+
+class CityJSONFeatures(CityJSONStream):
+    """The buildings of ``features``, a list of (cityobjects, vertex_pool), as a file with the header of ``stream``."""
+
+    def __init__(self, stream, features):
+        self.path = stream.path
+        self.ignore_duplicate_keys = stream.ignore_duplicate_keys
+        self.json_backend = stream.json_backend
+        self.j = stream.j
+        self.transform = stream.transform
+        self.vertex_pool = stream.vertex_pool
+        self.feature_list = list(features)
+
+    def features(self, select=None):
+        yield from select_features(self.feature_list, select)
@@ -0,0 +1,317 @@
+import collections
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+from datetime import datetime, timezone
+
+import click
+
+from metrics import get_max_rss, write_record
+
+# How often the workers are checked, in seconds
+POLL_INTERVAL = 1.0
+# Seconds before the first retry of a failed task, every next retry waits twice as long
+RETRY_BACKOFF = 60.0
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def get_process_tree(pid):
+    """The process ids of ``pid`` and all its descendants, eg. the chunk processes of a worker, on Linux."""
+    if not os.path.isdir("/proc"):
+        return [pid]
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The name in parentheses may contain spaces, the parent id is the second field after it
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children.get(parent, []))
+    return pids
+
+
+def get_rss(pids):
+    """The current resident set size of the processes in bytes, None where /proc is not available."""
+    if not os.path.isdir("/proc"):
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    rss = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            # The process exited in the meantime
+            continue
+    return rss
+
+
+def read_quarantine(path):
+    """The names of the tasks in the quarantine file, they are skipped until they are removed from it."""
+    if path is None or not os.path.isfile(path):
+        return set()
+    names = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                names.add(json.loads(line)["file"])
+    return names
+
+
+def run_worker(function, connection, max_rss_growth):
+    """
+    Run the tasks that come in over ``connection`` until the None sentinel comes in. A worker whose peak RSS
+    has grown by more than max_rss_growth bytes since it started stops after its task, so that the memory
+    that is leaked by the C libraries is given back. The scheduler starts a new worker in its place.
+    """
+    start_rss = peak_rss = get_max_rss()
+    while True:
+        task = connection.recv()
+        if task is None:
+            return
+        index, args = task
+        error = None
+        try:
+            function(*args)
+        except Exception as ex:
+            error = f"{type(ex).__name__}: {ex}"
+        # The tasks may reset the peak, see reset_peak_rss, so the peak of the worker is kept here
+        peak_rss = max(peak_rss, get_max_rss())
+        growth = peak_rss - start_rss
+        retire = max_rss_growth is not None and growth > max_rss_growth
+        connection.send((index, error, growth, retire))
+        if retire:
+            return
+
+
+class Scheduler:
+    """
+    Runs a function over a list of tasks in worker processes, the most expensive tasks first, so that
+    the large tiles do not end up alone at the tail of the run. Results are handled in the order in
+    which they finish, with the progress, throughput and estimated time left after every task.
+
+    Each task is a tuple (name, args, cost). The cost is an estimate of the work, eg. the uncompressed
+    size of the file, and is used for the order and the time estimate.
+
+    Every worker has a pipe of its own, over which it gets its tasks and sends its results, so that a
+    worker that is killed or crashes does not leave a lock held that the other workers share. A worker
+    that runs a task for longer than ``timeout`` seconds, or of which the processes use more than
+    ``max_rss`` bytes, is killed with its child processes and replaced, the other workers keep running.
+    A task that failed, raised or got its worker killed is run again up to ``retries`` times, after
+    ``backoff`` seconds and twice as long for every next retry. A task that failed every time is
+    appended to the JSON lines file ``quarantine_file`` with its error.
+    """
+
+    def __init__(self, function, num_workers, max_rss_growth=None, timeout=None, max_rss=None, retries=0,
+                 backoff=RETRY_BACKOFF, quarantine_file=None):
+        self.function = function
+        self.num_workers = max(1, num_workers)
+        self.max_rss_growth = max_rss_growth
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.retries = retries
+        self.backoff = backoff
+        self.quarantine_file = quarantine_file
+        # The process and the connection of every worker by its name
+        self.workers = {}
+        self.worker_count = 0
+        self.failed = []
+        self.done = 0
+        self.done_cost = 0
+        self.total_cost = 1
+        self.start_time = None
+
+    def start_worker(self):
+        self.worker_count += 1
+        connection, worker_connection = multiprocessing.Pipe()
+        worker = multiprocessing.Process(
+            target=run_worker,
+            args=(self.function, worker_connection, self.max_rss_growth),
+            name=f"worker-{self.worker_count}",
+            # Not a daemon, so that a worker can convert a large file in chunks in processes of its own
+            daemon=False,
+        )
+        worker.start()
+        # The pipe reads as closed when the worker exits only when the parent does not hold its end
+        worker_connection.close()
+        self.workers[worker.name] = (worker, connection)
+
+    def stop_worker(self, worker_name):
+        worker, connection = self.workers.pop(worker_name)
+        worker.join()
+        connection.close()
+
+    def kill_worker(self, worker_name):
+        """Kill a worker and the processes it started, eg. to convert a file in chunks."""
+        worker, connection = self.workers[worker_name]
+        for pid in reversed(get_process_tree(worker.pid)):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.stop_worker(worker_name)
+
+    def run(self, tasks):
+        """Run all tasks and return the names of the tasks that failed."""
+        try:
+            return self.run_tasks(tasks)
+        except BaseException:
+            # The workers are not daemons, they would keep the process alive
+            for worker, connection in self.workers.values():
+                worker.terminate()
+            self.workers = {}
+            raise
+
+    def run_tasks(self, tasks):
+        tasks = sorted(tasks, key=lambda task: task[2], reverse=True)
+        self.failed = []
+        self.total_cost = sum(task[2] for task in tasks) or 1
+        self.done_cost = 0
+        self.done = 0
+        self.start_time = time.monotonic()
+        # The tasks that wait for a worker, the most expensive first
+        pending = collections.deque(range(len(tasks)))
+        # The task index and start time of every worker that runs a task
+        running = {}
+        attempts = [0] * len(tasks)
+        # The time at which the tasks that failed are run again, and their index
+        retries = []
+        next_check = time.monotonic() + POLL_INTERVAL
+        while self.done < len(tasks):
+            now = time.monotonic()
+            for retry in [retry for retry in retries if retry[0] <= now]:
+                retries.remove(retry)
+                pending.append(retry[1])
+            while len(self.workers) < min(self.num_workers, len(tasks) - self.done):
+                self.start_worker()
+            for worker_name, (worker, connection) in list(self.workers.items()):
+                if worker_name in running or not pending:
+                    continue
+                index = pending.popleft()
+                try:
+                    connection.send((index, tasks[index][1]))
+                except OSError:
+                    # The worker died while it was waiting, it is replaced in the next round
+                    pending.appendleft(index)
+                    self.stop_worker(worker_name)
+                    continue
+                running[worker_name] = (index, time.monotonic())
+
+            if now >= next_check:
+                for worker_name, error in self.check_workers(running):
+                    index = running.pop(worker_name)[0]
+                    self.finish(tasks, index, error, attempts, retries)
+                next_check = time.monotonic() + POLL_INTERVAL
+
+            names = {connection: worker_name for worker_name, (worker, connection) in self.workers.items()}
+            for connection in multiprocessing.connection.wait(list(names), timeout=POLL_INTERVAL):
+                worker_name = names[connection]
+                worker = self.workers[worker_name][0]
+                try:
+                    index, error, growth, retire = connection.recv()
+                except (EOFError, OSError):
+                    # The worker died, eg. of a segfault in a C library, its task failed with it
+                    self.stop_worker(worker_name)
+                    if worker_name in running:
+                        error = f"{worker_name} exited with code {worker.exitcode}"
+                        self.finish(tasks, running.pop(worker_name)[0], error, attempts, retries)
+                    continue
+                running.pop(worker_name)
+                self.finish(tasks, index, error, attempts, retries)
+                if retire:
+                    click.echo(f"Restarting {worker_name}, its memory grew by {format_size(growth)}.")
+                    self.stop_worker(worker_name)
+
+        for worker, connection in self.workers.values():
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for worker_name in list(self.workers):
+            self.stop_worker(worker_name)
+        return self.failed
+
+    def finish(self, tasks, index, error, attempts, retries):
+        """Count a task as done, or schedule it again when it failed and has retries left."""
+        name, args, cost = tasks[index]
+        if error is not None:
+            click.echo(f"Error processing {name}: {error}")
+            attempts[index] += 1
+            if attempts[index] <= self.retries:
+                delay = self.backoff * 2 ** (attempts[index] - 1)
+                click.echo(f"Retrying {name} in {delay:g} s ({attempts[index]} of {self.retries} retries).")
+                retries.append((time.monotonic() + delay, index))
+                return
+            self.failed.append(name)
+            if self.quarantine_file is not None:
+                self.quarantine(name, error, attempts[index])
+        self.done += 1
+        self.done_cost += cost
+        self.report(name, self.done, len(tasks), self.done_cost, self.total_cost, self.start_time)
+
+    def quarantine(self, name, error, attempts):
+        click.echo(f"Quarantined {name} in {self.quarantine_file}.")
+        write_record(self.quarantine_file, {
+            "file": name,
+            "error": error,
+            "attempts": attempts,
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        })
+
+    def check_workers(self, running):
+        """
+        Kill and replace the workers that went over the time or memory limit of their task, and the workers
+        that no longer run but of which the pipe is held open, eg. by the chunk processes they started.
+        Returns the workers that were running a task with the error of the task.
+        """
+        stopped = []
+        now = time.monotonic()
+        for worker_name in list(running):
+            worker = self.workers[worker_name][0]
+            error = None
+            elapsed = now - running[worker_name][1]
+            if not worker.is_alive():
+                error = f"{worker_name} exited with code {worker.exitcode}"
+            elif self.timeout is not None and elapsed > self.timeout:
+                error = f"timed out after {format_duration(elapsed)}"
+            elif self.max_rss is not None:
+                rss = get_rss(get_process_tree(worker.pid))
+                if rss is not None and rss > self.max_rss:
+                    error = f"used {format_size(rss)} of memory, more than the limit of {format_size(self.max_rss)}"
+            if error is not None:
+                if worker.is_alive():
+                    click.echo(f"Killing {worker_name}, its task {error}.")
+                self.kill_worker(worker_name)
+                stopped.append((worker_name, error))
+        return stopped
+
+    def report(self, name, done, total, done_cost, total_cost, start_time):
+        elapsed = time.monotonic() - start_time
+        rate = done_cost / elapsed if elapsed > 0 else 0
+        eta = (total_cost - done_cost) / rate if rate > 0 else 0
+        click.echo(
+            f"[{done}/{total}] {name} done. {format_duration(elapsed)} elapsed, "
+            f"{done / elapsed * 60 if elapsed > 0 else 0:.1f} files/min, {format_size(rate)}/s, "
+            f"ETA {format_duration(eta)}"
+        )
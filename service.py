@@ -0,0 +1,201 @@
+"""
+Serves the IFC of single buildings on request, from the CityJSON tiles of a tile index (see tile_index.py).
+
+Parsed tiles are kept in memory in an LRU cache, so only the first request for a building of a tile reads
+the tile and the next requests for buildings of the same tile only convert the building.
+
+    python service.py --input_dir /data/tiles --port 8080
+    curl "http://localhost:8080/building/NL.IMBAG.Pand.0363100012185598?lod=2.2" -o pand.ifc
+
+The same is available from Python:
+
+    service = BuildingService("/data/tiles/tile_index.sqlite")
+    ifc = service.get_ifc("NL.IMBAG.Pand.0363100012185598", lod="2.2")
+"""
+import os
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import click
+
+from batch_converter import LODS, stream_cityjson
+from cityjson2ifc import Cityjson2ifc
+from reader import CityJSONFeatures, estimate_size, get_feature_key
+from tile_index import INDEX_NAME, TileIndex
+
+# Memory of the parsed tiles in the cache, in MB. A parsed tile takes a few times its uncompressed size.
+CACHE_SIZE = 2048
+PARSED_SIZE_RATIO = 3
+
+
+class ParsedTile:
+    """The buildings of a tile by their identificatie and the identificatie of every CityObject."""
+
+    def __init__(self, path, ignore_duplicate_keys=False):
+        self.path = path
+        stat = os.stat(path)
+        self.version = (stat.st_size, stat.st_mtime_ns)
+        self.size = estimate_size(path) * PARSED_SIZE_RATIO
+        self.stream = stream_cityjson(path, ignore_duplicate_keys=ignore_duplicate_keys)
+        self.features = {}
+        self.feature_keys = {}
+        for cityobjects, vertex_pool in self.stream.features():
+            key = get_feature_key(cityobjects)
+            self.features[key] = (cityobjects, vertex_pool)
+            for co_id in cityobjects:
+                self.feature_keys[co_id] = key
+
+    def is_current(self):
+        stat = os.stat(self.path)
+        return self.version == (stat.st_size, stat.st_mtime_ns)
+
+    def get_building(self, identificatie):
+        """The building with its parts as a file of its own, or None when it is not in the tile."""
+        key = identificatie if identificatie in self.features else self.feature_keys.get(identificatie)
+        if key is None:
+            return None
+        return CityJSONFeatures(self.stream, [self.features[key]])
+
+
+class TileCache:
+    """An LRU cache of parsed tiles, the least recently used tiles are dropped when they take more than ``max_size`` bytes."""
+
+    def __init__(self, max_size, ignore_duplicate_keys=False):
+        self.max_size = max_size
+        self.ignore_duplicate_keys = ignore_duplicate_keys
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        tile = self.tiles.get(path)
+        if tile is not None and tile.is_current():
+            self.hits += 1
+            self.tiles.move_to_end(path)
+            return tile
+        if tile is not None:
+            self.remove(path)
+        self.misses += 1
+        tile = ParsedTile(path, self.ignore_duplicate_keys)
+        self.tiles[path] = tile
+        self.size += tile.size
+        # The tile that was just read is kept, even when it is larger than the cache
+        while self.size > self.max_size and len(self.tiles) > 1:
+            self.remove(next(iter(self.tiles)))
+        return tile
+
+    def remove(self, path):
+        self.size -= self.tiles.pop(path).size
+
+
+class BuildingService:
+    """Converts single buildings to IFC, finding their tile in the tile index ``index_file``."""
+
+    def __init__(self, index_file, cache_size=CACHE_SIZE * 1024 * 1024, ignore_duplicate_keys=False):
+        self.index = TileIndex(index_file)
+        self.cache = TileCache(cache_size, ignore_duplicate_keys)
+
+    def close(self):
+        self.index.close()
+
+    def get_model(self, identificatie, lod="2.2", tessellated=False):
+        """The IFC model of the building with its parts at a LoD, or None when the building is unknown."""
+        tile = self.index.find_tile(identificatie)
+        if tile is None:
+            return None
+        building = self.cache.get(tile).get_building(identificatie)
+        if building is None:
+            return None
+        converter = Cityjson2ifc()
+        converter.configuration(
+            name_project="3DBAG Project",
+            name_site="3DBAG Site",
+            name_person_family="3Dgeoinfo",
+            name_person_given="3DGI/",
+            lod=lod,
+            tessellated=tessellated,
+            file_destination=f"{identificatie}.ifc",
+        )
+        converter.city_model = building
+        converter.create_model()
+        return converter.IFC_model
+
+    def get_ifc(self, identificatie, lod="2.2", tessellated=False):
+        """The IFC of the building with its parts at a LoD as STEP text, or None when the building is unknown."""
+        IFC_model = self.get_model(identificatie, lod, tessellated)
+        return IFC_model.to_string() if IFC_model is not None else None
+
+
+class BuildingRequestHandler(BaseHTTPRequestHandler):
+    """GET /building/<identificatie>?lod=2.2&tessellated=1 returns the IFC file of the building."""
+
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "building":
+            self.send_error(404, "Use /building/<identificatie>")
+            return
+        identificatie = unquote(parts[1])
+        query = parse_qs(url.query)
+        lod = query.get("lod", ["2.2"])[0]
+        if lod not in LODS:
+            self.send_error(400, f"Unknown LoD {lod}, use one of {', '.join(LODS)}")
+            return
+        tessellated = query.get("tessellated", ["0"])[0].lower() in ["1", "true", "yes"]
+
+        start = time.perf_counter()
+        try:
+            ifc = self.service.get_ifc(identificatie, lod, tessellated)
+        except Exception as e:
+            self.send_error(500, f"{type(e).__name__}: {e}")
+            return
+        if ifc is None:
+            self.send_error(404, f"Building {identificatie} not found")
+            return
+        body = ifc.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-step")
+        self.send_header("Content-Disposition", f'attachment; filename="{identificatie}-{lod}.ifc"')
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Conversion-Time", f"{time.perf_counter() - start:.4f}")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@click.command()
+@click.option('--input_dir', default=".", show_default=True, help="Directory containing the CityJSON files.")
+@click.option('--index', 'index_file', type=click.Path(dir_okay=False), default=None,
+              help=f"SQLite index of tile_index.py, {INDEX_NAME} in the input directory by default.")
+@click.option('--host', default="127.0.0.1", show_default=True, help="Address to listen on.")
+@click.option('--port', type=int, default=8080, show_default=True, help="Port to listen on.")
+@click.option('--cache-size', type=int, default=CACHE_SIZE, show_default=True,
+              help="Memory for the parsed tiles in the cache, in MB.")
+@click.option('--ignore_duplicate', is_flag=True, default=False,
+              help="Ignore duplicate JSON keys in CityJSON files.")
+def main(input_dir, index_file, host, port, cache_size, ignore_duplicate):
+    """Serve the IFC of single buildings by their identificatie."""
+    input_dir = os.path.abspath(os.path.expanduser(input_dir))
+    index_file = os.path.abspath(os.path.expanduser(index_file or os.path.join(input_dir, INDEX_NAME)))
+    if not os.path.isfile(index_file):
+        raise click.ClickException(f"No index {index_file}, create it with: python tile_index.py build")
+    service = BuildingService(index_file, cache_size * 1024 * 1024, ignore_duplicate)
+    # Requests are handled one at a time, they share the cache of parsed tiles
+    BuildingRequestHandler.service = service
+    server = HTTPServer((host, port), BuildingRequestHandler)
+    click.echo(f"Serving buildings on http://{host}:{port}/building/<identificatie>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
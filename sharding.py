@@ -0,0 +1,155 @@
+"""
+Splits the tiles of an input directory over several nodes that share the directory, eg. over NFS.
+
+With a static shard i/n a node converts the tiles of which the hash of the path relative to the input
+directory modulo n is i. With leases every node goes over all tiles and claims a tile before converting
+it, by creating a lease file on the shared file system. There is no coordinator: the lease files of a
+tile are numbered and a claim is the exclusive creation of the next number, which only one node can
+win. The files of earlier claims are kept, emptied, so that a number is never created twice, also not by
+a node that listed the files before a newer claim. A lease is kept alive by a heartbeat that touches the
+file. A lease that has not been touched for longer than the timeout, eg. of a node that crashed, is
+expired and the tile can be claimed again.
+"""
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Time after which a lease that is not touched by its heartbeat expires, in seconds
+LEASE_TIMEOUT = 600
+
+
+class LeaseLost(Exception):
+    """Another node claimed the tile, the output of this node must not replace its output."""
+
+
+def parse_shard(text):
+    """Parse a shard "i/n", the i-th of n shards counting from 0, into (i, n)."""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard {text}, use i/n")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {text}, i must be between 0 and n - 1")
+    return index, count
+
+
+def get_tile_key(path, root):
+    """The path of a tile relative to the input directory, the same on every node whatever the mount point."""
+    return os.path.relpath(os.path.abspath(path), os.path.abspath(root)).replace(os.sep, "/")
+
+
+def in_shard(key, shard):
+    index, count = shard
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % count == index
+
+
+class Lease:
+    """A claim on a tile. Holds as long as its file is the latest lease file of the tile and is touched in time."""
+
+    def __init__(self, path, token, timeout, claimed_at):
+        self.path = path
+        self.token = token
+        self.timeout = timeout
+        self.claimed_at = claimed_at
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def __enter__(self):
+        self.start_heartbeat()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def start_heartbeat(self):
+        self.heartbeat = threading.Thread(target=self.run_heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(self.timeout / 4):
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    def is_held(self):
+        """
+        Whether no other node claimed the tile, eg. because the heartbeat stalled for longer than the timeout,
+        and the lease does not expire within half the timeout. What is done right after the check, eg. moving
+        the output in place, is then done before another node can claim the tile.
+        """
+        directory, name = os.path.split(self.path)
+        try:
+            if time.time() - os.stat(self.path).st_mtime >= self.timeout / 2:
+                return False
+            latest = max(get_generations(directory))
+            with open(os.path.join(directory, str(latest))) as file:
+                return json.load(file)["token"] == self.token
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def release(self):
+        """Stop the heartbeat and expire the lease, the tile can be claimed again right away."""
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        try:
+            os.utime(self.path, (0, 0))
+        except OSError:
+            pass
+
+
+def get_generations(directory):
+    return [int(name) for name in os.listdir(directory) if name.isdigit()]
+
+
+class LeaseDirectory:
+    """The lease files of the tiles of ``root``, in a directory per tile in ``directory``."""
+
+    def __init__(self, directory, root, timeout=LEASE_TIMEOUT):
+        self.directory = directory
+        self.root = root
+        self.timeout = timeout
+
+    def claim(self, path):
+        """Claim the tile, returns its Lease or None when another node holds it."""
+        key = get_tile_key(path, self.root)
+        directory = os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+        os.makedirs(directory, exist_ok=True)
+        generations = get_generations(directory)
+        generation = 0
+        if generations:
+            latest = max(generations)
+            try:
+                modified = os.stat(os.path.join(directory, str(latest))).st_mtime
+            except FileNotFoundError:
+                return None
+            if time.time() - modified < self.timeout:
+                return None
+            generation = latest + 1
+
+        lease_path = os.path.join(directory, str(generation))
+        token = uuid.uuid4().hex
+        claimed_at = time.time()
+        try:
+            # Only one node can create the next lease file, also on NFS. The files are never removed, so the
+            # number cannot have been created and removed by another claim in the meantime.
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as file:
+            json.dump({
+                "token": token, "tile": key, "host": socket.gethostname(), "pid": os.getpid(),
+                "claimed_at": claimed_at,
+            }, file)
+        # The earlier lease files are only kept for their number
+        for old in generations:
+            try:
+                os.truncate(os.path.join(directory, str(old)), 0)
+            except OSError:
+                pass
+        return Lease(lease_path, token, self.timeout, claimed_at)
@@ -0,0 +1,254 @@
+"""
+Simplifies the surfaces and solids of a CityJSON geometry before they are written as IFC faces.
+
+The LoD2 geometry of 3DBAG is split into many faces, eg. triangles, of which neighbours often lie in
+the same plane. Every face becomes an IfcFace with its loops, so merging them gives smaller files that
+load faster. Within a shell and a semantic surface, faces that share an edge and lie in the same plane
+within ``tolerance`` are merged into one face, with holes where the merged faces enclose others. The
+vertices of the rings that lie on a straight line between their neighbours are dropped, unless another
+face uses them, so that the shells stay closed. Repeated vertices and rings without an area are dropped.
+"""
+import math
+from collections import Counter
+
+from geometry import CompactGeometry
+
+# Distance in metres within which vertices are in the plane of a face or on the line between their neighbours
+DEFAULT_TOLERANCE = 0.01
+
+
+def get_plane(ring, coordinates):
+    """The unit normal and offset of the plane of a ring, by Newell's method, or None for a ring without area."""
+    normal = [0.0, 0.0, 0.0]
+    points = [coordinates[vertex] for vertex in ring]
+    for (x1, y1, z1), (x2, y2, z2) in zip(points, points[1:] + points[:1]):
+        normal[0] += (y1 - y2) * (z1 + z2)
+        normal[1] += (z1 - z2) * (x1 + x2)
+        normal[2] += (x1 - x2) * (y1 + y2)
+    length = math.sqrt(normal[0] ** 2 + normal[1] ** 2 + normal[2] ** 2)
+    if length == 0:
+        return None
+    normal = [value / length for value in normal]
+    centre = [sum(point[axis] for point in points) / len(points) for axis in range(3)]
+    return normal, sum(n * c for n, c in zip(normal, centre))
+
+
+def get_distance(plane, point):
+    normal, offset = plane
+    return abs(normal[0] * point[0] + normal[1] * point[1] + normal[2] * point[2] - offset)
+
+
+def get_area(ring, coordinates, normal):
+    """The area of a ring projected on the plane of ``normal``, negative when it turns the other way."""
+    total = [0.0, 0.0, 0.0]
+    points = [coordinates[vertex] for vertex in ring]
+    for (x1, y1, z1), (x2, y2, z2) in zip(points, points[1:] + points[:1]):
+        total[0] += y1 * z2 - z1 * y2
+        total[1] += z1 * x2 - x1 * z2
+        total[2] += x1 * y2 - y1 * x2
+    return (normal[0] * total[0] + normal[1] * total[1] + normal[2] * total[2]) / 2
+
+
+def clean_ring(ring):
+    """The ring without repeated vertices, also the last one when it repeats the first."""
+    cleaned = [vertex for i, vertex in enumerate(ring) if i == 0 or vertex != ring[i - 1]]
+    while len(cleaned) > 1 and cleaned[0] == cleaned[-1]:
+        cleaned.pop()
+    return cleaned
+
+
+def is_collinear(previous, point, following, tolerance):
+    """Whether ``point`` lies on the segment between its neighbours, within ``tolerance``."""
+    direction = [following[axis] - previous[axis] for axis in range(3)]
+    offset = [point[axis] - previous[axis] for axis in range(3)]
+    length = sum(value * value for value in direction)
+    if length == 0:
+        return False
+    t = sum(d * o for d, o in zip(direction, offset)) / length
+    if t <= 0 or t >= 1:
+        return False
+    return math.dist(point, [previous[axis] + t * direction[axis] for axis in range(3)]) <= tolerance
+
+
+def drop_collinear(ring, coordinates, tolerance, removable):
+    """The ring without the vertices of ``removable`` that lie on the line between their neighbours."""
+    ring = list(ring)
+    i = 0
+    while len(ring) > 3 and i < len(ring):
+        vertex = ring[i]
+        previous, following = ring[i - 1], ring[(i + 1) % len(ring)]
+        if vertex in removable and is_collinear(
+            coordinates[previous], coordinates[vertex], coordinates[following], tolerance
+        ):
+            del ring[i]
+            # The previous vertex may be collinear now
+            i = max(i - 1, 0)
+        else:
+            i += 1
+    return ring
+
+
+def get_loops(faces):
+    """
+    The rings around the faces, which share edges in opposite directions, or None when they do not
+    form simple rings, eg. when they touch in a single vertex.
+    """
+    edges = Counter()
+    for face in faces:
+        for ring in face:
+            for start, end in zip(ring, ring[1:] + ring[:1]):
+                edges[start, end] += 1
+    # The edges between two of the faces are inside the merged face
+    for (start, end), count in list(edges.items()):
+        shared = min(count, edges.get((end, start), 0))
+        if shared:
+            edges[start, end] -= shared
+            edges[end, start] -= shared
+    following = {}
+    for (start, end), count in edges.items():
+        if count == 0:
+            continue
+        if count > 1 or start in following:
+            return None
+        following[start] = end
+    loops = []
+    while following:
+        start, vertex = following.popitem()
+        loop = [start]
+        while vertex != start:
+            loop.append(vertex)
+            if vertex not in following:
+                return None
+            vertex = following.pop(vertex)
+        loops.append(loop)
+    return loops
+
+
+def merge_faces(faces, coordinates, normal):
+    """The faces as a single face with holes, or None when they cannot be merged into one."""
+    loops = get_loops(faces)
+    if loops is None:
+        return None
+    exteriors = [loop for loop in loops if get_area(loop, coordinates, normal) > 0]
+    if len(exteriors) != 1:
+        return None
+    return exteriors + [loop for loop in loops if loop is not exteriors[0]]
+
+
+class Simplifier:
+    """Simplifies the geometries of a conversion within ``tolerance``."""
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+
+    def simplify(self, geometry, coordinates):
+        """
+        A simplified copy of a CompactGeometry with the vertex indices of the array ``coordinates``, eg. of
+        a VertexPool, with the number of faces and ring vertices that were removed. Other geometries are
+        returned as they are.
+        """
+        if not isinstance(geometry, CompactGeometry) or not len(geometry.vertices):
+            return geometry, 0, 0
+        faces = geometry.get_faces()
+        used = geometry.get_vertex_indices()
+        points = dict(zip(used, coordinates[used].tolist()))
+        values = geometry.surface_values.tolist() if geometry.surface_values is not None else [-1] * len(faces)
+        paths = geometry.get_face_paths()
+
+        # The number of faces that use every vertex, a vertex that only the merged faces use can be dropped
+        usage = Counter(vertex for face in faces for vertex in {vertex for ring in face for vertex in ring})
+        groups = {}
+        for face_id, (path, value) in enumerate(zip(paths, values)):
+            groups.setdefault((tuple(path[:-1]), value), []).append(face_id)
+
+        new_faces = {}
+        for (shell, value), face_ids in groups.items():
+            for face in self.simplify_group([faces[face_id] for face_id in face_ids], points, usage):
+                new_faces.setdefault(shell, []).append((face, value))
+
+        boundaries, new_values = self.rebuild(geometry, new_faces)
+        semantics = None
+        if geometry.semantic_surfaces is not None:
+            semantics = {"surfaces": geometry.semantic_surfaces, "values": new_values}
+        simplified = CompactGeometry(geometry.type, geometry.lod, boundaries, semantics)
+        return simplified, len(faces) - (len(simplified.faces) - 1), len(geometry.vertices) - len(simplified.vertices)
+
+    def simplify_group(self, faces, points, usage):
+        """The faces of a shell and a semantic surface, merged and cleaned."""
+        cleaned = []
+        for face in faces:
+            rings = [clean_ring(ring) for ring in face]
+            exterior = rings[0] if rings and len(rings[0]) >= 3 else None
+            plane = get_plane(exterior, points) if exterior is not None else None
+            if plane is None:
+                continue
+            holes = [ring for ring in rings[1:] if len(ring) >= 3 and get_plane(ring, points) is not None]
+            cleaned.append(([exterior] + holes, plane))
+
+        # Faces that share an edge in the opposite direction are neighbours
+        edges = {}
+        for index, (face, _) in enumerate(cleaned):
+            for ring in face:
+                for start, end in zip(ring, ring[1:] + ring[:1]):
+                    edges.setdefault((start, end), []).append(index)
+        merged = set()
+        result = []
+        for seed, (face, plane) in enumerate(cleaned):
+            if seed in merged:
+                continue
+            merged.add(seed)
+            # Grow the region of the faces in the plane of the seed, so that the plane does not drift
+            region = [seed]
+            stack = [seed]
+            while stack:
+                for ring in cleaned[stack.pop()][0]:
+                    for start, end in zip(ring, ring[1:] + ring[:1]):
+                        for neighbour in edges.get((end, start), []):
+                            if neighbour in merged or not self.is_coplanar(plane, cleaned[neighbour], points):
+                                continue
+                            merged.add(neighbour)
+                            region.append(neighbour)
+                            stack.append(neighbour)
+            region_faces = [cleaned[index][0] for index in region]
+            merged_face = merge_faces(region_faces, points, plane[0]) if len(region) > 1 else None
+            if merged_face is None:
+                result.extend(self.drop_collinear(face, points, usage, [face]) for face in region_faces)
+            else:
+                result.append(self.drop_collinear(merged_face, points, usage, region_faces))
+        return [face for face in result if face is not None]
+
+    def is_coplanar(self, plane, face, points):
+        rings, neighbour_plane = face
+        if sum(a * b for a, b in zip(plane[0], neighbour_plane[0])) <= 0:
+            return False
+        return all(get_distance(plane, points[vertex]) <= self.tolerance for ring in rings for vertex in ring)
+
+    def drop_collinear(self, face, points, usage, faces):
+        """The face without the collinear vertices that no face other than ``faces`` uses, None when nothing is left."""
+        own = Counter(vertex for other in faces for vertex in {vertex for ring in other for vertex in ring})
+        removable = {vertex for vertex, count in own.items() if usage[vertex] == count}
+        rings = [drop_collinear(ring, points, self.tolerance, removable) for ring in face]
+        if get_plane(rings[0], points) is None:
+            return None
+        return [rings[0]] + [ring for ring in rings[1:] if get_plane(ring, points) is not None]
+
+    def rebuild(self, geometry, new_faces):
+        """The boundaries and semantic values of the geometry from the faces and values of every shell."""
+        def shell(key):
+            faces = new_faces.get(key, [])
+            return [face for face, _ in faces], [value if value >= 0 else None for _, value in faces]
+
+        if geometry.shells is None:
+            return shell(())
+        shells = geometry.shells.tolist()
+        if geometry.solids is None:
+            parts = [shell((index,)) for index in range(len(shells) - 1)]
+            return [faces for faces, _ in parts], [values for _, values in parts]
+        solids = geometry.solids.tolist()
+        boundaries = []
+        solid_values = []
+        for solid in range(len(solids) - 1):
+            parts = [shell((solid, index)) for index in range(solids[solid + 1] - solids[solid])]
+            boundaries.append([faces for faces, _ in parts])
+            solid_values.append([values for _, values in parts])
+        return boundaries, solid_values
@@ -0,0 +1,116 @@
+import re
+
+# Strings are left out when looking for references, they can contain a #
+STRING = re.compile(r"'(?:[^']|'')*'")
+REFERENCE = re.compile(r"#(\d+)")
+STRING_OR_REFERENCE = re.compile(r"'(?:[^']|'')*'|#(\d+)")
+
+
+def format_real(value):
+    """
+    A REAL as ifcopenshell writes it: the shortest digits that read back as ``value``, in fixed notation
+    unless scientific notation is shorter, with a decimal point in either, eg. 0., 0.25 or 1.E-05.
+    """
+    text = repr(value)
+    sign = ""
+    if text[0] == "-":
+        sign, text = "-", text[1:]
+    mantissa, _, exponent = text.partition("e")
+    whole, _, fraction = mantissa.partition(".")
+    digits = whole + fraction
+    # The decimal point is before the digit at index ``point``
+    point = len(whole) + int(exponent or 0)
+    stripped = digits.lstrip("0")
+    point -= len(digits) - len(stripped)
+    digits = stripped.rstrip("0")
+    if not digits:
+        return sign + "0."
+    power = f"{'-' if point < 1 else '+'}{abs(point - 1):02d}"
+    if point <= 0:
+        fixed = "0." + "0" * -point + digits
+    elif point >= len(digits):
+        # Large numbers are written with all their digits
+        fixed = str(int(abs(value)))
+    else:
+        fixed = digits[:point] + "." + digits[point:]
+    scientific_size = len(digits) + (len(digits) > 1) + 1 + len(power)
+    if len(fixed) <= scientific_size:
+        return sign + (fixed if "." in fixed else fixed + ".")
+    return f"{sign}{digits[0]}.{digits[1:]}E{power}"
+
+
+def format_list(items):
+    return "(" + ",".join(items) + ")"
+
+
+def format_references(entity_ids):
+    return "(" + ",".join(f"#{entity_id}" for entity_id in entity_ids) + ")"
+
+
+def shift_references(line, offset, first):
+    """The line with ``offset`` added to the id of the entity and of the references from ``first`` on."""
+    def shift(match):
+        if match.group(1) is None or int(match.group(1)) < first:
+            return match.group(0)
+        return f"#{int(match.group(1)) + offset}"
+    return STRING_OR_REFERENCE.sub(shift, line)
+
+
+class StepFile:
+    """
+    The entities of an IFC model as lines of STEP text by their id, to write subsets of the model as text
+    without copying the model. The text is the output of ``ifcopenshell.file.to_string()``, which writes
+    every entity on a line of its own.
+    """
+
+    def __init__(self, text):
+        header, _, data = text.partition("\nDATA;\n")
+        data, _, footer = data.rpartition("ENDSEC;")
+        self.header = header + "\nDATA;\n"
+        self.footer = "ENDSEC;" + footer
+        self.lines = {}
+        for line in data.splitlines():
+            if line.startswith("#"):
+                self.lines[int(line[1:line.index("=")])] = line
+
+    def get_references(self, entity_id):
+        line = self.lines[entity_id]
+        attributes = line[line.index("("):]
+        if "'" in attributes:
+            attributes = STRING.sub("''", attributes)
+        return [int(reference) for reference in REFERENCE.findall(attributes)]
+
+    def get_roots(self):
+        """The entities that no other entity refers to, eg. the products and relations."""
+        referenced = set()
+        for entity_id in self.lines:
+            referenced.update(self.get_references(entity_id))
+        return set(self.lines) - referenced
+
+    def get_closure(self, start, stop=frozenset()):
+        """The entities of ``start`` and all entities they refer to, without going into the entities of ``stop``."""
+        closure = set()
+        stack = [entity_id for entity_id in start if entity_id not in stop]
+        while stack:
+            entity_id = stack.pop()
+            if entity_id in closure:
+                continue
+            closure.add(entity_id)
+            stack.extend(
+                reference for reference in self.get_references(entity_id)
+                if reference not in closure and reference not in stop
+            )
+        return closure
+
+    def remove_references(self, entity_id, removed):
+        """The line of the entity without the references to ``removed`` in its lists."""
+        line = self.lines[entity_id]
+        for reference in set(self.get_references(entity_id)) & removed:
+            line = re.sub(rf"#{reference}(?!\d),?", "", line)
+        return line.replace(",)", ")")
+
+    def to_string(self, entity_ids, lines=None):
+        """The STEP text of the entities, with the lines of ``lines`` instead of their own."""
+        lines = lines or {}
+        data = "\n".join(lines.get(entity_id, self.lines[entity_id]) for entity_id in sorted(entity_ids))
+        return f"{self.header}{data}\n{self.footer}"
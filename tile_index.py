@@ -0,0 +1,327 @@
+"""
+Spatial and ID index over a directory of CityJSON tiles, to convert a part of the tiles to a single IFC file.
+
+The index is a SQLite file with the bounding box of every tile and of every building with the ids of its
+CityObjects. A query by bounding box, polygon or ids only opens the tiles that have matching buildings,
+and only the matching buildings are converted.
+
+    python tile_index.py build --input_dir /data/tiles
+    python tile_index.py extract --input_dir /data/tiles --bbox 85000,446000,85500,446500 area.ifc
+    python tile_index.py extract --input_dir /data/tiles --ids NL.IMBAG.Pand.0363100012185598 pand.ifc
+"""
+import json
+import os
+import sqlite3
+
+import click
+
+from batch_converter import LODS, find_cityjson_files, stream_cityjson
+from cityjson2ifc import Cityjson2ifc
+from reader import CityJSONStream, CityJSONSubset, get_feature_bbox, get_feature_key
+
+# Name of the index in the input directory
+INDEX_NAME = "tile_index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    minx REAL,
+    miny REAL,
+    maxx REAL,
+    maxy REAL
+);
+CREATE TABLE IF NOT EXISTS buildings (
+    tile TEXT,
+    feature TEXT,
+    object_ids TEXT,
+    minx REAL,
+    miny REAL,
+    maxx REAL,
+    maxy REAL
+);
+CREATE INDEX IF NOT EXISTS buildings_tile ON buildings (tile);
+CREATE INDEX IF NOT EXISTS buildings_feature ON buildings (feature);
+CREATE INDEX IF NOT EXISTS buildings_x ON buildings (minx, maxx);
+CREATE TABLE IF NOT EXISTS objects (
+    id TEXT,
+    tile TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_id ON objects (id);
+CREATE INDEX IF NOT EXISTS objects_tile ON objects (tile)
+"""
+
+
+def point_in_polygon(x, y, polygon):
+    """Whether the point is inside the polygon, a list of (x, y), by the even-odd rule."""
+    inside = False
+    n = len(polygon)
+    for i in range(n):
+        x1, y1 = polygon[i]
+        x2, y2 = polygon[(i + 1) % n]
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def get_polygon_bbox(polygon):
+    xs = [x for x, y in polygon]
+    ys = [y for x, y in polygon]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class TileIndex:
+    """
+    The bounding boxes of the tiles and their buildings and the ids of their CityObjects, in a SQLite file.
+
+    A tile is indexed again when its size or modification time changed. The queries return the selected
+    CityObject ids by tile, so that only those tiles are opened. A building is selected by a polygon when
+    the centre of its bounding box is inside the polygon.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_indexed(self, path):
+        row = self.connection.execute(
+            "SELECT size, mtime_ns FROM tiles WHERE path = ?", (os.path.abspath(path),)
+        ).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(path)
+        return row == (stat.st_size, stat.st_mtime_ns)
+
+    def add_tile(self, path, ignore_duplicate_keys=False):
+        """Index the buildings of a tile, replacing an earlier index of the tile. Returns the number of buildings."""
+        stream = CityJSONStream(path, ignore_duplicate_keys=ignore_duplicate_keys)
+        translate = stream.transform["translate"] if stream.transform else None
+        buildings = []
+        objects = []
+        for cityobjects, vertex_pool in stream.features():
+            bbox = get_feature_bbox(cityobjects, vertex_pool, translate)
+            buildings.append((get_feature_key(cityobjects), json.dumps(list(cityobjects)), bbox))
+            objects.extend(cityobjects)
+
+        bboxes = [bbox for _, _, bbox in buildings if bbox is not None]
+        if bboxes:
+            tile_bbox = (
+                min(bbox[0] for bbox in bboxes), min(bbox[1] for bbox in bboxes),
+                max(bbox[2] for bbox in bboxes), max(bbox[3] for bbox in bboxes),
+            )
+        else:
+            tile_bbox = (None, None, None, None)
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.remove_tile(path)
+            self.connection.execute(
+                "INSERT INTO tiles (path, size, mtime_ns, minx, miny, maxx, maxy) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, *tile_bbox),
+            )
+            self.connection.executemany(
+                "INSERT INTO buildings (tile, feature, object_ids, minx, miny, maxx, maxy) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(path, feature, object_ids, *(bbox or (None,) * 4)) for feature, object_ids, bbox in buildings],
+            )
+            self.connection.executemany(
+                "INSERT INTO objects (id, tile) VALUES (?, ?)", [(object_id, path) for object_id in objects]
+            )
+        return len(buildings)
+
+    def remove_tile(self, path):
+        for table, column in [("tiles", "path"), ("buildings", "tile"), ("objects", "tile")]:
+            self.connection.execute(f"DELETE FROM {table} WHERE {column} = ?", (path,))
+
+    def build(self, paths, ignore_duplicate_keys=False):
+        """Index the new and changed tiles of ``paths`` and forget the tiles that no longer exist."""
+        indexed = 0
+        for path in paths:
+            if self.is_indexed(path):
+                continue
+            buildings = self.add_tile(path, ignore_duplicate_keys)
+            click.echo(f"Indexed {buildings} buildings of {path}.")
+            indexed += 1
+        for (path,) in self.connection.execute("SELECT path FROM tiles").fetchall():
+            if not os.path.isfile(path):
+                with self.connection:
+                    self.connection.execute("BEGIN")
+                    self.remove_tile(path)
+        return indexed
+
+    def query_bbox(self, bbox):
+        """The ids of the CityObjects of the buildings that overlap the bounding box, by tile."""
+        minx, miny, maxx, maxy = bbox
+        rows = self.connection.execute(
+            "SELECT b.tile, b.feature, b.object_ids FROM tiles t JOIN buildings b ON b.tile = t.path "
+            "WHERE t.minx <= ? AND t.maxx >= ? AND t.miny <= ? AND t.maxy >= ? "
+            "AND b.minx <= ? AND b.maxx >= ? AND b.miny <= ? AND b.maxy >= ? ORDER BY b.tile",
+            (maxx, minx, maxy, miny, maxx, minx, maxy, miny),
+        )
+        return self.group_by_tile(rows)
+
+    def query_polygon(self, polygon):
+        """The ids of the CityObjects of the buildings with the centre of their bounding box inside the polygon, by tile."""
+        minx, miny, maxx, maxy = get_polygon_bbox(polygon)
+        rows = self.connection.execute(
+            "SELECT b.tile, b.feature, b.object_ids, b.minx, b.miny, b.maxx, b.maxy FROM tiles t "
+            "JOIN buildings b ON b.tile = t.path "
+            "WHERE t.minx <= ? AND t.maxx >= ? AND t.miny <= ? AND t.maxy >= ? "
+            "AND b.minx <= ? AND b.maxx >= ? AND b.miny <= ? AND b.maxy >= ? ORDER BY b.tile",
+            (maxx, minx, maxy, miny, maxx, minx, maxy, miny),
+        )
+        return self.group_by_tile(
+            (tile, feature, object_ids)
+            for tile, feature, object_ids, bminx, bminy, bmaxx, bmaxy in rows
+            if point_in_polygon((bminx + bmaxx) / 2, (bminy + bmaxy) / 2, polygon)
+        )
+
+    def query_ids(self, object_ids):
+        """The CityObject ids that are in the index, by tile. Ids that are in several tiles are taken from the first."""
+        selected = {}
+        seen = set()
+        object_ids = list(dict.fromkeys(object_ids))
+        # Stay below the limit of the number of parameters of SQLite
+        for start in range(0, len(object_ids), 500):
+            batch = object_ids[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT id, tile FROM objects WHERE id IN ({', '.join('?' * len(batch))}) ORDER BY tile",
+                batch,
+            )
+            for object_id, tile in rows:
+                if object_id not in seen:
+                    seen.add(object_id)
+                    selected.setdefault(tile, set()).add(object_id)
+        return selected
+
+    def find_tile(self, feature):
+        """The tile of a building by its identificatie, or of a CityObject by its id. None when it is not in the index."""
+        row = self.connection.execute("SELECT tile FROM buildings WHERE feature = ? LIMIT 1", (feature,)).fetchone()
+        if row is None:
+            row = self.connection.execute("SELECT tile FROM objects WHERE id = ? LIMIT 1", (feature,)).fetchone()
+        return row[0] if row is not None else None
+
+    def group_by_tile(self, rows):
+        selected = {}
+        features = set()
+        for tile, feature, object_ids in rows:
+            # A building on the border of two tiles is converted once
+            if feature in features:
+                continue
+            features.add(feature)
+            selected.setdefault(tile, set()).update(json.loads(object_ids))
+        return selected
+
+
+def parse_coordinates(text, count=None):
+    values = [float(value) for value in text.replace(",", " ").split()]
+    if len(values) % 2 or (count is not None and len(values) != count):
+        raise click.BadParameter(f"Invalid coordinates: {text}")
+    return values
+
+
+def convert_selection(selected, output, lod=None, tessellated=False, ignore_duplicate_keys=False):
+    """Convert the selected CityObjects, by tile, to a single IFC file."""
+    streams = [stream_cityjson(tile, ignore_duplicate_keys=ignore_duplicate_keys) for tile in sorted(selected)]
+    object_ids = set().union(*selected.values())
+    converter = Cityjson2ifc()
+    converter.configuration(
+        name_project="3DBAG Project",
+        name_site="3DBAG Site",
+        name_person_family="3Dgeoinfo",
+        name_person_given="3DGI/",
+        split=False,
+        lod=lod,
+        tessellated=tessellated,
+        object_ids=object_ids,
+        file_destination=output,
+    )
+    converter.convert(CityJSONSubset(streams))
+    return converter
+
+
+def get_index_file(index_file, input_dir):
+    return os.path.abspath(os.path.expanduser(index_file or os.path.join(input_dir, INDEX_NAME)))
+
+
+@click.group()
+def main():
+    """Index CityJSON tiles and convert the buildings in an area or with given ids to IFC."""
+
+
+@main.command()
+@click.option('--input_dir', required=True, help="Directory containing the CityJSON files.")
+@click.option('--index', 'index_file', type=click.Path(dir_okay=False), default=None,
+              help=f"SQLite index, {INDEX_NAME} in the input directory by default.")
+@click.option('--ignore_duplicate', is_flag=True, default=False,
+              help="Ignore duplicate JSON keys in CityJSON files.")
+def build(input_dir, index_file, ignore_duplicate):
+    """Index the new and changed CityJSON files of the input directory."""
+    input_dir = os.path.abspath(os.path.expanduser(input_dir))
+    cityjson_files = find_cityjson_files(input_dir)
+    with TileIndex(get_index_file(index_file, input_dir)) as index:
+        indexed = index.build(cityjson_files, ignore_duplicate)
+    click.echo(f"Indexed {indexed} of {len(cityjson_files)} CityJSON files.")
+
+
+@main.command()
+@click.option('--input_dir', default=".", show_default=True, help="Directory containing the CityJSON files.")
+@click.option('--index', 'index_file', type=click.Path(dir_okay=False), default=None,
+              help=f"SQLite index, {INDEX_NAME} in the input directory by default.")
+@click.option('--bbox', default=None, help="Bounding box minx,miny,maxx,maxy in the CRS of the tiles.")
+@click.option('--polygon', default=None, help="Polygon as x1,y1 x2,y2 ... in the CRS of the tiles.")
+@click.option('--ids', default=None, help="Comma separated ids of CityObjects, eg. BAG pand ids.")
+@click.option('--ids-file', type=click.File(), default=None, help="File with an id of a CityObject on every line.")
+@click.option('--lod', type=click.Choice(LODS), default=None, help="Only convert this LoD, all LoDs by default.")
+@click.option('--tessellated', is_flag=True, default=False,
+              help="Write geometry as IfcPolygonalFaceSet instead of IfcFace/IfcPolyLoop.")
+@click.option('--ignore_duplicate', is_flag=True, default=False,
+              help="Ignore duplicate JSON keys in CityJSON files.")
+@click.argument('output', type=click.Path(dir_okay=False))
+def extract(input_dir, index_file, bbox, polygon, ids, ids_file, lod, tessellated, ignore_duplicate, output):
+    """Convert the buildings in a bounding box or polygon or with the given ids, with their parts, to one IFC file."""
+    if sum(option is not None for option in [bbox, polygon, ids or ids_file]) != 1:
+        raise click.UsageError("Give one of --bbox, --polygon or --ids/--ids-file.")
+    input_dir = os.path.abspath(os.path.expanduser(input_dir))
+    index_file = get_index_file(index_file, input_dir)
+    if not os.path.isfile(index_file):
+        raise click.ClickException(f"No index {index_file}, create it with the build command.")
+
+    with TileIndex(index_file) as index:
+        if bbox is not None:
+            selected = index.query_bbox(parse_coordinates(bbox, 4))
+        elif polygon is not None:
+            values = parse_coordinates(polygon)
+            if len(values) < 6:
+                raise click.BadParameter("A polygon needs at least three points.")
+            selected = index.query_polygon(list(zip(values[::2], values[1::2])))
+        else:
+            object_ids = [object_id.strip() for object_id in (ids or "").split(",") if object_id.strip()]
+            if ids_file is not None:
+                object_ids.extend(line.strip() for line in ids_file if line.strip())
+            selected = index.query_ids(object_ids)
+            missing = set(object_ids).difference(*selected.values())
+            if missing:
+                click.echo(f"{len(missing)} ids are not in the index: {', '.join(sorted(missing)[:10])}")
+
+    if not selected:
+        raise click.ClickException("No buildings found.")
+    click.echo(f"Converting {sum(len(ids) for ids in selected.values())} CityObjects of {len(selected)} tiles ...")
+    convert_selection(selected, output, lod, tessellated, ignore_duplicate)
+    click.echo(f"Created {output}.")
+
+
+if __name__ == "__main__":
+    main()